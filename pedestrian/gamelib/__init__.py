@@ -11,10 +11,38 @@ The GameUnit class in unit.py represetns a single unit.
 Investigating it is useful for any player that wants to access information about units. \n
 
 The AlgoCore class in algocore.py handles communication with the game engine, and forms the bones of an algo. AlgoStrategy inherits from it. 
-Investigating it is useful for advanced players interested in getting data from the action phase or communicating directly with the game engine. \n
+Investigating it is useful for advanced players interested in getting data from the action phase or communicating directly with the game engine. 
+Its anytime_turn runs improvement steps within the turn time budget and submits the best plan they found, 
+and its watchdog submits a fallback plan if on_turn overruns. \n
 
 The Navigation class in navigation.py contains functions related to pathfinding, which are used by GameState in pathing related functions. 
 Investigating it is useful for advanced player who want to optimize the slow default pathing algorithm we provide. \n 
+GridPathFinder is an array backed version of ShortestPathFinder that GameState uses by default, it can also path on hypothetical blocked bitmaps. \n
+
+The EvaluationPool class in pool.py scores candidate plans in worker processes on a board published to shared memory, 
+returning whatever finished before a timeout. Create it in on_game_start. \n
+
+The CompactBoard class in board.py stores the board in flat per-tile arrays and only creates GameUnits for the tiles you look at. 
+It is useful for aggregate queries over many units, like the total health of enemy turrets in a few rows. \n
+
+The CoverageMap class in coverage.py tracks which tiles each player's turrets can hit, for how much damage, and the shields their supports give. 
+GameMap keeps one up to date, so get_attackers and path damage estimates are lookups instead of range scans. \n
+
+The Ruleset class in ruleset.py holds the rules compiled from the game config, like unit types, costs and ranges. 
+Every GameState has one as game_state.ruleset. \n
+
+The ActionSimulator class in simulator.py steps the action phase locally, to see what a deployment would do before submitting it. \n
+
+calibration.py replays the turns of .replay files through the ActionSimulator and reports where they diverge, 
+run it with python -m gamelib.calibration. \n
+
+The TargetingEngine class in targeting.py picks attack targets for GameState.get_target and GameState.get_targets_batch, 
+the batch version resolves every attack of a frame at once. \n
+
+The TranspositionCache class in transposition.py is a bounded cache with hit counters for analyses keyed on GameMap.zobrist_hash, 
+the hash of the structure layout. \n
+
+geometry.py contains lookup tables describing the board, like the in-bounds table, the edges and each player's half. \n
 
 util.py contains a small handful of functions that help with communication, including the debug-printing function, debug_write().
 """
@@ -25,5 +53,5 @@ from .game_state import GameState
 from .unit import GameUnit
 from .game_map import GameMap
 
-__all__ = ["algocore", "game_state", "game_map", "navigation", "unit", "util"]
+__all__ = ["algocore", "board", "calibration", "coverage", "game_state", "game_map", "geometry", "navigation", "pool", "ruleset", "simulator", "targeting", "transposition", "unit", "util"]
  
\ No newline at end of file
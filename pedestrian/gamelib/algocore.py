@@ -1,19 +1,280 @@
 import json
+import time
+import queue
+import types
+import threading
+import traceback
+from collections import deque
 
 from .game_state import GameState
-from .util import get_command, debug_write, BANNER_TEXT, send_command
+from .util import get_command, debug_write, BANNER_TEXT, decode_json, submit_commands, open_turn, close_turn
+
+DEFAULT_TURN_TIME_LIMIT = 5.0
+
+
+def _is_turn(message):
+    """True if an engine message is the game state of a new turn
+    """
+    if "turnInfo" not in message:
+        return False
+    try:
+        return int(decode_json(message)["turnInfo"][0]) == 0
+    except (ValueError, KeyError, IndexError, TypeError):
+        return False
+
+
+class AnytimeTurn:
+    """Runs improvement steps on a turn until they are done or the time budget is spent, then submits the best plan
+
+    A step is a function called as step(game_state) that plans on top of the baseline with attempt_spawn, 
+    attempt_upgrade and attempt_remove and returns a score, or None if it found nothing worth submitting. 
+    A step can also be a generator that yields a score every time its plan improves, the deadline is then 
+    checked between yields and the generator is closed once it passes. Every step starts from the baseline, 
+    the plan the game state held when the turn was created, and is rolled back when it ends.
+
+    A step that raises is logged and skipped. Steps are never interrupted, so keep single steps and yields short and use time_left for anything longer, 
+    for example as the timeout of EvaluationPool.evaluate.
+
+    Attributes :
+        * game_state (:obj: GameState): The turn being planned
+        * deadline (float): The time.monotonic() by which the best plan is submitted
+        * best_score (float): The score of the best plan so far
+        * best_step (int): The index of the step that found the best plan, None for the baseline
+        * steps_run (int): The number of steps started
+
+    """
+    def __init__(self, game_state, deadline, baseline_score=float("-inf")):
+        self.game_state = game_state
+        self.deadline = deadline
+        self.best_score = baseline_score
+        self.best_step = None
+        self.steps_run = 0
+        self._steps = []
+        self._baseline = game_state.savepoint()
+        self._best_plan = (list(game_state._build_stack), list(game_state._deploy_stack))
+
+    def add_step(self, step):
+        """Registers an improvement step, steps run in the order they are added
+        """
+        self._steps.append(step)
+
+    def time_left(self):
+        """Seconds until the deadline, never below 0
+        """
+        return max(0.0, self.deadline - time.monotonic())
+
+    def expired(self):
+        """True once the deadline has passed
+        """
+        return time.monotonic() >= self.deadline
+
+    def __offer(self, score, index):
+        if score is not None and score > self.best_score:
+            self.best_score = score
+            self.best_step = index
+            self._best_plan = (list(self.game_state._build_stack), list(self.game_state._deploy_stack))
+
+    def __run_step(self, step, index):
+        result = step(self.game_state)
+        if not isinstance(result, types.GeneratorType):
+            self.__offer(result, index)
+            return
+        try:
+            for score in result:
+                self.__offer(score, index)
+                if self.expired():
+                    break
+        finally:
+            result.close()
+
+    def run(self, submit=True):
+        """Runs the registered steps until they are done or the deadline passes, then submits the best plan
+
+        Afterwards the game state is back at the baseline, the best plan is what was submitted.
+
+        Args:
+            submit: If false, the best plan is only returned
+
+        Returns:
+            The (build, deploy) command lists of the best plan
+
+        """
+        game_state = self.game_state
+        for index, step in enumerate(self._steps):
+            if self.expired():
+                break
+            self.steps_run += 1
+            try:
+                self.__run_step(step, index)
+            except Exception:
+                debug_write("Step {} failed, keeping the best plan so far:\n{}".format(index, traceback.format_exc()))
+            game_state.rollback(self._baseline)
+        if self.steps_run < len(self._steps):
+            debug_write("Turn budget spent after {} of {} steps".format(self.steps_run, len(self._steps)))
+        if submit:
+            game_state._build_stack, game_state._deploy_stack = list(self._best_plan[0]), list(self._best_plan[1])
+            game_state.submit_turn()
+            game_state.rollback(self._baseline)
+        return self._best_plan
+
 
 class AlgoCore(object):
     """
     This class handles communication with the game engine. \n
     algo_strategy.py subclasses it. 
 
+    It also keeps the time budget of anytime turns, see anytime_turn. The budget is the engine's soft turn 
+    time limit minus a safety margin, minus the largest recent gap between the time the engine reported 
+    for a turn (my_time) and the time on_turn took here.
+
+    A watchdog guards every turn from the moment it is received. If the turn is not submitted within 
+    watchdog_timeout, it submits fallback_plan instead and sets turn_overran. Whatever on_turn submits 
+    afterwards is discarded. Keep fallback_plan cheap to send and current, for example last turn's repairs, 
+    see set_fallback. If on_turn returns without submitting, the fallback is submitted right away.
+
+    Messages from the engine are read on a separate thread and stamped when they arrive, so the watchdog 
+    and anytime_turn count from the arrival of a turn even if on_turn was still busy with the previous one. 
+    A turn that arrives while on_turn is still running is answered with the fallback right away, and 
+    on_turn is not called for it.
+
     Attributes :
         * config (JSON): json object containing information about the game
+        * turn_time_limit (float): The turn time limit in seconds, read from the config if None
+        * turn_time_margin (float): The share of the limit that is never planned into
+        * turn_overheads (deque): Recent reported turn times minus the measured on_turn times, in seconds
+        * watchdog_enabled (bool): If true, turns are guarded by the watchdog
+        * watchdog_timeout (float): Seconds from receiving a turn to submitting the fallback, 95% of the turn time limit 
+          minus the worst recent overhead if None
+        * fallback_plan (tuple): The (build, deploy) command lists the watchdog submits
+        * turn_overran (bool): True once the watchdog has submitted the fallback for the current turn
 
     """
     def __init__(self):
         self.config = None
+        self.turn_time_limit = None
+        self.turn_time_margin = 0.15
+        self.turn_overheads = deque(maxlen=10)
+        self.watchdog_enabled = True
+        self.watchdog_timeout = None
+        self.fallback_plan = ([], [])
+        self.turn_overran = False
+        self._turn_started = None
+        self._last_turn_elapsed = None
+        self._turn_running = False
+        self._turn_lock = threading.Lock()
+
+    def __time_limit(self):
+        limit = self.turn_time_limit
+        if limit is None:
+            timing = (self.config or {}).get("timingAndReplay", {})
+            limit = timing["waitTimeBotSoft"] / 1000 if "waitTimeBotSoft" in timing else DEFAULT_TURN_TIME_LIMIT
+        return limit, max(max(self.turn_overheads, default=0.0), 0.0)
+
+    def turn_budget(self):
+        """The number of seconds on_turn may plan for this turn
+
+        Returns:
+            The limit after the margin and the worst recent overhead, never below 0
+
+        """
+        limit, overhead = self.__time_limit()
+        return max(0.0, limit * (1 - self.turn_time_margin) - overhead)
+
+    def set_fallback(self, plan):
+        """Sets what the watchdog submits if a turn overruns
+
+        Args:
+            plan: A GameState, whose planned builds and deploys are used, or a (build, deploy) pair of command lists
+
+        """
+        if isinstance(plan, GameState):
+            plan = (plan._build_stack, plan._deploy_stack)
+        builds, deploys = plan
+        self.fallback_plan = (list(builds), list(deploys))
+
+    def __start_watchdog(self):
+        """Guards the turn received at _turn_started, returns the timer or None if the watchdog is disabled
+        """
+        self.turn_overran = False
+        if not self.watchdog_enabled:
+            return None
+        timeout = self.watchdog_timeout
+        if timeout is None:
+            limit, overhead = self.__time_limit()
+            timeout = max(0.0, limit * 0.95 - overhead)
+        timeout = max(0.0, self._turn_started + timeout - time.monotonic())
+        with self._turn_lock:
+            self._turn_running = True
+            watchdog = threading.Timer(timeout, self.__submit_fallback, args=(open_turn(),))
+        watchdog.daemon = True
+        watchdog.start()
+        return watchdog
+
+    def __stop_watchdog(self, watchdog):
+        if watchdog is None:
+            return
+        watchdog.cancel()
+        with self._turn_lock:
+            self._turn_running = False
+            submitted = close_turn()
+        if not submitted:
+            debug_write("on_turn returned without submitting the turn, submitting the fallback plan")
+            self.__submit_fallback()
+
+    def __submit_fallback(self, turn=None):
+        builds, deploys = self.fallback_plan
+        if submit_commands(json.dumps(builds), json.dumps(deploys), turn):
+            if turn is not None:
+                self.turn_overran = True
+                debug_write("on_turn overran the watchdog deadline, submitted the fallback plan")
+
+    def __read_commands(self, messages):
+        """Puts every message from the engine on messages as (message, time received, answered), then None once stdin closes
+
+        A turn that arrives while on_turn is still running is answered with the fallback here, see AlgoCore.
+        """
+        while True:
+            try:
+                message = get_command()
+            except SystemExit:
+                messages.put(None)
+                return
+            received = time.monotonic()
+            answered = False
+            with self._turn_lock:
+                if self._turn_running and _is_turn(message):
+                    builds, deploys = self.fallback_plan
+                    answered = submit_commands(json.dumps(builds), json.dumps(deploys), open_turn())
+            if answered:
+                debug_write("A turn arrived while on_turn was still running, submitted the fallback plan")
+            messages.put((message, received, answered))
+
+    def anytime_turn(self, game_state, baseline_score=float("-inf")):
+        """Starts an AnytimeTurn for this turn, its deadline counts from when the turn was received
+
+        Args:
+            game_state: The GameState of this turn, holding the baseline plan
+            baseline_score: The score a step has to beat to replace the baseline plan
+
+        Returns:
+            An AnytimeTurn, add steps to it and call run() instead of submit_turn()
+
+        """
+        started = self._turn_started if self._turn_started is not None else time.monotonic()
+        return AnytimeTurn(game_state, started + self.turn_budget(), baseline_score)
+
+    def _record_turn_time(self, state):
+        """Learns the overhead of the previous turn from the time the engine reports for it
+        """
+        if self._last_turn_elapsed is None:
+            return
+        try:
+            reported = float(state["p1Stats"][3]) / 1000
+        except (KeyError, IndexError, TypeError, ValueError):
+            return
+        if reported > 0:
+            self.turn_overheads.append(reported - self._last_turn_elapsed)
+        self._last_turn_elapsed = None
 
     def on_game_start(self, config):
         """
@@ -31,8 +292,7 @@ class AlgoCore(object):
         algo_strategy.py inherits from AlgoCore and overrides this on turn function. 
         Adjusting the on_turn function in algo_strategy is the main way to adjust your algo's logic. 
         """
-        send_command("[]")
-        send_command("[]")
+        submit_commands("[]", "[]")
     
     def on_action_frame(self, action_frame_game_state):
         """
@@ -53,10 +313,16 @@ class AlgoCore(object):
         """
         debug_write(BANNER_TEXT)
 
+        # Note: Python blocks and hangs on stdin. Can cause issues if connections aren't setup properly and may need to
+        # manually kill this Python program.
+        messages = queue.Queue()
+        reader = threading.Thread(target=self.__read_commands, args=(messages,), daemon=True)
+        reader.start()
         while True:
-            # Note: Python blocks and hangs on stdin. Can cause issues if connections aren't setup properly and may need to
-            # manually kill this Python program.
-            game_state_string = get_command()
+            message = messages.get()
+            if message is None:
+                break
+            game_state_string, received, answered = message
             if "replaySave" in game_state_string:
                 """
                 This means this must be the config file. So, load in the config file as a json and add it to your AlgoStrategy class.
@@ -64,14 +330,25 @@ class AlgoCore(object):
                 parsed_config = json.loads(game_state_string)
                 self.on_game_start(parsed_config)
             elif "turnInfo" in game_state_string:
-                state = json.loads(game_state_string)
+                state = decode_json(game_state_string)
                 stateType = int(state.get("turnInfo")[0])
                 if stateType == 0:
                     """
                     This is the game turn game state message. Algo must now print to stdout 2 lines, one for build phase one for
                     deploy phase. Printing is handled by the provided functions.
                     """
-                    self.on_turn(game_state_string)
+                    self._record_turn_time(state)
+                    if answered:
+                        self.turn_overran = True
+                        continue
+                    self._turn_started = received
+                    watchdog = self.__start_watchdog()
+                    try:
+                        self.on_turn(game_state_string)
+                    finally:
+                        self.__stop_watchdog(watchdog)
+                    self._last_turn_elapsed = time.monotonic() - self._turn_started
+                    self._turn_started = None
                 elif stateType == 1:
                     """
                     If stateType == 1, this game_state_string string represents a single frame of an action phase
@@ -0,0 +1,300 @@
+import json
+from array import array
+
+from .unit import GameUnit
+from .ruleset import Ruleset
+from .util import debug_write
+from . import geometry
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+EMPTY = -1
+
+
+class CompactBoard:
+    """Array backed board for analysis that would otherwise pay for a GameUnit per unit
+
+    Structures are stored in parallel per-tile arrays indexed by x + y * 28, mobile units
+    in a side table of parallel arrays. board[x, y] returns GameUnits like GameMap does,
+    but they are only created for the tiles that are actually looked at. They are views:
+    change the board through add_unit, remove_unit, set_health and upgrade, not through them.
+
+    Aggregate queries such as total_health run directly over the arrays.
+    If numpy is installed, numpy_views returns arrays sharing memory with the board.
+
+    Attributes :
+        * config (JSON): Contains information about the current game rules
+        * ruleset (:obj: Ruleset): The rules compiled from config
+        * unit_type (array): Unit type index of the structure on every tile, -1 if there is none
+        * owner (array): Player index of the structure on every tile
+        * health (array): Health of the structure on every tile
+        * upgraded (bytearray): 1 where the structure on the tile is upgraded
+        * pending_removal (bytearray): 1 where the structure on the tile is marked for removal
+        * mobile_type (array): Unit type index of every mobile unit
+        * mobile_owner (array): Player index of every mobile unit
+        * mobile_health (array): Health of every mobile unit
+        * mobile_tile (array): Tile index of every mobile unit
+
+    """
+    def __init__(self, config):
+        """Creates an empty board
+
+        Args:
+            config (JSON): Contains information about the game
+
+        """
+        self.config = config
+        self.enable_warnings = True
+        self.ruleset = Ruleset.for_config(config)
+        self._shorthands = [type_config.get("shorthand") for type_config in config["unitInformation"]]
+        self._type_index = self.ruleset.UNIT_TYPE_TO_INDEX
+        self._is_structure = [self.ruleset.stats[shorthand, False].stationary for shorthand in self._shorthands]
+        self.unit_type = array('b', [EMPTY]) * geometry.NUM_TILES
+        self.owner = array('b', [EMPTY]) * geometry.NUM_TILES
+        self.health = array('d', [0.0]) * geometry.NUM_TILES
+        self.upgraded = bytearray(geometry.NUM_TILES)
+        self.pending_removal = bytearray(geometry.NUM_TILES)
+        self.mobile_type = array('b')
+        self.mobile_owner = array('b')
+        self.mobile_health = array('d')
+        self.mobile_tile = array('h')
+        self._views = {}
+
+    @classmethod
+    def from_serialized(cls, config, serialized_string):
+        """Builds a board straight from a turn or frame string, without creating any GameUnits
+
+        Args:
+            * config (JSON): A json object containing information about the game
+            * serialized_string (string): The game state string sent by the engine
+
+        """
+        board = cls(config)
+        state = json.loads(serialized_string)
+        board._load_units(state["p1Units"], 0)
+        board._load_units(state["p2Units"], 1)
+        return board
+
+    @classmethod
+    def from_game_map(cls, game_map):
+        """Builds a board holding the same units as a GameMap
+
+        Args:
+            * game_map: The GameMap to copy
+
+        """
+        board = cls(game_map.config)
+        for x, y in geometry.LOCATIONS:
+            for unit in game_map[x, y]:
+                board._store(board._type_index[unit.unit_type], unit.player_index, unit.health, x, y, unit.upgraded, unit.pending_removal)
+        return board
+
+    def _load_units(self, units, player_index):
+        """Stores the unit buckets of one player, in the format of p1Units and p2Units
+        """
+        remove_index = self._type_index[self.ruleset.REMOVE]
+        upgrade_index = self._type_index[self.ruleset.UPGRADE]
+        for type_index, bucket in enumerate(units):
+            for uinfo in bucket:
+                x, y = int(uinfo[0]), int(uinfo[1])
+                tile = x + y * geometry.ARENA_SIZE
+                # This depends on RM and UP always being the last types to be processed
+                if type_index == remove_index:
+                    if self.unit_type[tile] != EMPTY:
+                        self.pending_removal[tile] = 1
+                elif type_index == upgrade_index:
+                    if self.unit_type[tile] != EMPTY:
+                        self.upgraded[tile] = 1
+                else:
+                    self._store(type_index, player_index, float(uinfo[2]), x, y)
+
+    def _store(self, type_index, player_index, health, x, y, upgraded=False, pending_removal=False):
+        tile = x + y * geometry.ARENA_SIZE
+        if self._is_structure[type_index]:
+            self.unit_type[tile] = type_index
+            self.owner[tile] = player_index
+            self.health[tile] = health
+            self.upgraded[tile] = 1 if upgraded else 0
+            self.pending_removal[tile] = 1 if pending_removal else 0
+        else:
+            self.mobile_type.append(type_index)
+            self.mobile_owner.append(player_index)
+            self.mobile_health.append(health)
+            self.mobile_tile.append(tile)
+        self._views.pop(tile, None)
+
+    def __getitem__(self, location):
+        if len(location) == 2 and geometry.in_arena_bounds(location):
+            x, y = map(int, location)
+            tile = x + y * geometry.ARENA_SIZE
+            units = self._views.get(tile)
+            if units is None:
+                units = self._materialise(tile, x, y)
+                self._views[tile] = units
+            return units
+        self.warn("{} is out of bounds.".format(str(location)))
+
+    def __iter__(self):
+        for x, y in geometry.LOCATIONS:
+            yield [x, y]
+
+    def _materialise(self, tile, x, y):
+        """Creates the GameUnits standing on a tile
+        """
+        units = []
+        type_index = self.unit_type[tile]
+        if type_index != EMPTY:
+            unit = GameUnit(self._shorthands[type_index], self.config, self.owner[tile], self.health[tile], x, y)
+            if self.upgraded[tile]:
+                unit.upgrade()
+            unit.pending_removal = bool(self.pending_removal[tile])
+            units.append(unit)
+        for index, mobile_tile in enumerate(self.mobile_tile):
+            if mobile_tile == tile:
+                units.append(GameUnit(self._shorthands[self.mobile_type[index]], self.config, self.mobile_owner[index], self.mobile_health[index], x, y))
+        return units
+
+    def in_arena_bounds(self, location):
+        """Checks if the given location is inside the diamond shaped game board.
+        """
+        return geometry.in_arena_bounds(location)
+
+    def add_unit(self, unit_type, location, player_index=0):
+        """Add a single unit to the board at the given location, see GameMap.add_unit
+        """
+        if not geometry.in_arena_bounds(location):
+            self.warn("{} is out of bounds.".format(str(location)))
+            return
+        x, y = map(int, location)
+        type_index = self._type_index[unit_type]
+        if self._is_structure[type_index]:
+            self.remove_unit(location)
+        health = self.ruleset.stats[unit_type, False].max_health
+        self._store(type_index, player_index, health, x, y)
+
+    def remove_unit(self, location):
+        """Remove all units on the board at the given location, see GameMap.remove_unit
+        """
+        if not geometry.in_arena_bounds(location):
+            self.warn("{} is out of bounds.".format(str(location)))
+            return
+        x, y = map(int, location)
+        tile = x + y * geometry.ARENA_SIZE
+        self.unit_type[tile] = EMPTY
+        self.owner[tile] = EMPTY
+        self.health[tile] = 0.0
+        self.upgraded[tile] = 0
+        self.pending_removal[tile] = 0
+        if tile in self.mobile_tile:
+            keep = [index for index, mobile_tile in enumerate(self.mobile_tile) if mobile_tile != tile]
+            self.mobile_type = array('b', [self.mobile_type[index] for index in keep])
+            self.mobile_owner = array('b', [self.mobile_owner[index] for index in keep])
+            self.mobile_health = array('d', [self.mobile_health[index] for index in keep])
+            self.mobile_tile = array('h', [self.mobile_tile[index] for index in keep])
+        self._views.pop(tile, None)
+
+    def set_health(self, location, health):
+        """Sets the health of the structure at a location
+        """
+        x, y = map(int, location)
+        tile = x + y * geometry.ARENA_SIZE
+        if self.unit_type[tile] == EMPTY:
+            self.warn("No structure at {} to set the health of.".format(location))
+            return
+        self.health[tile] = health
+        self._views.pop(tile, None)
+
+    def upgrade(self, location):
+        """Marks the structure at a location as upgraded
+        """
+        x, y = map(int, location)
+        tile = x + y * geometry.ARENA_SIZE
+        if self.unit_type[tile] == EMPTY:
+            self.warn("No structure at {} to upgrade.".format(location))
+            return
+        self.upgraded[tile] = 1
+        self._views.pop(tile, None)
+
+    def _region_tiles(self, region, rows):
+        """Flat tile indices selected by a region of locations and/or a range of rows
+        """
+        if rows is not None:
+            tiles = [tile for y in rows if 0 <= y < geometry.ARENA_SIZE for tile in geometry.ROW_INDICES[y]]
+            if region is None:
+                return tiles
+            selected = {int(x) + int(y) * geometry.ARENA_SIZE for x, y in region}
+            return [tile for tile in tiles if tile in selected]
+        if region is not None:
+            return [int(x) + int(y) * geometry.ARENA_SIZE for x, y in region if geometry.in_arena_bounds((x, y))]
+        return range(geometry.NUM_TILES)
+
+    def _structure_tiles(self, player_index, unit_type, region, rows):
+        type_index = EMPTY if unit_type is None else self._type_index[unit_type]
+        unit_types = self.unit_type
+        owners = self.owner
+        for tile in self._region_tiles(region, rows):
+            tile_type = unit_types[tile]
+            if tile_type == EMPTY:
+                continue
+            if (type_index == EMPTY or tile_type == type_index) and (player_index is None or owners[tile] == player_index):
+                yield tile
+
+    def count_structures(self, player_index=None, unit_type=None, region=None, rows=None):
+        """Counts structures on the board
+
+        Args:
+            * player_index: The player whose structures we want, 0 for you 1 for the enemy. Both players if None.
+            * unit_type: The type of structure we want, WALL, TURRET, etc. All structure types if None.
+            * region: An iterable of locations to restrict the count to
+            * rows: An iterable of y coordinates to restrict the count to, for example range(14, 18)
+
+        Returns:
+            The number of matching structures
+
+        """
+        return sum(1 for _ in self._structure_tiles(player_index, unit_type, region, rows))
+
+    def total_health(self, player_index=None, unit_type=None, region=None, rows=None):
+        """Sums the health of structures on the board, see count_structures for the arguments
+
+        For example, the total health of enemy turrets in rows 14 to 17 is
+        board.total_health(1, TURRET, rows=range(14, 18))
+
+        """
+        health = self.health
+        return sum(health[tile] for tile in self._structure_tiles(player_index, unit_type, region, rows))
+
+    def get_structure_locations(self, player_index=None, unit_type=None, region=None, rows=None):
+        """Locations of structures on the board, see count_structures for the arguments
+        """
+        return [[tile % geometry.ARENA_SIZE, tile // geometry.ARENA_SIZE] for tile in self._structure_tiles(player_index, unit_type, region, rows)]
+
+    def numpy_views(self):
+        """Numpy arrays sharing memory with the per-tile arrays, for vectorised analysis
+
+        Returns:
+            A dict with 'unit_type', 'owner', 'health', 'upgraded' and 'pending_removal' arrays of
+            shape (28, 28) indexed [y, x], or None if numpy is not installed
+
+        """
+        if numpy is None:
+            self.warn("numpy_views requires numpy, which is not installed")
+            return None
+        shape = (geometry.ARENA_SIZE, geometry.ARENA_SIZE)
+        return {
+            'unit_type': numpy.frombuffer(self.unit_type, dtype=numpy.int8).reshape(shape),
+            'owner': numpy.frombuffer(self.owner, dtype=numpy.int8).reshape(shape),
+            'health': numpy.frombuffer(self.health, dtype=numpy.float64).reshape(shape),
+            'upgraded': numpy.frombuffer(self.upgraded, dtype=numpy.uint8).reshape(shape),
+            'pending_removal': numpy.frombuffer(self.pending_removal, dtype=numpy.uint8).reshape(shape),
+        }
+
+    def warn(self, message):
+        """
+        Used internally by CompactBoard to print out default messaging
+        """
+        if(self.enable_warnings):
+            debug_write(message)
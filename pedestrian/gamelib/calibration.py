@@ -0,0 +1,293 @@
+"""
+Checks the action phase simulator against the action phases recorded in .replay files.
+
+Every recorded turn is started from its first action frame, simulated, and compared frame by frame with the replay.
+Run it from the algo folder on replay files or folders of them::
+
+    python -m gamelib.calibration replays/ -j 4
+"""
+
+import os
+import sys
+import glob
+import argparse
+import traceback
+import multiprocessing
+from collections import Counter
+
+from .game_state import GameState
+from .simulator import ActionSimulator
+from .util import decode_json, debug_write
+
+RULES = ("pathing", "targeting", "shielding", "breaches", "final_health")
+
+
+def load_replay(path):
+    """Reads a replay file
+
+    Args:
+        path: The path of a .replay file
+
+    Returns:
+        The game config and a list of (line, frame) pairs, one for every frame in the file, where frame is the decoded line
+
+    """
+    config = None
+    frames = []
+    with open(path) as replay:
+        for line in replay:
+            line = line.strip()
+            if not line:
+                continue
+            data = decode_json(line)
+            if "debug" in data:
+                config = data
+            elif "turnInfo" in data:
+                frames.append((line, data))
+    return config, frames
+
+
+def recorded_turns(frames):
+    """Splits the frames of a replay into the action phases of each turn
+
+    Args:
+        frames: The frames returned by load_replay
+
+    Returns:
+        A list of (turn_number, action_frames) pairs, action_frames being the (line, frame) pairs of that turn in order
+
+    """
+    turns = {}
+    for line, data in frames:
+        phase, turn_number, frame_number = data["turnInfo"][:3]
+        if phase == 1:
+            turns.setdefault(turn_number, []).append((frame_number, line, data))
+    return [(turn_number, [(line, data) for _, line, data in sorted(action_frames, key=lambda frame: frame[0])])
+        for turn_number, action_frames in sorted(turns.items())]
+
+
+def replay_snapshot(frame, ruleset):
+    """The mobile units and structures of a recorded frame, see simulated_snapshot
+    """
+    mobiles = Counter()
+    healths = {}
+    structures = {}
+    unit_types = [type_config.get("shorthand") for type_config in ruleset.config["unitInformation"]]
+    for key, player_index in (("p1Units", 0), ("p2Units", 1)):
+        for type_index, bucket in enumerate(frame[key]):
+            unit_type = unit_types[type_index]
+            if unit_type in (ruleset.REMOVE, ruleset.UPGRADE):
+                continue
+            for unit_info in bucket:
+                x, y, health = int(unit_info[0]), int(unit_info[1]), float(unit_info[2])
+                if ruleset.is_stationary(unit_type):
+                    structures[x, y] = (player_index, unit_type, health)
+                else:
+                    mobiles[player_index, unit_type, x, y] += 1
+                    healths.setdefault((player_index, unit_type, x, y), []).append(health)
+    return mobiles, {key: sorted(values) for key, values in healths.items()}, structures
+
+
+def simulated_snapshot(mobile_units, structures):
+    """The units of a simulated frame in a form that can be compared with a recorded one
+
+    Returns:
+        A Counter of the mobile units per (player_index, unit_type, x, y),
+        their sorted healths per (player_index, unit_type, x, y),
+        and a dict mapping the (x, y) of every structure to its (player_index, unit_type, health)
+
+    """
+    mobiles = Counter()
+    healths = {}
+    for unit in mobile_units:
+        key = (unit.player_index, unit.unit_type, unit.x, unit.y)
+        mobiles[key] += 1
+        healths.setdefault(key, []).append(unit.health)
+    return mobiles, {key: sorted(values) for key, values in healths.items()}, {(unit.x, unit.y): (unit.player_index, unit.unit_type, unit.health) for unit in structures}
+
+
+def _healths_differ(first, second, tolerance):
+    return len(first) != len(second) or any(abs(a - b) > tolerance for a, b in zip(first, second))
+
+
+class TurnReport:
+    """How a simulated turn compared with the recorded one
+
+    Attributes :
+        * turn_number (int): The turn of the replay
+        * frames (int): The number of frames compared
+        * mismatches (dict): Maps every rule in RULES to the number of frames it diverged on
+        * first_divergence (dict): Maps a rule to the first frame it diverged on, rules that never diverged are missing
+        * breaches (tuple): The number of (recorded, simulated) breaches
+        * final_health (tuple): The (recorded, simulated) [player 1, player 2] health at the end of the turn
+
+    """
+    def __init__(self, turn_number):
+        self.turn_number = turn_number
+        self.frames = 0
+        self.mismatches = dict.fromkeys(RULES, 0)
+        self.first_divergence = {}
+        self.breaches = (0, 0)
+        self.final_health = None
+
+    def _diverged(self, rule, frame):
+        self.mismatches[rule] += 1
+        self.first_divergence.setdefault(rule, frame)
+
+
+def calibrate_turn(config, action_frames, tolerance=0.01):
+    """Simulates a recorded turn from its first action frame and compares every following frame
+
+    Simulated frame i is compared with recorded action frame i + 1. A frame counts as a pathing mismatch
+    if the mobile units stand on different tiles, a shielding mismatch if units on the same tiles have
+    different health on a frame with shield events, a targeting mismatch for other health or structure
+    differences, and a breach mismatch if a different number of units breached.
+
+    Args:
+        config: The game config of the replay
+        action_frames: The action frames of one turn, see recorded_turns
+        tolerance: The largest health difference that still counts as equal
+
+    Returns:
+        A TurnReport
+
+    """
+    start_line, start = action_frames[0]
+    report = TurnReport(start["turnInfo"][1])
+    game_state = GameState(config, start_line)
+    game_state.suppress_warnings(True)
+    ruleset = game_state.ruleset
+    simulated = []
+    result = ActionSimulator(game_state).simulate(max_frames=len(action_frames) - 1,
+        on_frame=lambda frame, mobiles, structures: simulated.append(simulated_snapshot(mobiles, structures)))
+    simulated_breaches = Counter(frame for frame, _, _, _ in result.breaches)
+    ended = simulated_snapshot(result.survivors, result.structures)
+
+    recorded_breaches = 0
+    for index, (_, frame) in enumerate(action_frames[1:]):
+        report.frames += 1
+        mobiles, healths, structures = replay_snapshot(frame, ruleset)
+        sim_mobiles, sim_healths, sim_structures = simulated[index] if index < len(simulated) else ended
+        events = frame.get("events", {})
+        breaches = len(events.get("breach", []))
+        recorded_breaches += breaches
+
+        if mobiles != sim_mobiles:
+            report._diverged("pathing", index)
+        health_rule = "shielding" if events.get("shield") else "targeting"
+        if any(_healths_differ(values, sim_healths[key], tolerance) for key, values in healths.items() if key in sim_healths):
+            report._diverged(health_rule, index)
+        elif structures.keys() != sim_structures.keys() or any(abs(structures[key][2] - sim_structures[key][2]) > tolerance for key in structures):
+            report._diverged("targeting", index)
+        if breaches != simulated_breaches.get(index, 0):
+            report._diverged("breaches", index)
+
+    last = action_frames[-1][1]
+    recorded_health = [float(last["p1Stats"][0]), float(last["p2Stats"][0])]
+    report.breaches = (recorded_breaches, len(result.breaches))
+    report.final_health = (recorded_health, result.player_health)
+    if any(abs(a - b) > tolerance for a, b in zip(recorded_health, result.player_health)):
+        report._diverged("final_health", report.frames)
+    return report
+
+
+def calibrate_replay(path):
+    """Calibrates every turn of a replay file
+
+    Turns that cannot be simulated or compared, for example because of a malformed frame, are logged and left out.
+
+    Args:
+        path: The path of a .replay file
+
+    Returns:
+        A list of TurnReports, empty if the file could not be read
+
+    """
+    try:
+        config, frames = load_replay(path)
+    except (OSError, ValueError) as error:
+        debug_write("Could not read replay {}: {}".format(path, error))
+        return []
+    if config is None:
+        debug_write("Replay {} has no config".format(path))
+        return []
+    reports = []
+    for turn_number, action_frames in recorded_turns(frames):
+        if len(action_frames) < 2:
+            continue
+        try:
+            reports.append(calibrate_turn(config, action_frames))
+        except Exception:
+            debug_write("Could not calibrate turn {} of {}:\n{}".format(turn_number, path, traceback.format_exc()))
+    return reports
+
+
+def replay_files(paths):
+    """The .replay files of a list of files and folders, folders are searched without recursion
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, "*.replay"))))
+        else:
+            files.append(path)
+    return files
+
+
+def calibrate_replays(paths, processes=None):
+    """Calibrates many replays, in parallel when processes is not 1
+
+    Args:
+        paths: Replay files or folders of them
+        processes: The number of worker processes, the number of CPUs if None
+
+    Returns:
+        A dict mapping every replay file to its list of TurnReports
+
+    """
+    files = replay_files(paths)
+    if processes == 1 or len(files) < 2:
+        return {path: calibrate_replay(path) for path in files}
+    with multiprocessing.Pool(processes) as pool:
+        return dict(zip(files, pool.map(calibrate_replay, files)))
+
+
+def summarize(reports):
+    """Mismatch rates per rule over many turns
+
+    Args:
+        reports: TurnReports, or the dict calibrate_replays returns
+
+    Returns:
+        A dict with the number of turns and frames compared, and for every rule in RULES
+        the share of frames it diverged on. final_health is the share of turns ending on different health.
+
+    """
+    if isinstance(reports, dict):
+        reports = [report for turn_reports in reports.values() for report in turn_reports]
+    turns = len(reports)
+    frames = sum(report.frames for report in reports)
+    summary = {"turns": turns, "frames": frames}
+    for rule in RULES:
+        mismatches = sum(report.mismatches[rule] for report in reports)
+        total = turns if rule == "final_health" else frames
+        summary[rule] = mismatches / total if total else 0.0
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the action phase simulator with recorded replays")
+    parser.add_argument("paths", nargs="*", default=["replays"], help="Replay files or folders of them")
+    parser.add_argument("-j", "--processes", type=int, default=None, help="Number of worker processes, all CPUs by default")
+    args = parser.parse_args(argv)
+
+    results = calibrate_replays(args.paths, args.processes)
+    summary = summarize(results)
+    sys.stdout.write("{} replays, {} turns, {} frames\n".format(len(results), summary["turns"], summary["frames"]))
+    for rule in RULES:
+        sys.stdout.write("{:>14} : {:.1%} mismatched\n".format(rule, summary[rule]))
+    return summary
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""
+Per-tile totals of what each player's structures project onto the board, the damage of turrets and the shields of supports.
+GameMap keeps a CoverageMap up to date as structures are added, removed and upgraded,
+so questions like "how many turrets can hit this tile" are lookups instead of range scans.
+"""
+
+from . import geometry
+
+ARENA_SIZE = geometry.ARENA_SIZE
+NUM_TILES = geometry.NUM_TILES
+
+_footprints = {}
+_ranks = {}
+
+
+def footprint(x, y, radius, hit_radius):
+    """The flat indices of the tiles whose center is within radius of (x, y), the same tiles get_attackers would check
+
+    Footprints are cached per (x, y, radius, hit_radius), do not modify them.
+    """
+    key = (x, y, radius, hit_radius)
+    tiles = _footprints.get(key)
+    if tiles is None:
+        tiles = tuple(nx + ny * ARENA_SIZE for nx, ny, distance in geometry.tiles_in_range((x, y), radius, hit_radius) if distance <= radius)
+        _footprints[key] = tiles
+    return tiles
+
+
+def stencil_rank(radius, hit_radius):
+    """Maps every (dx, dy) offset of a range stencil to its position in the stencil, nearest first
+    """
+    key = (radius, hit_radius)
+    ranks = _ranks.get(key)
+    if ranks is None:
+        ranks = {(dx, dy): rank for rank, (dx, dy, _) in enumerate(geometry.range_stencil(radius, hit_radius))}
+        _ranks[key] = ranks
+    return ranks
+
+
+class CoverageMap:
+    """Attack and shield coverage of the structures of both players
+
+    Grids are lists indexed by x + y * 28 and by the player that owns the structures.
+
+    Attributes :
+        * hit_radius (float): The getHitRadius from the game config
+        * attacker_count (tuple): For each owner, the number of their structures that can attack each tile
+        * damage (tuple): For each owner, the damage per frame their structures deal to a mobile unit on each tile
+        * attackers (tuple): For each owner, a bitboard per tile of the tiles holding structures that can attack it
+        * shield (tuple): For each owner, the shield their supports give to a mobile unit entering each tile
+        * shielders (tuple): For each owner, a bitboard per tile of the tiles holding supports that reach it
+
+    """
+    def __init__(self, hit_radius):
+        self.hit_radius = hit_radius
+        self.attacker_count = ([0] * NUM_TILES, [0] * NUM_TILES)
+        self.damage = ([0.0] * NUM_TILES, [0.0] * NUM_TILES)
+        self.attackers = ([0] * NUM_TILES, [0] * NUM_TILES)
+        self._sources = {}
+        self.shield = ([0.0] * NUM_TILES, [0.0] * NUM_TILES)
+        self.shielders = ([0] * NUM_TILES, [0] * NUM_TILES)
+        self._shield_sources = {}
+
+    @staticmethod
+    def shield_amount(unit, y):
+        """The shield a support at row y gives, shieldPerUnit plus shieldBonusPerY for every row it is from its owner's edge
+        """
+        rows = y if unit.player_index == 0 else ARENA_SIZE - 1 - y
+        return unit.shieldPerUnit + unit.shieldBonusPerY * rows
+
+    def add(self, unit, x, y):
+        """Adds the coverage of a structure standing at (x, y)
+        """
+        owner = unit.player_index
+        if owner not in (0, 1):
+            return
+        source = x + y * ARENA_SIZE
+        if unit.shieldRange > 0:
+            amount = self.shield_amount(unit, y)
+            if amount > 0:
+                self.__add_shield(unit, owner, source, footprint(x, y, unit.shieldRange, self.hit_radius), amount)
+        if unit.damage_i + unit.damage_f <= 0:
+            return
+        tiles = footprint(x, y, unit.attackRange, self.hit_radius)
+        damage = unit.damage_i
+        self._sources[source] = (unit, owner, tiles, damage)
+        bit = 1 << source
+        counts = self.attacker_count[owner]
+        damages = self.damage[owner]
+        attackers = self.attackers[owner]
+        for tile in tiles:
+            counts[tile] += 1
+            damages[tile] += damage
+            attackers[tile] |= bit
+
+    def __add_shield(self, unit, owner, source, tiles, amount):
+        self._shield_sources[source] = (unit, owner, tiles, amount)
+        bit = 1 << source
+        shield = self.shield[owner]
+        shielders = self.shielders[owner]
+        for tile in tiles:
+            shield[tile] += amount
+            shielders[tile] |= bit
+
+    def __remove_shield(self, unit, source):
+        entry = self._shield_sources.get(source)
+        if entry is None or entry[0] is not unit:
+            return
+        del self._shield_sources[source]
+        _, owner, tiles, amount = entry
+        mask = ~(1 << source)
+        shield = self.shield[owner]
+        shielders = self.shielders[owner]
+        for tile in tiles:
+            shield[tile] -= amount
+            shielders[tile] &= mask
+
+    def remove(self, unit, x, y):
+        """Removes the coverage of a structure standing at (x, y), as it was when it was added
+        """
+        source = x + y * ARENA_SIZE
+        self.__remove_shield(unit, source)
+        entry = self._sources.get(source)
+        if entry is None or entry[0] is not unit:
+            return
+        del self._sources[source]
+        _, owner, tiles, damage = entry
+        mask = ~(1 << source)
+        counts = self.attacker_count[owner]
+        damages = self.damage[owner]
+        attackers = self.attackers[owner]
+        for tile in tiles:
+            counts[tile] -= 1
+            damages[tile] -= damage
+            attackers[tile] &= mask
+
+    def refresh(self, unit, x, y):
+        """Recomputes the coverage of a structure after its stats changed, for example after an upgrade
+        """
+        self.remove(unit, x, y)
+        self.add(unit, x, y)
+
+    def structures_attacking(self, location, player_index, max_range):
+        """The structures that can attack a unit of player_index at location, in the order get_attackers scans them
+
+        Args:
+            location: The location of a hypothetical defender
+            player_index: The player controlling the defender
+            max_range: The radius get_attackers scans
+
+        """
+        x, y = location
+        bits = self.attackers[1 - player_index][x + y * ARENA_SIZE]
+        sources = []
+        while bits:
+            low = bits & -bits
+            sources.append(low.bit_length() - 1)
+            bits ^= low
+        if len(sources) > 1:
+            ranks = stencil_rank(max_range, self.hit_radius)
+            sources.sort(key=lambda source: ranks[source % ARENA_SIZE - x, source // ARENA_SIZE - y])
+        return [self._sources[source][0] for source in sources]
+
+    def path_shield(self, path, player_index):
+        """The total shield a mobile unit of player_index picks up walking a path
+
+        A support shields a unit once, however many tiles of the path it reaches.
+
+        Args:
+            path: A list of locations
+            player_index: The player controlling the mobile unit
+
+        """
+        shielders = self.shielders[player_index]
+        bits = 0
+        for x, y in path:
+            bits |= shielders[x + y * ARENA_SIZE]
+        total = 0
+        sources = self._shield_sources
+        while bits:
+            low = bits & -bits
+            total += sources[low.bit_length() - 1][3]
+            bits ^= low
+        return total
@@ -1,6 +1,13 @@
 import math
 from .unit import GameUnit
+from .ruleset import Ruleset
+from .coverage import CoverageMap
+from .transposition import zobrist_key
 from .util import debug_write
+from . import geometry
+
+
+ARENA_LOCATIONS = geometry.LOCATIONS
 
 class GameMap:
     """Holds data about the current game map and provides functions
@@ -9,8 +16,26 @@ class GameMap:
     game_map[x, y] will return a list of Units located at that location, 
     or an empty list if there are no units at the location
 
+    Iterating over a GameMap yields every in-arena location as an [x, y] list. 
+    Each loop gets its own iterator, so loops over the same map can be nested.
+
+    Structures are also indexed by player and unit type, see get_structures and count_structures, 
+    and kept in bitboards, see structure_mask. Their attack and shield coverage is kept per tile, see get_attacker_count, 
+    get_damage_per_frame and get_path_shield.
+    The layout also has an incrementally updated Zobrist hash, see zobrist_hash.
+    The index follows add_unit, remove_unit and game_map[x, y] = units, but not changes made 
+    directly to the list returned by game_map[x, y]. Upgrade structures with upgrade_unit or GameUnit.upgrade, which both update 
+    the index, and do not change the stats of a structure on the map any other way.
+
+    While a GameState savepoint is active, add_unit, remove_unit and game_map[x, y] = units record the tiles they 
+    replace in an undo journal, see GameState.savepoint.
+
+    A GameState parsed in lazy mode hands the map its unit buckets unbuilt. get_structures, count_structures 
+    and structure_mask only build the buckets they are asked about, anything else builds them all first.
+
     Attributes :
         * config (JSON): Contains information about the current game rules
+        * ruleset (:obj: Ruleset): The rules compiled from config
         * enable_warnings (bool): If true, debug messages for game_map functions will print out
         * ARENA_SIZE (int): The size of the arena.
         * HALF_ARENA (int): Half of the size of the arena.
@@ -29,51 +54,60 @@ class GameMap:
         """
         self.config = config
         self.enable_warnings = True
-        self.ARENA_SIZE = 28
-        self.HALF_ARENA = int(self.ARENA_SIZE / 2)
-        self.TOP_RIGHT = 0
-        self.TOP_LEFT = 1
-        self.BOTTOM_LEFT = 2
-        self.BOTTOM_RIGHT = 3
+        self.ARENA_SIZE = geometry.ARENA_SIZE
+        self.HALF_ARENA = geometry.HALF_ARENA
+        self.TOP_RIGHT = geometry.TOP_RIGHT
+        self.TOP_LEFT = geometry.TOP_LEFT
+        self.BOTTOM_LEFT = geometry.BOTTOM_LEFT
+        self.BOTTOM_RIGHT = geometry.BOTTOM_RIGHT
+        self.ruleset = Ruleset.for_config(config)
         self.__map = self.__empty_grid()
-        self.__start = [13,0]
+        self.__hit_radius = self.ruleset.hit_radius
+        for radius in self.ruleset.ranges:
+            geometry.range_stencil(radius, self.__hit_radius)
+        self.__structures = {0: {}, 1: {}}
+        self.__masks = {}
+        self.__player_masks = [0, 0]
+        self._layout_version = 0
+        self.__deferred = {}
+        self._on_structures_loaded = None
+        self.__mobile_masks = [0, 0]
+        self._coverage = CoverageMap(self.__hit_radius)
+        self._journal = None
+        self.__zobrist = 0
+        self.__zobrist_keys = {}
     
     def __getitem__(self, location):
+        if self.__deferred:
+            self._materialise()
         if len(location) == 2 and self.in_arena_bounds(location):
             x,y = location
             return self.__map[x][y]
         self._invalid_coordinates(location)
 
     def __setitem__(self, location, val):
+        if self.__deferred:
+            self._materialise()
         if type(location) == tuple and len(location) == 2 and self.in_arena_bounds(location):
-            self.__map[location[0]][location[1]] = val
+            x, y = location
+            self._record_tile(x, y)
+            self.__clear_tile(x, y)
+            self.__map[x][y] = val
+            for unit in val:
+                if unit.stationary:
+                    unit._game_map = self
+                    self.__index_unit(unit, x, y)
+                else:
+                    self.__add_mobile(unit, x, y)
             return
         self._invalid_coordinates(location)
 
     def __iter__(self):
-        self.__start = [13,0]
-        return self
-    
-    def __next__(self):
-        location = self.__start
-        if location == [15,27]:
-            raise StopIteration
-        new_location = [location[0]+1, location[1]]
-        while not self.in_arena_bounds(new_location) and not location == [14,27]:
-            if new_location[0] == self.ARENA_SIZE:
-                new_location = [0, new_location[1]+1]
-            else:
-                new_location = [new_location[0]+1, new_location[1]]
-        self.__start = new_location
-        return location 
+        for x, y in ARENA_LOCATIONS:
+            yield [x, y]
 
     def __empty_grid(self):
-        grid = []
-        for x in range(0, self.ARENA_SIZE):
-            grid.append([])
-            for _ in range(0, self.ARENA_SIZE):
-                grid[x].append([])
-        return grid
+        return [[[] for _ in range(self.ARENA_SIZE)] for _ in range(self.ARENA_SIZE)]
 
     def _invalid_coordinates(self, location):
         self.warn("{} is out of bounds.".format(str(location)))
@@ -88,20 +122,7 @@ class GameMap:
             True if the location is on the board, False otherwise
         
         """
-        x, y = location
-        half_board = self.HALF_ARENA
-
-        row_size = y + 1
-        startx = half_board - row_size
-        endx = startx + (2 * row_size) - 1
-        top_half_check = (y < self.HALF_ARENA and x >= startx and x <= endx)
-
-        row_size = (self.ARENA_SIZE - 1 - y) + 1
-        startx = half_board - row_size
-        endx = startx + (2 * row_size) - 1
-        bottom_half_check = (y >= self.HALF_ARENA and x >= startx and x <= endx)
-
-        return bottom_half_check or top_half_check
+        return geometry.in_arena_bounds(location)
 
     def get_edge_locations(self, quadrant_description):
         """Takes in an edge description and returns a list of locations.
@@ -117,8 +138,7 @@ class GameMap:
             self.warn("Passed invalid quadrant_description '{}'. See the documentation for valid inputs for get_edge_locations.".format(quadrant_description))
             return
 
-        edges = self.get_edges()
-        return edges[quadrant_description]
+        return [[x, y] for x, y in geometry.EDGES[quadrant_description]]
 
     def get_edges(self):
         """Gets all of the edges and their edge locations
@@ -127,27 +147,7 @@ class GameMap:
             A list with four lists inside of it of locations corresponding to the four edges.
             [0] = top_right, [1] = top_left, [2] = bottom_left, [3] = bottom_right.
         """
-        top_right = []
-        for num in range(0, self.HALF_ARENA):
-            x = self.HALF_ARENA + num
-            y = self.ARENA_SIZE - 1 - num
-            top_right.append([int(x), int(y)])
-        top_left = []
-        for num in range(0, self.HALF_ARENA):
-            x = self.HALF_ARENA - 1 - num
-            y = self.ARENA_SIZE - 1 - num
-            top_left.append([int(x), int(y)])
-        bottom_left = []
-        for num in range(0, self.HALF_ARENA):
-            x = self.HALF_ARENA - 1 - num
-            y = num
-            bottom_left.append([int(x), int(y)])
-        bottom_right = []
-        for num in range(0, self.HALF_ARENA):
-            x = self.HALF_ARENA + num
-            y = num
-            bottom_right.append([int(x), int(y)])
-        return [top_right, top_left, bottom_left, bottom_right]
+        return [[[x, y] for x, y in edge] for edge in geometry.EDGES]
     
     def add_unit(self, unit_type, location, player_index=0):
         """Add a single GameUnit to the map at the given location.
@@ -161,17 +161,19 @@ class GameMap:
         is to allow you to create arbitrary gamestates. Using this function on the game_map provided with game_state will 
         desynchronize it from the actual gamestate, and can cause issues. 
         """
+        if self.__deferred:
+            self._materialise()
         if not self.in_arena_bounds(location):
             self._invalid_coordinates(location)
         if player_index < 0 or player_index > 1:
             self.warn("Player index {} is invalid. Player index should be 0 or 1.".format(player_index))
 
         x, y = location
+        self._record_tile(x, y)
         new_unit = GameUnit(unit_type, self.config, player_index, None, location[0], location[1])
-        if not new_unit.stationary:
-            self.__map[x][y].append(new_unit)
-        else:
-            self.__map[x][y] = [new_unit]
+        if new_unit.stationary:
+            self.__clear_tile(x, y)
+        self._place_unit(new_unit)
 
     def remove_unit(self, location):
         """Remove all units on the map in the given location.
@@ -182,12 +184,363 @@ class GameMap:
         This function does not affect your turn and only changes the data stored in GameMap. The intended use of this function
         is to allow you to create arbitrary gamestates. Using this function on the GameMap inside game_state can cause your algo to crash.
         """
+        if self.__deferred:
+            self._materialise()
         if not self.in_arena_bounds(location):
             self._invalid_coordinates(location)
         
         x, y = location
+        self._record_tile(x, y)
+        self.__clear_tile(x, y)
+
+    def _defer_units(self, player_index, unit_type, stationary, loader):
+        """Registers a bucket of units that loader() will place on the map the first time they are needed.
+        Used internally by GameState in lazy mode.
+        """
+        self.__deferred[player_index, unit_type, stationary] = loader
+
+    def _materialise(self, player_index=None, unit_type=None, structures_only=False):
+        """Places the deferred unit buckets matching the filters on the map
+        """
+        for key in list(self.__deferred):
+            player, bucket_type, stationary = key
+            if player_index is not None and player != player_index:
+                continue
+            if unit_type is not None and bucket_type != unit_type:
+                continue
+            if structures_only and not stationary:
+                continue
+            loader = self.__deferred.pop(key, None)
+            if loader is not None:
+                loader()
+        if self._on_structures_loaded is not None and not any(key[2] for key in self.__deferred):
+            callback = self._on_structures_loaded
+            self._on_structures_loaded = None
+            callback()
+
+    def _place_unit(self, unit):
+        """Appends an existing GameUnit to the tile at its location and indexes it if it is a structure.
+        Used internally by add_unit and when GameState parses the turn.
+        """
+        self.__map[unit.x][unit.y].append(unit)
+        if unit.stationary:
+            unit._game_map = self
+            self.__index_unit(unit, unit.x, unit.y)
+        else:
+            self.__add_mobile(unit, unit.x, unit.y)
+
+    def upgrade_unit(self, location):
+        """Upgrades the structure at the given location, updating its coverage, the layout hash and the savepoint journal
+
+        Args:
+            location: The location of the structure
+
+        Returns:
+            The upgraded GameUnit, or None if there is no structure at the location
+
+        """
+        if self.__deferred:
+            self._materialise()
+        if not self.in_arena_bounds(location):
+            self._invalid_coordinates(location)
+            return None
+        x, y = map(int, location)
+        for unit in self.__map[x][y]:
+            if unit.stationary:
+                self._upgrade(unit)
+                return unit
+        self.warn("No structure at {} to upgrade.".format(location))
+        return None
+
+    def _upgrade(self, unit):
+        """Switches a structure standing on this map to its upgraded stats.
+        Used internally by upgrade_unit and GameUnit.upgrade.
+        """
+        if unit.upgraded:
+            return
+        self._record_unit(unit)
+        unit._stats = self.ruleset.stats[unit.unit_type, True]
+        self._refresh_unit(unit)
+
+    def _refresh_unit(self, unit):
+        """Updates the coverage and hash of a structure on the map after its stats changed.
+        Used internally by _upgrade and when a savepoint is rolled back.
+        """
+        if unit.stationary:
+            self._coverage.refresh(unit, unit.x, unit.y)
+            index_key = (unit.player_index, unit.unit_type, unit.x, unit.y)
+            if index_key in self.__zobrist_keys:
+                self.__zobrist ^= self.__zobrist_keys[index_key]
+                self.__zobrist_keys[index_key] = zobrist_key(unit.x + unit.y * self.ARENA_SIZE, unit.unit_type, unit.player_index, unit.upgraded)
+                self.__zobrist ^= self.__zobrist_keys[index_key]
+
+    def _record_tile(self, x, y):
+        """Journals the units of a tile before it changes, if a savepoint is active
+        """
+        if self._journal is not None and geometry.in_arena_bounds((x, y)):
+            self._journal.append((self.__restore_tile, x, y, list(self.__map[x][y])))
+
+    def _record_unit(self, unit):
+        """Journals the stats of a unit before it is upgraded, if a savepoint is active
+        """
+        if self._journal is not None:
+            self._journal.append((self.__restore_unit, unit, unit._stats))
+
+    def __restore_tile(self, x, y, units):
+        self.__clear_tile(x, y)
+        for unit in units:
+            self._place_unit(unit)
+
+    def __restore_unit(self, unit, stats):
+        unit._stats = stats
+        self._refresh_unit(unit)
+
+    def _tile_units(self, x, y):
+        """The unit list of an in-arena tile, without the bounds check or lazy loading of game_map[x, y].
+        Used internally by the targeting engine.
+        """
+        return self.__map[x][y]
+
+    def __add_mobile(self, unit, x, y):
+        if unit.player_index in (0, 1):
+            self.__mobile_masks[unit.player_index] |= 1 << (x + y * self.ARENA_SIZE)
+
+    def __clear_tile(self, x, y):
+        self.__unindex_tile(x, y)
+        for unit in self.__map[x][y]:
+            if unit.stationary:
+                if unit._game_map is self:
+                    unit._game_map = None
+            elif unit.player_index in (0, 1):
+                self.__mobile_masks[unit.player_index] &= ~(1 << (x + y * self.ARENA_SIZE))
         self.__map[x][y] = []
 
+    def __index_unit(self, unit, x, y):
+        self.__structures.setdefault(unit.player_index, {}).setdefault(unit.unit_type, {})[x, y] = unit
+        bit = 1 << (x + y * self.ARENA_SIZE)
+        key = (unit.player_index, unit.unit_type)
+        self.__masks[key] = self.__masks.get(key, 0) | bit
+        if unit.player_index in (0, 1):
+            self.__player_masks[unit.player_index] |= bit
+        index_key = (unit.player_index, unit.unit_type, x, y)
+        self.__zobrist ^= self.__zobrist_keys.get(index_key, 0)
+        self.__zobrist_keys[index_key] = zobrist_key(x + y * self.ARENA_SIZE, unit.unit_type, unit.player_index, unit.upgraded)
+        self.__zobrist ^= self.__zobrist_keys[index_key]
+        self._coverage.add(unit, x, y)
+        self._layout_version += 1
+
+    def __unindex_tile(self, x, y):
+        for unit in self.__map[x][y]:
+            if unit.stationary:
+                by_type = self.__structures.get(unit.player_index, {}).get(unit.unit_type, {})
+                if by_type.get((x, y)) is unit:
+                    del by_type[x, y]
+                    bit = 1 << (x + y * self.ARENA_SIZE)
+                    key = (unit.player_index, unit.unit_type)
+                    self.__masks[key] &= ~bit
+                    if unit.player_index in (0, 1):
+                        self.__player_masks[unit.player_index] &= ~bit
+                    self.__zobrist ^= self.__zobrist_keys.pop((unit.player_index, unit.unit_type, x, y), 0)
+                    self._coverage.remove(unit, x, y)
+                    self._layout_version += 1
+
+    def get_structures(self, player_index=None, unit_type=None):
+        """Gets structures from the structure index without scanning the board
+
+        Args:
+            player_index: The player whose structures we want, 0 for you 1 for the enemy. Both players if None.
+            unit_type: The type of structure we want, WALL, TURRET, etc. All structure types if None.
+
+        Returns:
+            A list of the matching structure GameUnits
+
+        """
+        if self.__deferred:
+            self._materialise(player_index, unit_type, True)
+        structures = []
+        for player, by_type in self.__structures.items():
+            if player_index is not None and player != player_index:
+                continue
+            for structure_type, units in by_type.items():
+                if unit_type is None or structure_type == unit_type:
+                    structures.extend(units.values())
+        return structures
+
+    def count_structures(self, player_index=None, unit_type=None):
+        """Counts structures using the structure index without scanning the board
+
+        Args:
+            player_index: The player whose structures we want, 0 for you 1 for the enemy. Both players if None.
+            unit_type: The type of structure we want, WALL, TURRET, etc. All structure types if None.
+
+        Returns:
+            The number of matching structures
+
+        """
+        if self.__deferred:
+            self._materialise(player_index, unit_type, True)
+        count = 0
+        for player, by_type in self.__structures.items():
+            if player_index is not None and player != player_index:
+                continue
+            for structure_type, units in by_type.items():
+                if unit_type is None or structure_type == unit_type:
+                    count += len(units)
+        return count
+
+    def structure_mask(self, player_index=None, unit_type=None):
+        """Gets a bitboard of the tiles holding structures, see geometry.py for the region masks to combine it with
+
+        For example, the number of enemy structures in row 14 is
+        geometry.popcount(game_map.structure_mask(1) & geometry.ROW_MASKS[14])
+
+        Args:
+            player_index: The player whose structures we want, 0 for you 1 for the enemy. Both players if None.
+            unit_type: The type of structure we want, WALL, TURRET, etc. All structure types if None.
+
+        Returns:
+            An int with bit x + y * 28 set for every matching structure
+
+        """
+        if self.__deferred:
+            self._materialise(player_index, unit_type, True)
+        if unit_type is None:
+            if player_index is None:
+                return self.__player_masks[0] | self.__player_masks[1]
+            return self.__player_masks[player_index]
+        if player_index is None:
+            return self.__masks.get((0, unit_type), 0) | self.__masks.get((1, unit_type), 0)
+        return self.__masks.get((player_index, unit_type), 0)
+
+    def zobrist_hash(self):
+        """A 64 bit hash of the structure layout, updated as structures are added, removed or upgraded through the map, 
+        see upgrade_unit
+
+        Two maps with the same structures, owners and upgrades on the same tiles have the same hash, 
+        in any process. Health, removal marks and mobile units are not part of it. Use it to key 
+        analyses of a layout, see TranspositionCache.
+
+        Returns:
+            The xor of the zobrist_key of every structure
+
+        """
+        if self.__deferred:
+            self._materialise(structures_only=True)
+        return self.__zobrist
+
+    def mobile_mask(self, player_index=None):
+        """Gets a bitboard of the tiles holding mobile units, like structure_mask does for structures
+
+        Args:
+            player_index: The player whose mobile units we want, 0 for you 1 for the enemy. Both players if None.
+
+        Returns:
+            An int with bit x + y * 28 set for every tile with a matching mobile unit
+
+        """
+        if self.__deferred:
+            self._materialise()
+        if player_index is None:
+            return self.__mobile_masks[0] | self.__mobile_masks[1]
+        return self.__mobile_masks[player_index]
+
+    def get_attacker_count(self, location, player_index):
+        """The number of enemy structures that can attack a unit at a location, looked up from the coverage grid
+
+        Args:
+            location: The location of a hypothetical defender
+            player_index: The player controlling the defender, 0 for you 1 for the enemy
+
+        Returns:
+            The number of structures of the other player that have the location in range
+
+        """
+        if self.__deferred:
+            self._materialise(1 - player_index, None, True)
+        x, y = location
+        return self._coverage.attacker_count[1 - player_index][x + y * self.ARENA_SIZE]
+
+    def get_attacking_structures(self, location, player_index):
+        """The enemy structures that can attack a unit at a location, looked up from the coverage grid
+
+        Args:
+            location: The location of a hypothetical defender, [x, y] with integer coordinates
+            player_index: The player controlling the defender, 0 for you 1 for the enemy
+
+        Returns:
+            A list of the structures of the other player that have the location in range, nearest first
+
+        """
+        if self.__deferred:
+            self._materialise(1 - player_index, None, True)
+        return self._coverage.structures_attacking(location, player_index, self.ruleset.max_attack_range)
+
+    def get_damage_per_frame(self, location, player_index):
+        """The damage per frame enemy structures can deal to a mobile unit at a location, looked up from the coverage grid
+
+        Args:
+            location: The location of a hypothetical defender
+            player_index: The player controlling the defender, 0 for you 1 for the enemy
+
+        Returns:
+            The sum of the damage to mobile units of every structure of the other player that has the location in range
+
+        """
+        if self.__deferred:
+            self._materialise(1 - player_index, None, True)
+        x, y = location
+        return self._coverage.damage[1 - player_index][x + y * self.ARENA_SIZE]
+
+    def get_path_damage(self, path, player_index):
+        """Sums the damage per frame enemy structures can deal along a path
+
+        Each tile counts once, so for a unit that spends more than one frame per tile multiply by the frames per tile.
+
+        Args:
+            path: A list of locations, like the ones find_path_to_edge returns
+            player_index: The player controlling the unit walking the path, 0 for you 1 for the enemy
+
+        Returns:
+            The total damage per frame over the tiles of the path
+
+        """
+        if self.__deferred:
+            self._materialise(1 - player_index, None, True)
+        damage = self._coverage.damage[1 - player_index]
+        size = self.ARENA_SIZE
+        return sum(damage[x + y * size] for x, y in path)
+
+    def get_shield(self, location, player_index):
+        """The shield friendly supports give a mobile unit at a location, looked up from the coverage grid
+
+        Args:
+            location: The location of the mobile unit
+            player_index: The player controlling the mobile unit, 0 for you 1 for the enemy
+
+        Returns:
+            The summed shieldPerUnit and shieldBonusPerY of the supports of player_index that reach the location
+
+        """
+        if self.__deferred:
+            self._materialise(player_index, None, True)
+        x, y = location
+        return self._coverage.shield[player_index][x + y * self.ARENA_SIZE]
+
+    def get_path_shield(self, path, player_index):
+        """The total shield a mobile unit receives walking a path. Each support counts once, like in the game.
+
+        Args:
+            path: A list of locations, like the ones find_path_to_edge returns
+            player_index: The player controlling the unit walking the path, 0 for you 1 for the enemy
+
+        Returns:
+            The shield the unit picks up from the supports of player_index along the path
+
+        """
+        if self.__deferred:
+            self._materialise(player_index, None, True)
+        return self._coverage.path_shield(path, player_index)
+
     def get_locations_in_range(self, location, radius):
         """Gets locations in a circular area around a location
 
@@ -196,7 +549,7 @@ class GameMap:
             radius: The radius of our search area
 
         Returns:
-            The locations that are within our search area
+            The locations that are within our search area, nearest first
 
         """
         if radius < 0 or radius > self.ARENA_SIZE:
@@ -204,17 +557,21 @@ class GameMap:
         if not self.in_arena_bounds(location):
             self._invalid_coordinates(location)
 
-        x, y = location
-        locations = []
-        search_radius = math.ceil(radius)
-        getHitRadius = self.config["unitInformation"][0]['getHitRadius']
-        for i in range(int(x - search_radius), int(x + search_radius + 1)):
-            for j in range(int(y - search_radius), int(y + search_radius + 1)):
-                new_location = [i, j]
-                # A unit with a given range affects all locations who's centers are within that range + get hit radius
-                if self.in_arena_bounds(new_location) and self.distance_between_locations(location, new_location) < radius + getHitRadius:
-                    locations.append(new_location)
-        return locations
+        return [[x, y] for x, y, _ in geometry.tiles_in_range(location, radius, self.__hit_radius)]
+
+    def get_tiles_in_range(self, location, radius):
+        """Gets locations in a circular area around a location together with their distance to it.
+        The distances come from a precomputed stencil, so no square roots are taken.
+
+        Args:
+            location: The center of our search area
+            radius: The radius of our search area
+
+        Returns:
+            A list of (x, y, distance) tuples for the locations in our search area, nearest first
+
+        """
+        return geometry.tiles_in_range(location, radius, self.__hit_radius)
 
     def distance_between_locations(self, location_1, location_2):
         """Euclidean distance
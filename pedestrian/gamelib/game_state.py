@@ -1,21 +1,79 @@
 import math
 import json
-import sys
+import functools
 
-from .navigation import ShortestPathFinder
-from .util import send_command, debug_write
+from .navigation import GridPathFinder, PocketIndex
+from .util import submit_commands, debug_write, decode_json
 from .unit import GameUnit
 from .game_map import GameMap
+from .targeting import TargetingEngine
+from .transposition import TranspositionCache
+from .ruleset import Ruleset
+from .coverage import stencil_rank
+from . import geometry
 
-def is_stationary(unit_type):
+_latest_ruleset = None
+
+def is_stationary(unit_type, ruleset=None):
     """
         Args:
             unit_type: A unit type
+            ruleset: The Ruleset of the game, game_state.ruleset. If None, the Ruleset of the last GameState created is used
         
         Returns: 
             Boolean, True if the unit is stationary, False otherwise.
     """
-    return unit_type in STRUCTURE_TYPES
+    if ruleset is None:
+        ruleset = _latest_ruleset
+        if ruleset is None:
+            debug_write("is_stationary needs a ruleset before any GameState is created, pass game_state.ruleset")
+            return False
+    return ruleset.is_stationary(unit_type)
+
+class StructureChanges:
+    """The structures that changed between two turns, see GameState.structure_changes
+
+    Attributes :
+        * built (list): GameUnits of the structures that are new this turn
+        * destroyed (list): GameUnits of the previous turn whose structure is gone. Their stats are as of the previous turn.
+        * upgraded (list): GameUnits of the structures that were upgraded since the previous turn
+        * marked_for_removal (list): GameUnits of the structures that were marked for removal since the previous turn
+        * health_changed (list): (GameUnit, previous health) pairs for the structures whose health changed
+
+    """
+    def __init__(self, previous, current):
+        """Compares two turns of structures
+
+        Args:
+            * previous: The structures of the previous turn, mapping (x, y) to (unit, unit_type, player_index, health, upgraded, pending_removal)
+            * current: The structures of this turn, in the same format
+
+        """
+        self.built = []
+        self.destroyed = []
+        self.upgraded = []
+        self.marked_for_removal = []
+        self.health_changed = []
+        for location, (unit, _, _, health, upgraded, pending_removal) in current.items():
+            old = previous.get(location)
+            if old is None or old[0] is not unit:
+                self.built.append(unit)
+                if old is not None:
+                    self.destroyed.append(old[0])
+                continue
+            if upgraded and not old[4]:
+                self.upgraded.append(unit)
+            if pending_removal and not old[5]:
+                self.marked_for_removal.append(unit)
+            if health != old[3]:
+                self.health_changed.append((unit, old[3]))
+        for location, old in previous.items():
+            if location not in current:
+                self.destroyed.append(old[0])
+
+    def __len__(self):
+        return len(self.built) + len(self.destroyed) + len(self.upgraded) + len(self.marked_for_removal) + len(self.health_changed)
+
 
 class GameState:
     """Represents the entire gamestate for a given turn
@@ -32,6 +90,8 @@ class GameState:
         * REMOVE (str): A constant representing removing your own unit
         * UPGRADE (str): A constant representing upgrading a unit
         * STRUCTURE_TYPES (list): A list of the structure units
+        * ALL_UNITS (list): A list of the units that can be spawned
+        * ruleset (:obj: Ruleset): The rules compiled from config, shared with every other GameState using the same config
 
         * ARENA_SIZE (int): The size of the arena
         * HALF_ARENA (int): Half the size of the arena
@@ -44,66 +104,117 @@ class GameState:
         * my_time (int): The time you took to submit your previous turn
         * enemy_health (int): Your opponents current remaining health
         * enemy_time (int): Your opponents current remaining time
+        * structure_changes (:obj: StructureChanges): What changed since the previous turn, None unless a previous GameState was passed in
+        * layout_cache (:obj: TranspositionCache): The pathing caches of recent structure layouts, keyed on GameMap.zobrist_hash 
+          and shared by every GameState, so layouts seen earlier in a search or on an earlier turn are not pathed again
 
     """
+    layout_cache = TranspositionCache(64)
 
-    def __init__(self, config, serialized_string):
+    def __init__(self, config, serialized_string, previous=None, lazy=False):
         """ Setup a turns variables using arguments passed
 
+        If the GameState of the previous turn is passed, structures that are still standing reuse its GameUnit objects, 
+        pathing caches are kept if no structure moved, and structure_changes lists what changed since then. 
+        The units of the previous GameState are updated in place, so it should not be used afterwards.
+
+        In lazy mode only the stats and turn number are read up front. The units of each player and type are 
+        built the first time something asks for them, so turns that only look at resources or at a few 
+        structure types skip most of the parsing. If a previous GameState is passed, structures are built 
+        right away because the change feed needs all of them.
+
         Args:
             * config (JSON): A json object containing information about the game
             * serialized_string (string): A string containing information about the game state at the start of this turn
+            * previous (:obj: GameState): The GameState of the previous turn, optional
+            * lazy (bool): If true, build units the first time they are needed
 
         """
         self.serialized_string = serialized_string
         self.config = config
         self.enable_warnings = True
 
-        global WALL, SUPPORT, TURRET, SCOUT, DEMOLISHER, INTERCEPTOR, REMOVE, UPGRADE, STRUCTURE_TYPES, ALL_UNITS, UNIT_TYPE_TO_INDEX
-        UNIT_TYPE_TO_INDEX = {}
-        WALL = config["unitInformation"][0]["shorthand"]
-        UNIT_TYPE_TO_INDEX[WALL] = 0
-        SUPPORT = config["unitInformation"][1]["shorthand"]
-        UNIT_TYPE_TO_INDEX[SUPPORT] = 1
-        TURRET = config["unitInformation"][2]["shorthand"]
-        UNIT_TYPE_TO_INDEX[TURRET] = 2
-        SCOUT = config["unitInformation"][3]["shorthand"]
-        UNIT_TYPE_TO_INDEX[SCOUT] = 3
-        DEMOLISHER = config["unitInformation"][4]["shorthand"]
-        UNIT_TYPE_TO_INDEX[DEMOLISHER] = 4
-        INTERCEPTOR = config["unitInformation"][5]["shorthand"]
-        UNIT_TYPE_TO_INDEX[INTERCEPTOR] = 5
-        REMOVE = config["unitInformation"][6]["shorthand"]
-        UNIT_TYPE_TO_INDEX[REMOVE] = 6
-        UPGRADE = config["unitInformation"][7]["shorthand"]
-        UNIT_TYPE_TO_INDEX[UPGRADE] = 7
-
-        ALL_UNITS = [SCOUT, DEMOLISHER, INTERCEPTOR, WALL, SUPPORT, TURRET]
-        STRUCTURE_TYPES = [WALL, SUPPORT, TURRET]
-
-        self.ARENA_SIZE = 28
-        self.HALF_ARENA = int(self.ARENA_SIZE / 2)
-        self.MP = 1
-        self.SP = 0
-        global MP, SP
-        MP = self.MP
-        SP = self.SP
+        global _latest_ruleset
+        self.ruleset = _latest_ruleset = Ruleset.for_config(config)
+        self.UNIT_TYPE_TO_INDEX = self.ruleset.UNIT_TYPE_TO_INDEX
+        self.WALL = self.ruleset.WALL
+        self.SUPPORT = self.ruleset.SUPPORT
+        self.TURRET = self.ruleset.TURRET
+        self.SCOUT = self.ruleset.SCOUT
+        self.DEMOLISHER = self.ruleset.DEMOLISHER
+        self.INTERCEPTOR = self.ruleset.INTERCEPTOR
+        self.REMOVE = self.ruleset.REMOVE
+        self.UPGRADE = self.ruleset.UPGRADE
+        self.ALL_UNITS = self.ruleset.ALL_UNITS
+        self.STRUCTURE_TYPES = self.ruleset.STRUCTURE_TYPES
+
+        self.ARENA_SIZE = geometry.ARENA_SIZE
+        self.HALF_ARENA = geometry.HALF_ARENA
+        self.MP = self.ruleset.MP
+        self.SP = self.ruleset.SP
 
         self.game_map = GameMap(self.config)
-        self._shortest_path_finder = ShortestPathFinder()
+        self._targeting = TargetingEngine(self.game_map)
+        self._shortest_path_finder = GridPathFinder()
+        self._path_cache_version = None
+        self._blocked_cache = None
+        self._edge_fields = {}
+        self._pocket_index = None
+        self._layout_entry = None
         self._build_stack = []
         self._deploy_stack = []
         self._player_resources = [
                 {'SP': 0, 'MP': 0},  # player 0, which is you
                 {'SP': 0, 'MP': 0}]  # player 1, which is the opponent
+        self.structure_changes = None
+        if previous is not None and previous.config is not config:
+            self.warn("Ignoring the previous GameState, it was built from a different config")
+            previous = None
+        self._lazy = lazy
+        self._previous_structures = previous._structure_snapshot() if previous is not None else {}
+        self._turn_structures = None
+        self.game_map._on_structures_loaded = self.__record_structures
         self.__parse_state(serialized_string)
+        if not lazy or previous is not None:
+            self.game_map._materialise(structures_only=True)
+        if previous is not None:
+            self.structure_changes = StructureChanges(self._previous_structures, self._turn_structures)
+            self.__inherit_caches(previous)
+        self._previous_structures = {}
+
+    def __record_structures(self):
+        """
+        Remembers the structures as parsed, before any changes are planned on this turn. Called once all structures are built.
+        """
+        self._turn_structures = {(unit.x, unit.y): (unit, unit.unit_type, unit.player_index, unit.health, unit.upgraded, unit.pending_removal)
+            for unit in self.game_map.get_structures()}
+
+    def _structure_snapshot(self):
+        """
+        The structures as parsed, building them first if this GameState is lazy.
+        """
+        if self._turn_structures is None:
+            self.game_map._materialise(structures_only=True)
+        return self._turn_structures
+
+    def __inherit_caches(self, previous):
+        """
+        Reuses the pathing caches of the previous turn if they are current and were built for the same structure layout.
+        """
+        self._shortest_path_finder = previous._shortest_path_finder
+        if (previous._path_cache_version == previous.game_map._layout_version and 
+                previous.game_map.structure_mask() == self.game_map.structure_mask()):
+            self._blocked_cache = previous._blocked_cache
+            self._edge_fields = previous._edge_fields
+            self._pocket_index = previous._pocket_index
+            self._path_cache_version = self.game_map._layout_version
 
     def __parse_state(self, state_line):
         """
         Fills in map based on the serialized game state so that self.game_map[x,y] is a list of GameUnits at that location.
         state_line is the game state as a json string.
         """
-        state = json.loads(state_line)
+        state = decode_json(state_line)
 
         turn_info = state["turnInfo"]
         self.turn_number = int(turn_info[1])
@@ -128,29 +239,50 @@ class GameState:
 
     def __create_parsed_units(self, units, player_number):
         """
-        Helper function for __parse_state to add units to the map.
+        Helper function for __parse_state to add units to the map, or register them with the map in lazy mode.
         """
         typedef = self.config.get("unitInformation")
+        # RM and UP are not units, they mark structures of the other buckets
+        remove_index = self.UNIT_TYPE_TO_INDEX[self.REMOVE]
+        upgrade_index = self.UNIT_TYPE_TO_INDEX[self.UPGRADE]
+        removals = set((int(uinfo[0]), int(uinfo[1])) for uinfo in units[remove_index]) if len(units) > remove_index else set()
+        upgrades = set((int(uinfo[0]), int(uinfo[1])) for uinfo in units[upgrade_index]) if len(units) > upgrade_index else set()
         for i, unit_types in enumerate(units):
-            for uinfo in unit_types:
-                unit_type = typedef[i].get("shorthand")
-                sx, sy, shp = uinfo[:3]
-                x, y = map(int, [sx, sy])
-                hp = float(shp)
-                # This depends on RM and UP always being the last types to be processed
-                if unit_type == REMOVE:
-                    # Quick fix will deploy engine fix soon
-                    if self.contains_stationary_unit([x,y]):
-                        self.game_map[x,y][0].pending_removal = True
-                elif unit_type == UPGRADE:
-                    if self.contains_stationary_unit([x,y]):
-                        self.game_map[x,y][0].upgrade()
-                else:
-                    unit = GameUnit(unit_type, self.config, player_number, hp, x, y)
-                    self.game_map[x,y].append(unit)
+            if i == remove_index or i == upgrade_index or not unit_types:
+                continue
+            unit_type = typedef[i].get("shorthand")
+            stationary = self.ruleset.is_stationary(unit_type)
+            if self._lazy:
+                self.game_map._defer_units(player_number, unit_type, stationary, 
+                    functools.partial(self.__load_bucket, unit_types, unit_type, stationary, player_number, removals, upgrades))
+            else:
+                self.__load_bucket(unit_types, unit_type, stationary, player_number, removals, upgrades)
+
+    def __load_bucket(self, unit_types, unit_type, stationary, player_number, removals, upgrades):
+        """
+        Builds the units of one player and type and places them on the map.
+        removals and upgrades are the locations the player marked with RM and UP.
+        """
+        for uinfo in unit_types:
+            sx, sy, shp = uinfo[:3]
+            x, y = map(int, [sx, sy])
+            hp = float(shp)
+            unit = None
+            if stationary:
+                previous = self._previous_structures.get((x, y))
+                if previous is not None and previous[1] == unit_type and previous[2] == player_number:
+                    unit = previous[0]
+                    unit.reset(hp)
+            if unit is None:
+                unit = GameUnit(unit_type, self.config, player_number, hp, x, y)
+            if stationary and (x, y) in removals:
+                unit.pending_removal = True
+            self.game_map._place_unit(unit)
+            if stationary and (x, y) in upgrades:
+                self.game_map._upgrade(unit)
 
     def __resource_required(self, unit_type):
-        return self.SP if is_stationary(unit_type) else self.MP
+        return self.SP if self.ruleset.is_stationary(unit_type) else self.MP
 
     def __set_resource(self, resource_type, amount, player_index=0):
         """
@@ -163,8 +295,13 @@ class GameState:
         elif resource_type == self.SP:
             resource_key = 'SP'
         held_resource = self.get_resource(resource_type, player_index)
+        if self.game_map._journal is not None:
+            self.game_map._journal.append((self.__restore_resource, player_index, resource_key, held_resource))
         self._player_resources[player_index][resource_key] = held_resource + amount
 
+    def __restore_resource(self, player_index, resource_key, amount):
+        self._player_resources[player_index][resource_key] = amount
+
     def _invalid_player_index(self, index):
         self.warn("Invalid player index {} passed, player index should always be 0 (yourself) or 1 (your opponent)".format(index))
     
@@ -177,8 +314,8 @@ class GameState:
         """
         build_string = json.dumps(self._build_stack)
         deploy_string = json.dumps(self._deploy_stack)
-        send_command(build_string)
-        send_command(deploy_string)
+        if not submit_commands(build_string, deploy_string):
+            self.warn("This turn was already submitted, most likely by the AlgoCore watchdog. Discarding it.")
 
     def get_resource(self, resource_type, player_index = 0):
         """Gets a players resources
@@ -234,11 +371,12 @@ class GameState:
             The number of units affordable of the given unit_type.
 
         """
-        if unit_type not in ALL_UNITS:
+        if unit_type not in self.ALL_UNITS:
             self._invalid_unit(unit_type)
             return
 
-        costs = self.type_cost(unit_type)
+        MP, SP = self.MP, self.SP
+        costs = self.ruleset.costs[unit_type]
         player_held = self.get_resources()
         if costs[MP] > 0 and costs[SP] > 0:
             return min(math.floor(player_held[SP] / costs[SP]), math.floor(player_held[MP] / costs[MP]))
@@ -271,16 +409,7 @@ class GameState:
             self.warn("Invalid current MP ({}). Current MP cannot be negative.".format(current_MP))
 
         MP = self.get_resource(self.MP, player_index) if not current_MP else current_MP
-        for increment in range(1, turns_in_future + 1):
-            current_turn = self.turn_number + increment
-            MP *= (1 - self.config["resources"]["bitDecayPerRound"])
-            MP_per_round = self.config["resources"]["bitsPerRound"]
-            MP_ramp_ups = current_turn // self.config["resources"]["turnIntervalForBitSchedule"]
-            MP_per_round_growth = self.config["resources"]["bitGrowthRate"]
-            MP_gained = MP_per_round + (MP_per_round_growth * MP_ramp_ups)
-            MP += MP_gained
-            MP = round(MP, 1)
-        return MP
+        return self.ruleset.project_MP(MP, self.turn_number, turns_in_future)
 
     def type_cost(self, unit_type, upgrade=False):
         """Gets the cost of a unit based on its type
@@ -292,16 +421,11 @@ class GameState:
             The units costs as a list [SP, MP]
 
         """
-        if unit_type == REMOVE:
+        if unit_type == self.REMOVE:
             self._invalid_unit(unit_type)
             return
-        
-        unit_def = self.config["unitInformation"][UNIT_TYPE_TO_INDEX[unit_type]]
-        cost_base = [unit_def.get('cost1', 0), unit_def.get('cost2', 0)]
-        if upgrade:
-            return [unit_def.get('upgrade', {}).get('cost1', cost_base[SP]), unit_def.get('upgrade', {}).get('cost2', cost_base[MP])]
 
-        return cost_base
+        return self.ruleset.type_cost(unit_type, upgrade)
 
 
     def can_spawn(self, unit_type, location, num=1):
@@ -320,7 +444,7 @@ class GameState:
             True if we can spawn the unit(s)
 
         """
-        if unit_type not in ALL_UNITS:
+        if unit_type not in self.ALL_UNITS:
             self._invalid_unit(unit_type)
             return
         
@@ -330,10 +454,10 @@ class GameState:
             return False
 
         affordable = self.number_affordable(unit_type) >= num
-        stationary = is_stationary(unit_type)
+        stationary = self.ruleset.is_stationary(unit_type)
         blocked = self.contains_stationary_unit(location) or (stationary and len(self.game_map[location[0],location[1]]) > 0)
         correct_territory = location[1] < self.HALF_ARENA
-        on_edge = location in (self.game_map.get_edge_locations(self.game_map.BOTTOM_LEFT) + self.game_map.get_edge_locations(self.game_map.BOTTOM_RIGHT))
+        on_edge = tuple(location) in geometry.PLAYER_EDGE_SETS[0]
 
         if self.enable_warnings:
             fail_reason = ""
@@ -364,7 +488,7 @@ class GameState:
             The number of units successfully spawned
 
         """
-        if unit_type not in ALL_UNITS:
+        if unit_type not in self.ALL_UNITS:
             self._invalid_unit(unit_type)
             return
         if num < 1 or not locations:
@@ -378,11 +502,11 @@ class GameState:
             for i in range(num):
                 if self.can_spawn(unit_type, location, 1):
                     x, y = map(int, location)
-                    costs = self.type_cost(unit_type)
-                    self.__set_resource(SP, 0 - costs[SP])
-                    self.__set_resource(MP, 0 - costs[MP])
+                    costs = self.ruleset.costs[unit_type]
+                    self.__set_resource(self.SP, 0 - costs[self.SP])
+                    self.__set_resource(self.MP, 0 - costs[self.MP])
                     self.game_map.add_unit(unit_type, location, 0)
-                    if is_stationary(unit_type):
+                    if self.ruleset.is_stationary(unit_type):
                         self._build_stack.append((unit_type, x, y))
                     else:
                         self._deploy_stack.append((unit_type, x, y))
@@ -407,7 +531,7 @@ class GameState:
         for location in locations:
             if location[1] < self.HALF_ARENA and self.contains_stationary_unit(location):
                 x, y = map(int, location)
-                self._build_stack.append((REMOVE, x, y))
+                self._build_stack.append((self.REMOVE, x, y))
                 removed_units += 1
             else:
                 self.warn("Could not remove a unit from {}. Location has no structures or is enemy territory.".format(location))
@@ -439,19 +563,67 @@ class GameState:
                     if unit.stationary:
                         existing_unit = unit
 
-                if not existing_unit.upgraded and self.config["unitInformation"][UNIT_TYPE_TO_INDEX[existing_unit.unit_type]].get("upgrade", None) is not None:
-                    costs = self.type_cost(existing_unit.unit_type, True)
+                if not existing_unit.upgraded and self.ruleset.is_upgradable(existing_unit.unit_type):
+                    costs = self.ruleset.upgrade_costs[existing_unit.unit_type]
                     resources = self.get_resources()
-                    if resources[SP] >= costs[SP] and resources[MP] >= costs[MP]:
-                        self.__set_resource(SP, 0 - costs[SP])
-                        self.__set_resource(MP, 0 - costs[MP])
-                        existing_unit.upgrade()
-                        self._build_stack.append((UPGRADE, x, y))
+                    if resources[self.SP] >= costs[self.SP] and resources[self.MP] >= costs[self.MP]:
+                        self.__set_resource(self.SP, 0 - costs[self.SP])
+                        self.__set_resource(self.MP, 0 - costs[self.MP])
+                        self.game_map.upgrade_unit([x, y])
+                        self._build_stack.append((self.UPGRADE, x, y))
                         spawned_units += 1
             else:
                 self.warn("Could not upgrade a unit from {}. Location has no structures or is enemy territory.".format(location))
         return spawned_units
 
+    def savepoint(self):
+        """Marks the current board and resources so that rollback can return to them.
+
+        From the first savepoint on, attempt_spawn, attempt_upgrade, attempt_remove, game_map.add_unit, 
+        game_map.remove_unit and game_map[x, y] = units record what they change in an undo journal, 
+        so trying a plan and rolling it back costs about as much as the plan itself. Pathing caches 
+        built at the savepoint are kept for after the rollback. Savepoints can be nested, and the same 
+        savepoint can be rolled back to many times. Changes made directly to units, like setting their 
+        health, are not recorded.
+
+        Returns:
+            A savepoint to pass to rollback
+
+        """
+        game_map = self.game_map
+        game_map._materialise()
+        if game_map._journal is None:
+            game_map._journal = []
+        path_cache = None
+        if self._path_cache_version == game_map._layout_version:
+            path_cache = (self._blocked_cache, self._edge_fields, self._pocket_index)
+        return (len(game_map._journal), len(self._build_stack), len(self._deploy_stack), game_map._layout_version, path_cache)
+
+    def rollback(self, savepoint):
+        """Undoes every change recorded since savepoint was made, see savepoint
+
+        Savepoints made after this one can not be rolled back to anymore.
+
+        Args:
+            savepoint: A savepoint returned by savepoint()
+
+        """
+        journal = self.game_map._journal
+        position, builds, deploys, layout_version, path_cache = savepoint
+        if journal is None or position > len(journal):
+            self.warn("Could not roll back to {}, it is not an active savepoint".format(savepoint))
+            return
+        self.game_map._journal = None
+        while len(journal) > position:
+            undo, *args = journal.pop()
+            undo(*args)
+        self.game_map._journal = journal
+        del self._build_stack[builds:]
+        del self._deploy_stack[deploys:]
+        if path_cache is not None and self.game_map._layout_version != layout_version:
+            self._blocked_cache, self._edge_fields, self._pocket_index = path_cache
+            self._path_cache_version = self.game_map._layout_version
+
     def get_target_edge(self, start_location):
         """Gets the target edge given a starting location
 
@@ -495,8 +667,107 @@ class GameState:
         if target_edge is None:
             target_edge = self.get_target_edge(start_location)
 
-        end_points = self.game_map.get_edge_locations(target_edge)
-        return self._shortest_path_finder.navigate_multiple_endpoints(start_location, end_points, self)
+        end_points = self.__end_points(target_edge)
+        if end_points is None:
+            return
+        blocked, field = self.__edge_field(target_edge, end_points)
+        return self._shortest_path_finder.navigate_field(start_location, end_points, blocked, field, self.__pockets_for(start_location, field))
+
+    def find_paths_to_edge_many(self, start_locations, target_edge=None):
+        """Gets the paths units at many locations would take.
+        Units heading to the same edge share a single search, so this is much cheaper than
+        calling find_path_to_edge for each location.
+
+        Args:
+            start_locations: A list of locations of hypothetical units
+            target_edge: The edge the units want to reach. Induced from each start location if None.
+
+        Returns:
+            A list with one path per start location, in the same order. Blocked start locations get None.
+
+        """
+        paths = []
+        for start_location in start_locations:
+            if self.contains_stationary_unit(start_location):
+                self.warn("Attempted to perform pathing from blocked starting location {}".format(start_location))
+                paths.append(None)
+                continue
+            edge = self.get_target_edge(start_location) if target_edge is None else target_edge
+            end_points = self.__end_points(edge)
+            if end_points is None:
+                paths.append(None)
+                continue
+            blocked, field = self.__edge_field(edge, end_points)
+            paths.append(self._shortest_path_finder.navigate_field(start_location, end_points, blocked, field, self.__pockets_for(start_location, field)))
+        return paths
+
+    def get_self_destruct_location(self, start_location, target_edge=None):
+        """Gets the location a unit will self destruct on if it is sealed in by structures.
+        This is a lookup into an index built once per structure layout, so it is cheap to call for many locations.
+
+        Args:
+            start_location: The location of a hypothetical unit
+            target_edge: The edge the unit wants to reach. game_map.TOP_LEFT, game_map.BOTTOM_RIGHT, etc. Induced from start_location if None.
+
+        Returns:
+            The location the unit will self destruct on, or None if it can reach its target edge or start_location is blocked
+
+        """
+        if target_edge is None:
+            target_edge = self.get_target_edge(start_location)
+        end_points = self.__end_points(target_edge)
+        if end_points is None:
+            return
+        return self.__pockets().self_destruct_location(start_location, end_points)
+
+    def __end_points(self, target_edge):
+        """
+        Returns the frozen edge tuple for target_edge, warning and returning None for invalid edges.
+        """
+        if target_edge in (geometry.TOP_RIGHT, geometry.TOP_LEFT, geometry.BOTTOM_LEFT, geometry.BOTTOM_RIGHT):
+            return geometry.EDGES[target_edge]
+        return self.game_map.get_edge_locations(target_edge)
+
+    def __edge_field(self, target_edge, end_points):
+        """
+        Returns the blocked bitmap and the distance field towards target_edge, 
+        recomputing them only when the structure layout of game_map has changed.
+        """
+        if self._path_cache_version != self.game_map._layout_version:
+            self._path_cache_version = self.game_map._layout_version
+            self._layout_entry = self.layout_cache.get(self.game_map.zobrist_hash())
+            if self._layout_entry is None:
+                self._layout_entry = [self._shortest_path_finder.blocked_from_game_state(self), {}, None]
+                self.layout_cache.put(self.game_map.zobrist_hash(), self._layout_entry)
+            self._blocked_cache, self._edge_fields, self._pocket_index = self._layout_entry
+        field = self._edge_fields.get(target_edge)
+        if field is None:
+            field = self._shortest_path_finder.distance_field(end_points, self._blocked_cache)
+            self._edge_fields[target_edge] = field
+        return self._blocked_cache, field
+
+    def __pockets_for(self, start_location, field):
+        """
+        Returns the PocketIndex if a unit at start_location cannot reach the edge of field, None otherwise.
+        """
+        if not self.game_map.in_arena_bounds(start_location):
+            return None
+        x, y = start_location
+        if field[x + y * self.ARENA_SIZE] >= 0:
+            return None
+        return self.__pockets()
+
+    def __pockets(self):
+        """
+        Returns the PocketIndex of the current structure layout, building it on first use.
+        """
+        if self._path_cache_version != self.game_map._layout_version:
+            self.__edge_field(geometry.TOP_RIGHT, geometry.EDGES[geometry.TOP_RIGHT])
+        if self._pocket_index is None:
+            self._pocket_index = PocketIndex(self._blocked_cache)
+            if self._layout_entry is not None and self._layout_entry[0] is self._blocked_cache:
+                self._layout_entry[2] = self._pocket_index
+        return self._pocket_index
 
     def contains_stationary_unit(self, location):
         """Check if a location is blocked, return structures unit if it is
@@ -512,11 +783,30 @@ class GameState:
             self.warn('Checked for stationary unit outside of arena bounds')
             return False
         x, y = map(int, location)
+        if not self.game_map.structure_mask() >> (x + y * self.ARENA_SIZE) & 1:
+            return False
         for unit in self.game_map[x,y]:
             if unit.stationary:
                 return unit
         return False
 
+    def structure_mask(self, player_index=None, unit_type=None):
+        """Gets a bitboard of the tiles holding structures, a python int with bit x + y * 28 set for every structure.
+
+        Combine it with the region masks in geometry.py using &, | and ~. For example, the open tiles 
+        of the left lane are geometry.lane_mask(0, 5) & ~game_state.structure_mask(), 
+        and geometry.mask_to_locations turns a bitboard back into locations.
+
+        Args:
+            player_index: The player whose structures we want, 0 for you 1 for the enemy. Both players if None.
+            unit_type: The type of structure we want, WALL, TURRET, etc. All structure types if None.
+
+        Returns:
+            The bitboard of the matching structures
+
+        """
+        return self.game_map.structure_mask(player_index, unit_type)
+
     def warn(self, message):
         """ Used internally by game_state to print warnings
         """
@@ -542,6 +832,8 @@ class GameState:
         Their targeting priority is as follows:
             Infantry > Nearest Unit > Lowest Health > Lowest Y position > Closest to edge (Highest distance of X from the boards center, 13.5)
 
+        The search walks the tiles in range one distance shell at a time and stops at the first shell with a target, see TargetingEngine.
+
         Args:
             attacking_unit: A GameUnit
 
@@ -554,69 +846,31 @@ class GameState:
             self.warn("Passed a {} to get_target as attacking_unit. Expected a GameUnit.".format(type(attacking_unit)))
             return
 
-        attacker_location = [attacking_unit.x, attacking_unit.y]
-        possible_locations = self.game_map.get_locations_in_range(attacker_location, attacking_unit.attackRange)
-        target = None
-        target_stationary = True
-        target_distance = sys.maxsize
-        target_health = sys.maxsize
-        target_y = self.ARENA_SIZE
-        target_x_distance = 0
-
-        for location in possible_locations:
-            for unit in self.game_map[location]:
-                if unit.player_index == attacking_unit.player_index or (attacking_unit.damage_f == 0 and is_stationary(unit.unit_type)) or (attacking_unit.damage_i == 0 and not(is_stationary(unit.unit_type))):
-                    continue
-
-                new_target = False
-                unit_stationary = unit.stationary
-                unit_distance = self.game_map.distance_between_locations(location, [attacking_unit.x, attacking_unit.y])
-                unit_health = unit.health
-                unit_y = unit.y
-                unit_x_distance = abs(self.HALF_ARENA - 0.5 - unit.x)
-
-                if target_stationary and not unit_stationary:
-                    new_target = True
-                elif not target_stationary and unit_stationary:
-                    continue
-                
-                if target_distance > unit_distance:
-                    new_target = True
-                elif target_distance < unit_distance and not new_target:
-                    continue
-
-                if target_health > unit_health:
-                    new_target = True
-                elif target_health < unit_health and not new_target:
-                    continue
-
-                # Compare height heuristic relative to attacking unit's player index
-                if attacking_unit.player_index == 0:
-                    if target_y > unit_y:
-                        new_target = True
-                    elif target_y < unit_y and not new_target:
-                        continue
-                else:
-                    if target_y < unit_y:
-                        new_target = True
-                    elif target_y > unit_y and not new_target:
-                        continue
-
-                if target_x_distance < unit_x_distance:
-                    new_target = True
-                
-                if new_target:
-                    target = unit
-                    target_stationary = unit_stationary
-                    target_distance = unit_distance
-                    target_health = unit_health
-                    target_y = unit_y
-                    target_x_distance = unit_x_distance
-        return target
+        return self._targeting.get_target(attacking_unit)
+
+    def get_targets_batch(self, attackers):
+        """Returns the targets of many units on the current map, like calling get_target for each of them. 
+        Useful to resolve every attack of a frame, the map is indexed once for all attackers.
+
+        Args:
+            attackers: A list of GameUnits
+
+        Returns:
+            A list with the GameUnit each attacker would choose to attack, or None, in the same order
+
+        """
+        for attacking_unit in attackers:
+            if not isinstance(attacking_unit, GameUnit):
+                self.warn("Passed a {} to get_targets_batch as an attacker. Expected a GameUnit.".format(type(attacking_unit)))
+                return
+
+        return self._targeting.get_targets(attackers)
 
     def get_attackers(self, location, player_index):
         """Gets the stationary units threatening a given location
 
+        The structures come from the coverage grid GameMap maintains, only the tiles of enemy mobile units in range are scanned.
+
         Args:
             location: The location of a hypothetical defender
             player_index: The index corresponding to the defending player, 0 for you 1 for the enemy
@@ -631,17 +885,34 @@ class GameState:
         if not self.game_map.in_arena_bounds(location):
             self.warn("Location {} is not in the arena bounds.".format(location))
 
+        if (type(location[0]) is int and type(location[1]) is int 
+                and self.game_map.in_arena_bounds(location) and player_index in (0, 1)):
+            attackers = self.game_map.get_attacking_structures(location, player_index)
+            max_range, hit_radius = self.ruleset.max_attack_range, self.ruleset.hit_radius
+            mobiles = self.game_map.mobile_mask(1 - player_index) & geometry.range_mask(location, max_range, hit_radius)
+            if not mobiles:
+                return attackers
+            """
+            Scan the tiles of the structures and the mobile units in the order of the range scan below
+            """
+            x, y = location
+            ranks = stencil_rank(max_range, hit_radius)
+            tiles = {(unit.x, unit.y) for unit in attackers}
+            tiles.update(map(tuple, geometry.mask_to_locations(mobiles)))
+            attackers = []
+            for tile_x, tile_y in sorted(tiles, key=lambda tile: ranks[tile[0] - x, tile[1] - y]):
+                distance = math.sqrt((tile_x - x) ** 2 + (tile_y - y) ** 2)
+                for unit in self.game_map[tile_x, tile_y]:
+                    if unit.damage_i + unit.damage_f > 0 and unit.player_index != player_index and distance <= unit.attackRange:
+                        attackers.append(unit)
+            return attackers
+
         attackers = []
         """
         Get locations in the range of TURRET units
         """
-        max_range = 0
-        for unit in self.config["unitInformation"]:
-            if unit.get('attackRange', 0) >= max_range:
-                max_range = unit.get('attackRange', 0)
-        possible_locations= self.game_map.get_locations_in_range(location, max_range)
-        for location_unit in possible_locations:
-            for unit in self.game_map[location_unit]:
-                if unit.damage_i + unit.damage_f > 0 and unit.player_index != player_index and self.game_map.distance_between_locations(location, location_unit) <= unit.attackRange:
+        for x, y, distance in self.game_map.get_tiles_in_range(location, self.ruleset.max_attack_range):
+            for unit in self.game_map[x, y]:
+                if unit.damage_i + unit.damage_f > 0 and unit.player_index != player_index and distance <= unit.attackRange:
                     attackers.append(unit)
         return attackers
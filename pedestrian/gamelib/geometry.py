@@ -0,0 +1,293 @@
+"""
+Lookup tables describing the shape of the board.
+They are built once when gamelib is imported and never change afterwards,
+so hot paths can use them instead of redoing the diamond arithmetic on every call.
+
+Tiles are either addressed by (x, y) tuples or by a flat index, x + y * ARENA_SIZE.
+"""
+
+import math
+
+ARENA_SIZE = 28
+HALF_ARENA = ARENA_SIZE // 2
+NUM_TILES = ARENA_SIZE * ARENA_SIZE
+
+# Edge constants, matching GameMap.TOP_RIGHT and friends
+TOP_RIGHT = 0
+TOP_LEFT = 1
+BOTTOM_LEFT = 2
+BOTTOM_RIGHT = 3
+
+
+def _in_diamond(x, y):
+    """The diamond arithmetic the lookup table is built from, also used for non integer coordinates
+    """
+    row_size = y + 1
+    startx = HALF_ARENA - row_size
+    endx = startx + (2 * row_size) - 1
+    top_half_check = (y < HALF_ARENA and x >= startx and x <= endx)
+
+    row_size = (ARENA_SIZE - 1 - y) + 1
+    startx = HALF_ARENA - row_size
+    endx = startx + (2 * row_size) - 1
+    bottom_half_check = (y >= HALF_ARENA and x >= startx and x <= endx)
+
+    return bottom_half_check or top_half_check
+
+
+def _build_bounds_table():
+    table = bytearray(NUM_TILES)
+    for y in range(ARENA_SIZE):
+        for x in range(ARENA_SIZE):
+            if _in_diamond(x, y):
+                table[x + y * ARENA_SIZE] = 1
+    return table
+
+
+def _build_neighbor_table():
+    neighbors = []
+    for index in range(NUM_TILES):
+        x, y = index % ARENA_SIZE, index // ARENA_SIZE
+        adjacent = []
+        for nx, ny in ((x, y + 1), (x, y - 1), (x + 1, y), (x - 1, y)):
+            if 0 <= nx < ARENA_SIZE and 0 <= ny < ARENA_SIZE and IN_BOUNDS[nx + ny * ARENA_SIZE]:
+                adjacent.append(nx + ny * ARENA_SIZE)
+        neighbors.append(tuple(adjacent))
+    return tuple(neighbors)
+
+
+def _build_edges():
+    top_right = tuple((HALF_ARENA + num, ARENA_SIZE - 1 - num) for num in range(HALF_ARENA))
+    top_left = tuple((HALF_ARENA - 1 - num, ARENA_SIZE - 1 - num) for num in range(HALF_ARENA))
+    bottom_left = tuple((HALF_ARENA - 1 - num, num) for num in range(HALF_ARENA))
+    bottom_right = tuple((HALF_ARENA + num, num) for num in range(HALF_ARENA))
+    return (top_right, top_left, bottom_left, bottom_right)
+
+
+# 1 where the flat tile index is inside the arena, 0 otherwise
+IN_BOUNDS = _build_bounds_table()
+
+# Every in-arena location as an (x, y) tuple, row by row from the bottom
+LOCATIONS = tuple((index % ARENA_SIZE, index // ARENA_SIZE) for index in range(NUM_TILES) if IN_BOUNDS[index])
+
+# Flat tile indices of the in-arena tiles of every row, indexed by y
+ROW_INDICES = tuple(tuple(x + y * ARENA_SIZE for x in range(ARENA_SIZE) if IN_BOUNDS[x + y * ARENA_SIZE]) for y in range(ARENA_SIZE))
+
+# In-arena neighbors of every flat tile index, in up/down/right/left order
+NEIGHBORS = _build_neighbor_table()
+
+# The four edges as (x, y) tuples, indexed by TOP_RIGHT, TOP_LEFT, BOTTOM_LEFT and BOTTOM_RIGHT
+EDGES = _build_edges()
+EDGE_SETS = tuple(frozenset(edge) for edge in EDGES)
+EDGE_INDICES = tuple(tuple(x + y * ARENA_SIZE for x, y in edge) for edge in EDGES)
+
+# The edges each player can deploy mobile units on
+PLAYER_EDGE_SETS = (EDGE_SETS[BOTTOM_LEFT] | EDGE_SETS[BOTTOM_RIGHT], EDGE_SETS[TOP_LEFT] | EDGE_SETS[TOP_RIGHT])
+
+# In-arena locations on each side of the board
+BOTTOM_HALF = frozenset(location for location in LOCATIONS if location[1] < HALF_ARENA)
+TOP_HALF = frozenset(location for location in LOCATIONS if location[1] >= HALF_ARENA)
+LEFT_HALF = frozenset(location for location in LOCATIONS if location[0] < HALF_ARENA)
+RIGHT_HALF = frozenset(location for location in LOCATIONS if location[0] >= HALF_ARENA)
+
+# The half of the board each player can build on, indexed by player index
+PLAYER_HALVES = (BOTTOM_HALF, TOP_HALF)
+
+
+def in_arena_bounds(location):
+    """Checks if the given location is inside the diamond shaped game board.
+
+    Args:
+        location: A map location
+
+    Returns:
+        True if the location is on the board, False otherwise
+
+    """
+    x, y = location
+    if type(x) is int and type(y) is int:
+        return 0 <= x < ARENA_SIZE and 0 <= y < ARENA_SIZE and IN_BOUNDS[x + y * ARENA_SIZE] == 1
+    return _in_diamond(x, y)
+
+
+def tile_index(location):
+    """The flat tile index of a location, or -1 if it is outside the arena
+    """
+    if not in_arena_bounds(location):
+        return -1
+    x, y = location
+    return int(x) + int(y) * ARENA_SIZE
+
+
+def mask_from_locations(locations):
+    """Builds a bitboard from locations, skipping any that are outside the arena
+
+    A bitboard is a python int with bit x + y * ARENA_SIZE set for every tile it contains,
+    so region questions become &, |, ~ and popcount instead of loops over coordinates.
+
+    Args:
+        locations: An iterable of map locations
+
+    Returns:
+        The bitboard containing the locations
+
+    """
+    mask = 0
+    for location in locations:
+        if in_arena_bounds(location):
+            x, y = location
+            mask |= 1 << (int(x) + int(y) * ARENA_SIZE)
+    return mask
+
+
+def mask_to_locations(mask):
+    """The locations in a bitboard as [x, y] lists, row by row from the bottom
+    """
+    locations = []
+    while mask:
+        low = mask & -mask
+        index = low.bit_length() - 1
+        locations.append([index % ARENA_SIZE, index // ARENA_SIZE])
+        mask ^= low
+    return locations
+
+
+def popcount(mask):
+    """The number of tiles in a bitboard
+    """
+    return bin(mask).count("1")
+
+
+def location_mask(location):
+    """The bitboard holding a single location, 0 if it is outside the arena
+    """
+    index = tile_index(location)
+    return 0 if index < 0 else 1 << index
+
+
+_BIT_TO_BYTE = bytes.maketrans(b"01", b"\x00\x01")
+
+
+def mask_to_bytearray(mask):
+    """Expands a bitboard into a bytearray with one entry per tile, like the blocked maps the pathfinders use
+    """
+    bits = format(mask & ARENA_MASK, "0{}b".format(NUM_TILES))[::-1]
+    return bytearray(bits.encode().translate(_BIT_TO_BYTE))
+
+
+# Bitboards of the whole arena, every row (indexed by y) and every column (indexed by x)
+ARENA_MASK = sum(1 << index for index in range(NUM_TILES) if IN_BOUNDS[index])
+ROW_MASKS = tuple(sum(1 << index for index in ROW_INDICES[y]) for y in range(ARENA_SIZE))
+COLUMN_MASKS = tuple(sum(1 << (x + y * ARENA_SIZE) for y in range(ARENA_SIZE) if IN_BOUNDS[x + y * ARENA_SIZE]) for x in range(ARENA_SIZE))
+
+# Bitboards of the four edges, each player's deploy edges and the sides of the board
+EDGE_MASKS = tuple(mask_from_locations(edge) for edge in EDGES)
+PLAYER_EDGE_MASKS = (EDGE_MASKS[BOTTOM_LEFT] | EDGE_MASKS[BOTTOM_RIGHT], EDGE_MASKS[TOP_LEFT] | EDGE_MASKS[TOP_RIGHT])
+BOTTOM_HALF_MASK = mask_from_locations(BOTTOM_HALF)
+TOP_HALF_MASK = mask_from_locations(TOP_HALF)
+LEFT_HALF_MASK = mask_from_locations(LEFT_HALF)
+RIGHT_HALF_MASK = mask_from_locations(RIGHT_HALF)
+PLAYER_HALF_MASKS = (BOTTOM_HALF_MASK, TOP_HALF_MASK)
+
+
+def lane_mask(start_x, end_x):
+    """The bitboard of the in-arena tiles in columns start_x to end_x inclusive, for example lane_mask(0, 5) for the left lane
+    """
+    mask = 0
+    for x in range(max(start_x, 0), min(end_x, ARENA_SIZE - 1) + 1):
+        mask |= COLUMN_MASKS[x]
+    return mask
+
+
+def rows_mask(start_y, end_y):
+    """The bitboard of the in-arena tiles in rows start_y to end_y inclusive
+    """
+    mask = 0
+    for y in range(max(start_y, 0), min(end_y, ARENA_SIZE - 1) + 1):
+        mask |= ROW_MASKS[y]
+    return mask
+
+
+_stencils = {}
+
+
+def range_stencil(radius, hit_radius=0):
+    """Offsets of every tile within range of a tile, nearest first
+
+    A unit with a given range affects all locations who's centers are within that range + get hit radius.
+    Stencils are computed once per distinct (radius, hit_radius) and shared, do not modify them.
+
+    Args:
+        radius: The radius of the area
+        hit_radius: The getHitRadius from the game config
+
+    Returns:
+        A tuple of (dx, dy, distance) tuples sorted by distance. Offsets at equal distance keep scan order.
+
+    """
+    key = (radius, hit_radius)
+    stencil = _stencils.get(key)
+    if stencil is None:
+        search_radius = math.ceil(radius)
+        offsets = []
+        for dx in range(-search_radius, search_radius + 1):
+            for dy in range(-search_radius, search_radius + 1):
+                distance = math.sqrt(dx * dx + dy * dy)
+                if distance < radius + hit_radius:
+                    offsets.append((dx, dy, distance))
+        offsets.sort(key=lambda offset: offset[2])
+        stencil = tuple(offsets)
+        _stencils[key] = stencil
+    return stencil
+
+
+def tiles_in_range(location, radius, hit_radius=0):
+    """Clips a range stencil around location against the arena
+
+    Args:
+        location: The center of the area
+        radius: The radius of the area
+        hit_radius: The getHitRadius from the game config
+
+    Returns:
+        A list of (x, y, distance) tuples for the in-arena tiles in range, nearest first
+
+    """
+    x, y = location
+    stencil = range_stencil(radius, hit_radius)
+    if type(x) is not int or type(y) is not int:
+        return [(x + dx, y + dy, distance) for dx, dy, distance in stencil if in_arena_bounds((x + dx, y + dy))]
+    tiles = []
+    for dx, dy, distance in stencil:
+        nx = x + dx
+        ny = y + dy
+        if 0 <= nx < ARENA_SIZE and 0 <= ny < ARENA_SIZE and IN_BOUNDS[nx + ny * ARENA_SIZE]:
+            tiles.append((nx, ny, distance))
+    return tiles
+
+
+_range_masks = {}
+
+
+def range_mask(location, radius, hit_radius=0):
+    """The bitboard of the tiles within range of a location, for example the footprint of a turret
+
+    Masks are cached per (location, radius, hit_radius).
+
+    Args:
+        location: The center of the area
+        radius: The radius of the area
+        hit_radius: The getHitRadius from the game config
+
+    Returns:
+        The bitboard of the in-arena tiles in range
+
+    """
+    key = (int(location[0]), int(location[1]), radius, hit_radius)
+    mask = _range_masks.get(key)
+    if mask is None:
+        mask = 0
+        for x, y, _ in tiles_in_range(location, radius, hit_radius):
+            mask |= 1 << (x + y * ARENA_SIZE)
+        _range_masks[key] = mask
+    return mask
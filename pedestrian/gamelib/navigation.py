@@ -2,7 +2,9 @@ import heapq
 import math
 import sys
 import queue
+from collections import deque
 from .util import debug_write
+from .geometry import ARENA_SIZE, HALF_ARENA, NUM_TILES, IN_BOUNDS, NEIGHBORS, EDGE_INDICES, in_arena_bounds, mask_to_bytearray
 
 class Node:
     """A pathfinding node
@@ -93,7 +95,7 @@ class ShortestPathFinder:
         while not current.empty():
             search_location = current.get()
             for neighbor in self._get_neighbors(search_location):
-                if not self.game_state.game_map.in_arena_bounds(neighbor) or self.game_map[neighbor[0]][neighbor[1]].blocked:
+                if not in_arena_bounds(neighbor) or self.game_map[neighbor[0]][neighbor[1]].blocked:
                     continue
 
                 x, y = neighbor
@@ -181,7 +183,7 @@ class ShortestPathFinder:
             current_location = current.get()
             current_node = self.game_map[current_location[0]][current_location[1]]
             for neighbor in self._get_neighbors(current_location):
-                if not self.game_state.game_map.in_arena_bounds(neighbor) or self.game_map[neighbor[0]][neighbor[1]].blocked:
+                if not in_arena_bounds(neighbor) or self.game_map[neighbor[0]][neighbor[1]].blocked:
                     continue
 
                 neighbor_node = self.game_map[neighbor[0]][neighbor[1]]
@@ -228,7 +230,7 @@ class ShortestPathFinder:
         best_pathlength = self.game_map[current_point[0]][current_point[1]].pathlength
         for neighbor in neighbors:
             #debug_write("Comparing champ {} and contender {}".format(ideal_neighbor, neighbor))
-            if not self.game_state.game_map.in_arena_bounds(neighbor) or self.game_map[neighbor[0]][neighbor[1]].blocked:
+            if not in_arena_bounds(neighbor) or self.game_map[neighbor[0]][neighbor[1]].blocked:
                 continue
 
             new_best = False
@@ -314,3 +316,618 @@ class ShortestPathFinder:
             sys.stderr.write(" ")
         sys.stderr.write(str(number))
         sys.stderr.write(" ")
+
+
+_EDGE_KEYS = {tiles: edge for edge, tiles in enumerate(EDGE_INDICES)}
+
+
+class GridPathFinder:
+    """Array backed drop-in replacement for ShortestPathFinder
+
+    Keeps flat, preallocated per-tile arrays indexed by x + y * ARENA_SIZE and
+    reuses them between searches. Visited flags are generation stamps, so starting
+    a new search is a counter increment rather than a reallocation. Paths are
+    identical to the ones ShortestPathFinder returns.
+
+    Attributes :
+        * HORIZONTAL (int): A constant representing a horizontal movement
+        * VERTICAL (int): A constant representing a vertical movement
+
+    """
+    def __init__(self):
+        self.HORIZONTAL = 1
+        self.VERTICAL = 2
+        self._generation = 0
+        self._visited_idealness = [0] * NUM_TILES
+        self._visited_validate = [0] * NUM_TILES
+        self._pathlength = [-1] * NUM_TILES
+        self._blocked = bytearray(NUM_TILES)
+
+    def blocked_from_game_state(self, game_state):
+        """Builds a blocked bitmap from the structures in a game state
+
+        Args:
+            game_state: A GameState object representing the gamestate we want to traverse
+
+        Returns:
+            A bytearray with one entry per tile, indexed by x + y * 28, that is 1 where a structure stands
+
+        """
+        return mask_to_bytearray(game_state.game_map.structure_mask())
+
+    def navigate_multiple_endpoints(self, start_point, end_points, game_state):
+        """Finds the path a unit would take to reach a set of endpoints
+
+        Args:
+            * start_point: The starting location of the unit
+            * end_points: The end points of the unit, should be a list of edge locations
+            * game_state: The current game state
+
+        Returns:
+            The path a unit at start_point would take when trying to reach end_points given the current game state.
+            Note that this path can change if a tower is destroyed during pathing, or if you or your enemy places structures.
+
+        """
+        if game_state.contains_stationary_unit(start_point):
+            return
+        return self.navigate_blocked(start_point, end_points, self.blocked_from_game_state(game_state))
+
+    def navigate_blocked(self, start_point, end_points, blocked):
+        """Finds the path a unit would take to reach a set of endpoints on an arbitrary board
+
+        Args:
+            * start_point: The starting location of the unit
+            * end_points: The end points of the unit, should be a list of edge locations
+            * blocked: A bitmap indexed by x + y * 28 that is truthy where a structure stands. It is only read.
+
+        Returns:
+            The path a unit at start_point would take, or None if start_point is blocked or out of bounds
+
+        """
+        x, y = start_point
+        if not (0 <= x < ARENA_SIZE and 0 <= y < ARENA_SIZE) or not IN_BOUNDS[x + y * ARENA_SIZE]:
+            return
+        start = x + y * ARENA_SIZE
+        if blocked[start]:
+            return
+
+        self._generation += 1
+        end_indices = [ex + ey * ARENA_SIZE for ex, ey in end_points]
+        ideal = self._idealness_search(start, end_points, end_indices, blocked)
+        self._validate(ideal, end_indices, blocked)
+        return self._get_path(start_point, end_points, blocked, self._pathlength)
+
+    def distance_field(self, end_points, blocked):
+        """Computes the pathlength of every tile to a set of endpoints
+
+        The field only depends on the endpoints and the blocked bitmap, so it can be shared
+        by every unit that is able to reach the edge. See navigate_field.
+
+        Args:
+            * end_points: The end points of the unit, should be a list of edge locations
+            * blocked: A bitmap indexed by x + y * 28 that is truthy where a structure stands
+
+        Returns:
+            A list indexed by x + y * 28 holding each tile's pathlength, or -1 if the tile cannot reach an endpoint
+
+        """
+        self._generation += 1
+        end_indices = [x + y * ARENA_SIZE for x, y in end_points]
+        self._validate(end_indices[0], end_indices, blocked)
+        generation = self._generation
+        visited = self._visited_validate
+        return [length if visited[index] == generation else -1 for index, length in enumerate(self._pathlength)]
+
+    def navigate_field(self, start_point, end_points, blocked, field, pockets=None):
+        """Finds the path a unit would take using a field computed by distance_field
+
+        Units that cannot reach the edge use the pocket index if one is given, 
+        and fall back to a full search for their self destruct pocket otherwise.
+
+        Args:
+            * start_point: The starting location of the unit
+            * end_points: The end points the field was computed for
+            * blocked: The blocked bitmap the field was computed for
+            * field: The result of distance_field(end_points, blocked)
+            * pockets: An optional PocketIndex built from blocked
+
+        Returns:
+            The same path navigate_blocked would return
+
+        """
+        x, y = start_point
+        if not (0 <= x < ARENA_SIZE and 0 <= y < ARENA_SIZE) or not IN_BOUNDS[x + y * ARENA_SIZE]:
+            return
+        start = x + y * ARENA_SIZE
+        if blocked[start]:
+            return
+        if field[start] < 0:
+            if pockets is None:
+                return self.navigate_blocked(start_point, end_points, blocked)
+            field = pockets.pocket_field(start, end_points)
+        return self._get_path(start_point, end_points, blocked, field)
+
+    def _idealness_search(self, start, end_points, end_indices, blocked):
+        """
+        Finds the most ideal tile in our 'pocket' of pathable space.
+        The edge if it is available, or the best self destruct location otherwise
+        """
+        generation = self._generation
+        visited = self._visited_idealness
+        end_set = set(end_indices)
+        weights = self._idealness_weights(end_points)
+        if start in end_set:
+            return start
+
+        visited[start] = generation
+        best_idealness = self._get_idealness(start, weights)
+        most_ideal = start
+        current = deque((start,))
+        while current:
+            for neighbor in NEIGHBORS[current.popleft()]:
+                if blocked[neighbor] or visited[neighbor] == generation:
+                    continue
+                if neighbor in end_set:
+                    return neighbor
+                idealness = self._get_idealness(neighbor, weights)
+                if idealness > best_idealness:
+                    best_idealness = idealness
+                    most_ideal = neighbor
+                visited[neighbor] = generation
+                current.append(neighbor)
+        return most_ideal
+
+    def _idealness_weights(self, end_points):
+        """The x and y direction a unit heading to end_points wants to travel in, see ShortestPathFinder._get_idealness
+        """
+        x, y = end_points[0]
+        return (1 if x >= HALF_ARENA else -1, 1 if y >= HALF_ARENA else -1)
+
+    def _get_idealness(self, index, weights):
+        """Idealness of a tile that is not an endpoint, see ShortestPathFinder._get_idealness
+        """
+        x, y = index % ARENA_SIZE, index // ARENA_SIZE
+        idealness = ARENA_SIZE * (y if weights[1] == 1 else ARENA_SIZE - 1 - y)
+        idealness += x if weights[0] == 1 else ARENA_SIZE - 1 - x
+        return idealness
+
+    def _validate(self, ideal, end_indices, blocked):
+        """Breadth first search of the grid, setting the pathlengths of each tile reachable from the ideal tile(s)
+        """
+        generation = self._generation
+        visited = self._visited_validate
+        pathlength = self._pathlength
+        if ideal in end_indices:
+            seeds = end_indices
+        else:
+            seeds = (ideal,)
+
+        current = deque()
+        for seed in seeds:
+            pathlength[seed] = 0
+            visited[seed] = generation
+            if not blocked[seed]:
+                current.append(seed)
+
+        while current:
+            index = current.popleft()
+            next_length = pathlength[index] + 1
+            for neighbor in NEIGHBORS[index]:
+                if blocked[neighbor] or visited[neighbor] == generation:
+                    continue
+                pathlength[neighbor] = next_length
+                visited[neighbor] = generation
+                current.append(neighbor)
+
+    def _get_path(self, start_point, end_points, blocked, pathlength):
+        """Walks down a validated pathlength field from start_point until it reaches a tile with pathlength 0
+        """
+        path = [start_point]
+        current = start_point[0] + start_point[1] * ARENA_SIZE
+        move_direction = 0
+        direction = self._idealness_weights(end_points)
+
+        while pathlength[current] != 0:
+            next_move = self._choose_next_move(current, move_direction, direction, blocked, pathlength)
+            if next_move % ARENA_SIZE == current % ARENA_SIZE:
+                move_direction = self.VERTICAL
+            else:
+                move_direction = self.HORIZONTAL
+            path.append([next_move % ARENA_SIZE, next_move // ARENA_SIZE])
+            current = next_move
+        return path
+
+    def _choose_next_move(self, current, previous_move_direction, direction, blocked, pathlength):
+        """Given the current tile, return the best 'next step' for a given unit to take
+        """
+        ideal_neighbor = current
+        best_pathlength = pathlength[current]
+        for neighbor in NEIGHBORS[current]:
+            if blocked[neighbor]:
+                continue
+            current_pathlength = pathlength[neighbor]
+            if current_pathlength > best_pathlength:
+                continue
+            if current_pathlength == best_pathlength and not self._better_direction(current, neighbor, ideal_neighbor, previous_move_direction, direction):
+                continue
+            ideal_neighbor = neighbor
+            best_pathlength = current_pathlength
+        return ideal_neighbor
+
+    def _better_direction(self, prev_tile, new_tile, prev_best, previous_move_direction, direction):
+        """Compare two tiles and return True if the unit would rather move to the new one, see ShortestPathFinder._better_direction
+        """
+        prev_x, prev_y = prev_tile % ARENA_SIZE, prev_tile // ARENA_SIZE
+        new_x, new_y = new_tile % ARENA_SIZE, new_tile // ARENA_SIZE
+        best_x, best_y = prev_best % ARENA_SIZE, prev_best // ARENA_SIZE
+        if previous_move_direction == self.HORIZONTAL and not new_x == best_x:
+            return not prev_y == new_y
+        if previous_move_direction == self.VERTICAL and not new_y == best_y:
+            return not prev_x == new_x
+        if previous_move_direction == 0:
+            return not prev_y == new_y
+
+        if new_y == best_y:
+            return (direction[0] == 1 and new_x > best_x) or (direction[0] == -1 and new_x < best_x)
+        if new_x == best_x:
+            return (direction[1] == 1 and new_y > best_y) or (direction[1] == -1 and new_y < best_y)
+        return True
+
+
+class IncrementalPathFinder(GridPathFinder):
+    """Pathfinder for what-if structure placements
+
+    Owns a blocked bitmap and keeps the distance fields of every edge it has been asked about.
+    Blocking or unblocking a single tile repairs only the part of each field that depended on
+    that tile, in the spirit of dynamic BFS, instead of searching the whole board again.
+    Self destruct pockets are cached per component and dropped only when a change touches them.
+
+    Typical use by a build planner::
+
+        finder = IncrementalPathFinder.from_game_state(game_state)
+        finder.block(candidate)
+        path = finder.find_path(start, end_points)
+        finder.unblock(candidate)
+
+    Attributes :
+        * blocked (bytearray): The current blocked bitmap, indexed by x + y * 28. Change it through block/unblock only.
+
+    """
+    def __init__(self, blocked=None):
+        super().__init__()
+        self.blocked = bytearray(blocked) if blocked is not None else bytearray(NUM_TILES)
+        self._fields = {}
+        self._pockets = {}
+
+    @classmethod
+    def from_game_state(cls, game_state):
+        """Creates an IncrementalPathFinder for the structures currently in game_state
+
+        Args:
+            game_state: A GameState object representing the gamestate we want to traverse
+
+        """
+        finder = cls()
+        finder.blocked = finder.blocked_from_game_state(game_state)
+        return finder
+
+    def block(self, location):
+        """Marks a location as blocked by a structure, repairing the cached fields
+        """
+        self.set_blocked(location, True)
+
+    def unblock(self, location):
+        """Marks a location as free of structures, repairing the cached fields
+        """
+        self.set_blocked(location, False)
+
+    def set_blocked(self, location, blocked):
+        """Sets whether a location is blocked by a structure, repairing the cached fields
+
+        Args:
+            * location: The location that changed
+            * blocked: True if a structure now stands at location
+
+        """
+        x, y = location
+        if not (0 <= x < ARENA_SIZE and 0 <= y < ARENA_SIZE) or not IN_BOUNDS[x + y * ARENA_SIZE]:
+            return
+        index = x + y * ARENA_SIZE
+        if bool(self.blocked[index]) == bool(blocked):
+            return
+        self.blocked[index] = 1 if blocked else 0
+        for sources, field in self._fields.values():
+            if blocked:
+                self._repair_blocked(index, sources, field)
+            else:
+                self._repair_unblocked(index, sources, field)
+        self._drop_pockets(index)
+
+    def find_path(self, start_point, end_points):
+        """Finds the path a unit would take to reach a set of endpoints on the current bitmap
+
+        Args:
+            * start_point: The starting location of the unit
+            * end_points: The end points of the unit, should be a list of edge locations
+
+        Returns:
+            The same path navigate_blocked would return for the current bitmap
+
+        """
+        x, y = start_point
+        if not (0 <= x < ARENA_SIZE and 0 <= y < ARENA_SIZE) or not IN_BOUNDS[x + y * ARENA_SIZE]:
+            return
+        start = x + y * ARENA_SIZE
+        if self.blocked[start]:
+            return
+        key = tuple(ex + ey * ARENA_SIZE for ex, ey in end_points)
+        entry = self._fields.get(key)
+        if entry is None:
+            entry = (frozenset(key), self.distance_field(end_points, self.blocked))
+            self._fields[key] = entry
+        field = entry[1]
+        if field[start] < 0:
+            field = self._pocket_field(start, key, end_points)
+        return self._get_path(start_point, end_points, self.blocked, field)
+
+    def _pocket_field(self, start, key, end_points):
+        """The pathlength field of the sealed pocket containing start, towards its best self destruct tile
+        """
+        pockets = self._pockets.setdefault(key, {})
+        field = pockets.get(start)
+        if field is not None:
+            return field
+
+        self._generation += 1
+        ideal = self._idealness_search(start, end_points, list(key), self.blocked)
+        self._validate(ideal, key, self.blocked)
+        generation = self._generation
+        visited = self._visited_validate
+        pathlength = self._pathlength
+        field = [-1] * NUM_TILES
+        tiles = [index for index in range(NUM_TILES) if visited[index] == generation]
+        for index in tiles:
+            field[index] = pathlength[index]
+        for index in tiles:
+            pockets[index] = field
+        return field
+
+    def _drop_pockets(self, index):
+        """Forgets every cached pocket that contains or borders a changed tile
+        """
+        touched = (index,) + NEIGHBORS[index]
+        for pockets in self._pockets.values():
+            for tile in touched:
+                field = pockets.get(tile)
+                if field is None:
+                    continue
+                for member, member_field in list(pockets.items()):
+                    if member_field is field:
+                        del pockets[member]
+
+    def _repair_blocked(self, index, sources, field):
+        """Repairs a distance field after index became blocked
+        """
+        if field[index] < 0:
+            return
+        blocked = self.blocked
+
+        # Find every tile whose shortest paths all ran through the new structure
+        affected = {index}
+        current = deque((index,))
+        while current:
+            tile = current.popleft()
+            child_length = field[tile] + 1
+            for child in NEIGHBORS[tile]:
+                if child in affected or blocked[child] or field[child] != child_length or child in sources:
+                    continue
+                supported = False
+                for parent in NEIGHBORS[child]:
+                    if field[parent] == field[tile] and not blocked[parent] and parent not in affected:
+                        supported = True
+                        break
+                if not supported:
+                    affected.add(child)
+                    current.append(child)
+
+        # Reconnect the affected tiles from the unaffected boundary
+        for tile in affected:
+            field[tile] = -1
+        frontier = []
+        for tile in affected:
+            if blocked[tile]:
+                continue
+            best = -1
+            for neighbor in NEIGHBORS[tile]:
+                length = field[neighbor]
+                if length >= 0 and not blocked[neighbor] and (best < 0 or length + 1 < best):
+                    best = length + 1
+            if best >= 0:
+                field[tile] = best
+                frontier.append((best, tile))
+        heapq.heapify(frontier)
+        while frontier:
+            length, tile = heapq.heappop(frontier)
+            if length != field[tile]:
+                continue
+            for neighbor in NEIGHBORS[tile]:
+                if neighbor in affected and not blocked[neighbor] and (field[neighbor] < 0 or field[neighbor] > length + 1):
+                    field[neighbor] = length + 1
+                    heapq.heappush(frontier, (length + 1, neighbor))
+
+    def _repair_unblocked(self, index, sources, field):
+        """Repairs a distance field after index became free
+        """
+        blocked = self.blocked
+        if index in sources:
+            field[index] = 0
+        else:
+            best = -1
+            for neighbor in NEIGHBORS[index]:
+                length = field[neighbor]
+                if length >= 0 and not blocked[neighbor] and (best < 0 or length + 1 < best):
+                    best = length + 1
+            field[index] = best
+            if best < 0:
+                return
+
+        current = deque((index,))
+        while current:
+            tile = current.popleft()
+            next_length = field[tile] + 1
+            for neighbor in NEIGHBORS[tile]:
+                if blocked[neighbor]:
+                    continue
+                if field[neighbor] < 0 or field[neighbor] > next_length:
+                    field[neighbor] = next_length
+                    current.append(neighbor)
+
+
+class PocketIndex:
+    """Connected component labelling of the open tiles of a blocked bitmap
+
+    Built once per structure layout. Every component caches its best idealness tile
+    for each of the four edges, so finding out whether a unit is sealed in and where
+    it will self destruct is a constant time lookup instead of a flood of its pocket.
+
+    Attributes :
+        * blocked (bytearray): The blocked bitmap the index was built from, indexed by x + y * 28
+        * labels (list): The component of every tile, or -1 for blocked and out of bounds tiles
+
+    """
+    def __init__(self, blocked):
+        self.blocked = blocked
+        self.labels = [-1] * NUM_TILES
+        self._reaches = []
+        self._best = []
+        self._lazy_best = {}
+        self._fields = {}
+
+        members = []
+        for index in range(NUM_TILES):
+            if not IN_BOUNDS[index] or blocked[index] or self.labels[index] >= 0:
+                continue
+            label = len(members)
+            component = [index]
+            self.labels[index] = label
+            current = deque((index,))
+            while current:
+                for neighbor in NEIGHBORS[current.popleft()]:
+                    if blocked[neighbor] or self.labels[neighbor] >= 0:
+                        continue
+                    self.labels[neighbor] = label
+                    component.append(neighbor)
+                    current.append(neighbor)
+            members.append(component)
+
+        labels = self.labels
+        for component in members:
+            self._best.append([self._most_ideal(component, EDGE_INDICES[edge][0]) for edge in range(4)])
+            self._reaches.append([0, 0, 0, 0])
+        for edge, tiles in enumerate(EDGE_INDICES):
+            for index in tiles:
+                if labels[index] >= 0:
+                    self._reaches[labels[index]][edge] = 1
+
+    def _most_ideal(self, component, first_end_point):
+        """The tile of a component a unit heading to an edge would self destruct on, see ShortestPathFinder._get_idealness
+        """
+        x_weight = 1 if first_end_point % ARENA_SIZE >= HALF_ARENA else -1
+        y_weight = 1 if first_end_point // ARENA_SIZE >= HALF_ARENA else -1
+        best = -1
+        most_ideal = component[0]
+        for index in component:
+            x, y = index % ARENA_SIZE, index // ARENA_SIZE
+            idealness = ARENA_SIZE * (y if y_weight == 1 else ARENA_SIZE - 1 - y)
+            idealness += x if x_weight == 1 else ARENA_SIZE - 1 - x
+            if idealness > best:
+                best = idealness
+                most_ideal = index
+        return most_ideal
+
+    def _edge_of(self, end_points):
+        """The index of the standard edge matching end_points, or None for custom endpoints
+        """
+        return _EDGE_KEYS.get(tuple(x + y * ARENA_SIZE for x, y in end_points))
+
+    def component(self, location):
+        """The component label of a location, -1 if it is blocked or out of bounds
+        """
+        x, y = location
+        if not (0 <= x < ARENA_SIZE and 0 <= y < ARENA_SIZE):
+            return -1
+        return self.labels[x + y * ARENA_SIZE]
+
+    def is_sealed(self, location, end_points):
+        """Check if a unit at location is unable to reach any of end_points
+
+        Args:
+            * location: The location of the unit
+            * end_points: The end points of the unit, should be a list of edge locations
+
+        Returns:
+            True if the unit is sealed in and will self destruct, False otherwise or if location is blocked
+
+        """
+        return self.self_destruct_index(self.component(location), end_points) is not None
+
+    def self_destruct_location(self, location, end_points):
+        """Gets the location a unit will self destruct on
+
+        Args:
+            * location: The location of the unit
+            * end_points: The end points of the unit, should be a list of edge locations
+
+        Returns:
+            The [x, y] location the unit will self destruct on, or None if it can reach end_points or location is blocked
+
+        """
+        index = self.self_destruct_index(self.component(location), end_points)
+        if index is None:
+            return None
+        return [index % ARENA_SIZE, index // ARENA_SIZE]
+
+    def self_destruct_index(self, label, end_points):
+        """Tile index a unit in component label heading to end_points self destructs on, or None if it reaches them
+        """
+        if label < 0:
+            return None
+        edge = self._edge_of(end_points)
+        if edge is not None:
+            if self._reaches[label][edge]:
+                return None
+            return self._best[label][edge]
+
+        key = (label, tuple(x + y * ARENA_SIZE for x, y in end_points))
+        if key not in self._lazy_best:
+            component = [index for index in range(NUM_TILES) if self.labels[index] == label]
+            end_indices = set(key[1])
+            if any(index in end_indices for index in component):
+                self._lazy_best[key] = None
+            else:
+                self._lazy_best[key] = self._most_ideal(component, key[1][0])
+        return self._lazy_best[key]
+
+    def pocket_field(self, start, end_points):
+        """The pathlength field towards the self destruct tile of the sealed pocket containing tile index start
+        """
+        label = self.labels[start]
+        ideal = self.self_destruct_index(label, end_points)
+        field = self._fields.get(ideal)
+        if field is not None:
+            return field
+
+        blocked = self.blocked
+        field = [-1] * NUM_TILES
+        field[ideal] = 0
+        current = deque((ideal,))
+        while current:
+            index = current.popleft()
+            next_length = field[index] + 1
+            for neighbor in NEIGHBORS[index]:
+                if blocked[neighbor] or field[neighbor] >= 0:
+                    continue
+                field[neighbor] = next_length
+                current.append(neighbor)
+        self._fields[ideal] = field
+        return field
@@ -0,0 +1,312 @@
+"""
+A pool of worker processes that score candidate plans on a board snapshot in shared memory.
+"""
+
+import json
+import time
+import struct
+import traceback
+import multiprocessing
+from array import array
+from multiprocessing import shared_memory
+from multiprocessing.connection import wait
+
+from .board import CompactBoard, EMPTY
+from .game_state import GameState
+from .util import debug_write
+from . import geometry
+
+NUM_TILES = geometry.NUM_TILES
+
+# generation, turn number, mobile unit count, then health, SP, MP and time of both players
+_HEADER = struct.Struct("<qqq8d")
+_TILES = _HEADER.size
+_MOBILES = _TILES + NUM_TILES * (8 + 1 + 1 + 1 + 1)
+# seconds between checks that busy workers are still alive
+_POLL = 0.05
+
+
+class EvaluationPool:
+    """Scores candidate plans in worker processes, started once and fed a new board every turn
+
+    Create the pool in on_game_start, so the workers are forked before the first turn. Every turn,
+    publish the GameState you plan on, then pass evaluate a list of plans. Each worker rebuilds the
+    published board as its own GameState once per publish, and scores a plan by calling
+    evaluate_plan(game_state, plan) between a savepoint and a rollback, so plans do not see each other.
+
+    Boards are published as CompactBoard arrays in one shared memory block, only the plans and
+    their results are pickled, over one pipe per worker. Plans are handed to idle workers one at a
+    time. When the timeout passes, plans not started yet are skipped and workers still running a plan
+    are sent SIGTERM and abandoned without waiting, so the turn is never held up by a worker. A worker
+    that dies is abandoned as well, the plan it was running scores None. Abandoned workers are replaced
+    by the next publish or evaluate call, or earlier by replace_workers, for example from on_action_frame,
+    so that forking never happens after the deadline.
+
+    evaluate_plan must not write to stdout, which is reserved for the game engine. With the fork
+    start method it can be any function, otherwise it must be picklable.
+
+    Attributes :
+        * processes (int): The number of worker processes
+        * max_mobile_units (int): The most mobile units a published board can hold
+        * missed (int): The number of plans of the last evaluate call that did not finish in time
+
+    """
+    def __init__(self, config, evaluate_plan, processes=None, max_mobile_units=1024):
+        """Starts the workers
+
+        Args:
+            config (JSON): The game config
+            evaluate_plan: A function called as evaluate_plan(game_state, plan) in the workers, returning a picklable result
+            processes: The number of worker processes, the number of CPUs if None
+            max_mobile_units: The most mobile units a published board can hold
+
+        """
+        self.config = config
+        self.processes = processes or multiprocessing.cpu_count()
+        self.max_mobile_units = max_mobile_units
+        self.missed = 0
+        self.enable_warnings = True
+        self._generation = 0
+        self._evaluate_plan = evaluate_plan
+        self._memory = shared_memory.SharedMemory(create=True, size=_MOBILES + max_mobile_units * (1 + 1 + 8 + 2))
+        self._context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else None)
+        self._workers = [None] * self.processes
+        self._connections = [None] * self.processes
+        self._abandoned = set()
+        for slot in range(self.processes):
+            self.__spawn(slot)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    def publish(self, game_state):
+        """Copies the board, resources and health of a GameState into shared memory for the next evaluate calls
+
+        Args:
+            game_state: The GameState to publish, including the units already passed to attempt_spawn
+
+        """
+        self.replace_workers()
+        board = CompactBoard.from_game_map(game_state.game_map)
+        mobiles = len(board.mobile_tile)
+        if mobiles > self.max_mobile_units:
+            self.warn("Publishing {} of {} mobile units, raise max_mobile_units to publish them all".format(self.max_mobile_units, mobiles))
+            mobiles = self.max_mobile_units
+        buffer = self._memory.buf
+        self._generation += 1
+        _HEADER.pack_into(buffer, 0, 0, game_state.turn_number, mobiles,
+            game_state.my_health, game_state.get_resource(game_state.SP, 0), game_state.get_resource(game_state.MP, 0), game_state.my_time,
+            game_state.enemy_health, game_state.get_resource(game_state.SP, 1), game_state.get_resource(game_state.MP, 1), game_state.enemy_time)
+        offset = _TILES
+        for values in (board.health, board.unit_type, board.owner, board.upgraded, board.pending_removal):
+            data = bytes(values)
+            buffer[offset:offset + len(data)] = data
+            offset += len(data)
+        for values in (board.mobile_health, board.mobile_tile, board.mobile_type, board.mobile_owner):
+            data = bytes(values[:mobiles])
+            buffer[offset:offset + len(data)] = data
+            offset += values.itemsize * self.max_mobile_units
+        _HEADER.pack_into(buffer, 0, self._generation, *_HEADER.unpack_from(buffer, 0)[1:])
+
+    def evaluate(self, plans, timeout=None):
+        """Scores plans on the published board, waiting at most timeout seconds
+
+        Args:
+            plans: A list of picklable plans, passed one at a time to evaluate_plan
+            timeout: The number of seconds to wait for results, no limit if None
+
+        Returns:
+            A list with the result of each plan in the same order, None for plans that did not finish in time,
+            raised an exception or whose worker died, or None if no board was published
+
+        """
+        if self._generation == 0:
+            self.warn("Publish a GameState before evaluating plans")
+            return None
+        self.replace_workers()
+        end = None if timeout is None else time.monotonic() + timeout
+        results = [None] * len(plans)
+        pending = len(plans)
+        queued = 0
+        running = {}
+        while pending:
+            remaining = _POLL if end is None else min(_POLL, end - time.monotonic())
+            if remaining <= 0:
+                break
+            for slot in range(self.processes):
+                if slot in running or slot in self._abandoned or queued == len(plans):
+                    continue
+                try:
+                    self._connections[slot].send((self._generation, plans[queued]))
+                except OSError:
+                    self.__abandon(slot)
+                    continue
+                except Exception as error:
+                    self.warn("Plan {} could not be sent to a worker: {}".format(plans[queued], error))
+                    pending -= 1
+                else:
+                    running[slot] = queued
+                queued += 1
+            if not running:
+                if len(self._abandoned) == self.processes:
+                    self.warn("Every worker died, {} plans were not scored".format(pending))
+                    break
+                continue
+            ready = wait([self._connections[slot] for slot in running], remaining)
+            for slot, index in list(running.items()):
+                if self._connections[slot] in ready:
+                    try:
+                        results[index] = self._connections[slot].recv()
+                    except (EOFError, OSError):
+                        self.warn("A worker died scoring plan {}".format(plans[index]))
+                        self.__abandon(slot)
+                elif self._workers[slot].is_alive():
+                    continue
+                else:
+                    self.warn("A worker died scoring plan {}".format(plans[index]))
+                    self.__abandon(slot)
+                del running[slot]
+                pending -= 1
+        for slot in running:
+            self.__abandon(slot)
+        self.missed = pending
+        return results
+
+    def replace_workers(self):
+        """Starts new workers in place of the ones that died or were abandoned by evaluate
+
+        publish and evaluate call it first, call it yourself to fork outside of the turn, for example from on_action_frame.
+        """
+        for slot in sorted(self._abandoned):
+            self.__stop(slot)
+            self.__spawn(slot)
+        self._abandoned.clear()
+
+    def close(self):
+        """Stops the workers and frees the shared memory
+        """
+        if self._memory is None:
+            return
+        for connection in self._connections:
+            try:
+                connection.send(None)
+            except OSError:
+                pass
+        for slot in range(self.processes):
+            self.__stop(slot)
+        self._abandoned.clear()
+        self._memory.close()
+        self._memory.unlink()
+        self._memory = None
+
+    def __spawn(self, slot):
+        connection, child = self._context.Pipe()
+        worker = self._context.Process(target=_work, args=(self.config, self._memory, self.max_mobile_units, child, self._evaluate_plan), daemon=True)
+        worker.start()
+        child.close()
+        self._workers[slot] = worker
+        self._connections[slot] = connection
+
+    def __stop(self, slot):
+        worker = self._workers[slot]
+        worker.join(0.1)
+        if worker.is_alive():
+            worker.terminate()
+            worker.join(0.1)
+        if worker.is_alive():
+            worker.kill()
+            worker.join()
+        self._connections[slot].close()
+
+    def __abandon(self, slot):
+        """Sends SIGTERM to a worker that died or is still running an abandoned plan, replace_workers reaps it later
+        """
+        self._workers[slot].terminate()
+        self._abandoned.add(slot)
+
+    def warn(self, message):
+        """
+        Used internally by EvaluationPool to print out default messaging
+        """
+        if(self.enable_warnings):
+            debug_write(message)
+
+
+def _load_snapshot(config, buffer, generation, max_mobile_units):
+    """Rebuilds the published board as a GameState, or returns None if it changed while being read
+    """
+    header = _HEADER.unpack_from(buffer, 0)
+    if header[0] != generation:
+        return None
+    turn_number, mobiles = header[1:3]
+    board = CompactBoard(config)
+    offset = _TILES
+    for name in ("health", "unit_type", "owner"):
+        values = array(getattr(board, name).typecode)
+        values.frombytes(buffer[offset:offset + values.itemsize * NUM_TILES])
+        setattr(board, name, values)
+        offset += values.itemsize * NUM_TILES
+    for name in ("upgraded", "pending_removal"):
+        setattr(board, name, bytearray(buffer[offset:offset + NUM_TILES]))
+        offset += NUM_TILES
+    for name in ("mobile_health", "mobile_tile", "mobile_type", "mobile_owner"):
+        values = getattr(board, name)
+        values.frombytes(buffer[offset:offset + values.itemsize * mobiles])
+        offset += values.itemsize * max_mobile_units
+    if _HEADER.unpack_from(buffer, 0)[0] != generation:
+        return None
+
+    stats = header[3:]
+    state = json.dumps({"turnInfo": [0, turn_number, -1], "p1Stats": list(stats[:4]), "p2Stats": list(stats[4:]), "p1Units": [], "p2Units": []})
+    game_state = GameState(config, state)
+    tiles = set(board.mobile_tile)
+    tiles.update(tile for tile in range(NUM_TILES) if board.unit_type[tile] != EMPTY)
+    for tile in sorted(tiles):
+        for unit in board[tile % geometry.ARENA_SIZE, tile // geometry.ARENA_SIZE]:
+            game_state.game_map._place_unit(unit)
+    return game_state
+
+
+def _work(config, memory, max_mobile_units, connection, evaluate_plan):
+    """The loop of a worker process, see EvaluationPool
+
+    Every plan received gets a result sent back, None if the board could not be loaded or the plan failed.
+    """
+    game_state = None
+    loaded = None
+    while True:
+        try:
+            task = connection.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        generation, plan = task
+        result = None
+        try:
+            if loaded != generation:
+                loaded = None
+                game_state = _load_snapshot(config, memory.buf, generation, max_mobile_units)
+                if game_state is not None:
+                    game_state.suppress_warnings(True)
+                    loaded = generation
+            if loaded == generation:
+                savepoint = game_state.savepoint()
+                try:
+                    result = evaluate_plan(game_state, plan)
+                finally:
+                    game_state.rollback(savepoint)
+        except BaseException:
+            debug_write("Plan {} failed:\n{}".format(plan, traceback.format_exc()))
+            result = None
+            loaded = None
+        try:
+            connection.send(result)
+        except OSError:
+            break
+        except Exception:
+            debug_write("The result of plan {} could not be sent:\n{}".format(plan, traceback.format_exc()))
+            connection.send(None)
@@ -0,0 +1,208 @@
+from collections import namedtuple
+
+from .transposition import TranspositionCache
+
+
+UnitStats = namedtuple("UnitStats", ["unit_type", "upgraded", "stationary", "speed", "damage_f", "damage_i", "attackRange",
+    "shieldRange", "max_health", "shieldPerUnit", "shieldBonusPerY", "cost"])
+UnitStats.__doc__ = """The stats shared by every unit of one type, either upgraded or not. See GameUnit for what the fields mean.
+"""
+
+
+def build_stat_table(config):
+    """Reads the stats of every unit type out of a game config
+
+    Args:
+        config (JSON): Contains information about the game
+
+    Returns:
+        A dict mapping (unit_type, upgraded) to an immutable UnitStats record
+
+    """
+    table = {}
+    for type_config in config["unitInformation"]:
+        unit_type = type_config.get("shorthand")
+        cost = (type_config.get("cost1", 0), type_config.get("cost2", 0))
+        base = UnitStats(
+            unit_type=unit_type,
+            upgraded=False,
+            stationary=type_config.get("unitCategory") == 0,
+            speed=type_config.get("speed", 0),
+            damage_f=type_config.get("attackDamageTower", 0),
+            damage_i=type_config.get("attackDamageWalker", 0),
+            attackRange=type_config.get("attackRange", 0),
+            shieldRange=type_config.get("shieldRange", 0),
+            max_health=type_config.get("startHealth", 0),
+            shieldPerUnit=type_config.get("shieldPerUnit", 0),
+            shieldBonusPerY=type_config.get("shieldBonusPerY", 0),
+            cost=cost)
+        upgrade_config = type_config.get("upgrade", {})
+        upgraded = base._replace(
+            upgraded=True,
+            speed=upgrade_config.get("speed", base.speed),
+            damage_f=upgrade_config.get("attackDamageTower", base.damage_f),
+            damage_i=upgrade_config.get("attackDamageWalker", base.damage_i),
+            attackRange=upgrade_config.get("attackRange", base.attackRange),
+            shieldRange=upgrade_config.get("shieldRange", base.shieldRange),
+            max_health=upgrade_config.get("startHealth", base.max_health),
+            shieldPerUnit=upgrade_config.get("shieldPerUnit", base.shieldPerUnit),
+            shieldBonusPerY=upgrade_config.get("shieldBonusPerY", base.shieldBonusPerY),
+            cost=(upgrade_config.get("cost1", 0) + cost[0], upgrade_config.get("cost2", 0) + cost[1]))
+        table[unit_type, False] = base
+        table[unit_type, True] = upgraded
+    return table
+
+
+class Ruleset:
+    """The rules of a game, compiled once from its config
+
+    GameState, GameMap and GameUnit all read the rules from the Ruleset of their config instead of
+    module globals, so game states built from different configs can be used side by side.
+    Use Ruleset.for_config to get the shared Ruleset of a config.
+
+    Attributes :
+        * config (JSON): The config the rules were read from
+        * WALL, SUPPORT, TURRET, SCOUT, DEMOLISHER, INTERCEPTOR, REMOVE, UPGRADE (str): The unit type shorthands
+        * UNIT_TYPE_TO_INDEX (dict): Maps a unit type to its index in the config
+        * STRUCTURE_TYPES (list): The structure unit types
+        * ALL_UNITS (list): The unit types that can be spawned
+        * MP (int): A constant representing the Mobile Points resource
+        * SP (int): A constant representing the Structure Points resource
+        * stats (dict): Maps (unit_type, upgraded) to the shared UnitStats record
+        * costs (dict): Maps a unit type to its [SP, MP] cost
+        * upgrade_costs (dict): Maps a unit type to the [SP, MP] cost of upgrading it
+        * hit_radius (float): The getHitRadius of the units
+        * max_attack_range (float): The longest attack range of any unit, upgraded or not
+        * max_shield_range (float): The longest shield range of any unit, upgraded or not
+        * ranges (frozenset): Every distinct attack, shield and self destruct range in the config
+        * self_destruct (dict): Maps a mobile unit type to its (range, damage to mobile units, damage to structures, steps required) when it self destructs
+        * breach (dict): Maps a mobile unit type to the (damage to the enemy, SP reward) of it reaching its edge
+        * refund_percentage (dict): Maps a structure type to the part of its SP cost removing it refunds, before scaling by health
+        * resources (dict): The resource schedule from the config
+
+    """
+    _rulesets = TranspositionCache(16)
+
+    def __init__(self, config):
+        """Compiles the rules of a config
+
+        Args:
+            config (JSON): Contains information about the game
+
+        """
+        self.config = config
+        unit_information = config["unitInformation"]
+        self.UNIT_TYPE_TO_INDEX = {}
+        for index, type_config in enumerate(unit_information):
+            self.UNIT_TYPE_TO_INDEX[type_config.get("shorthand")] = index
+        self.WALL = unit_information[0]["shorthand"]
+        self.SUPPORT = unit_information[1]["shorthand"]
+        self.TURRET = unit_information[2]["shorthand"]
+        self.SCOUT = unit_information[3]["shorthand"]
+        self.DEMOLISHER = unit_information[4]["shorthand"]
+        self.INTERCEPTOR = unit_information[5]["shorthand"]
+        self.REMOVE = unit_information[6]["shorthand"]
+        self.UPGRADE = unit_information[7]["shorthand"]
+        self.ALL_UNITS = [self.SCOUT, self.DEMOLISHER, self.INTERCEPTOR, self.WALL, self.SUPPORT, self.TURRET]
+        self.STRUCTURE_TYPES = [self.WALL, self.SUPPORT, self.TURRET]
+        self.MP = 1
+        self.SP = 0
+
+        self.stats = build_stat_table(config)
+        self.costs = {}
+        self.upgrade_costs = {}
+        self.hit_radius = unit_information[0].get("getHitRadius", 0)
+        self.max_attack_range = 0
+        self.max_shield_range = 0
+        ranges = set()
+        self.self_destruct = {}
+        self.breach = {}
+        self.refund_percentage = {}
+        for type_config in unit_information:
+            unit_type = type_config.get("shorthand")
+            base = [type_config.get("cost1", 0), type_config.get("cost2", 0)]
+            self.costs[unit_type] = base
+            upgrade_config = type_config.get("upgrade")
+            if upgrade_config is not None:
+                self.upgrade_costs[unit_type] = [upgrade_config.get("cost1", base[self.SP]), upgrade_config.get("cost2", base[self.MP])]
+            for upgraded in (False, True):
+                stats = self.stats[unit_type, upgraded]
+                self.max_attack_range = max(self.max_attack_range, stats.attackRange)
+                self.max_shield_range = max(self.max_shield_range, stats.shieldRange)
+                ranges.add(stats.attackRange)
+                ranges.add(stats.shieldRange)
+            if "selfDestructRange" in type_config:
+                ranges.add(type_config["selfDestructRange"])
+            if type_config.get("unitCategory") == 0:
+                self.refund_percentage[unit_type] = type_config.get("refundPercentage", 0)
+            elif type_config.get("unitCategory") == 1:
+                self.self_destruct[unit_type] = (type_config.get("selfDestructRange", 0), type_config.get("selfDestructDamageWalker", 0), 
+                    type_config.get("selfDestructDamageTower", 0), type_config.get("selfDestructStepsRequired", 0))
+                self.breach[unit_type] = (type_config.get("playerBreachDamage", 1), type_config.get("metalForBreach", 0))
+        self.ranges = frozenset(ranges)
+
+        self.resources = config.get("resources", {})
+
+    @classmethod
+    def for_config(cls, config):
+        """The Ruleset of a config, compiled the first time the config is seen and shared afterwards
+
+        The Rulesets of the last 16 configs are kept, older ones are compiled again when needed.
+
+        Args:
+            config (JSON): Contains information about the game
+
+        """
+        entry = cls._rulesets.get(id(config))
+        if entry is None or entry.config is not config:
+            entry = cls(config)
+            cls._rulesets.put(id(config), entry)
+        return entry
+
+    def is_stationary(self, unit_type):
+        """
+            Args:
+                unit_type: A unit type
+
+            Returns:
+                Boolean, True if the unit is stationary, False otherwise.
+        """
+        return unit_type in self.STRUCTURE_TYPES
+
+    def is_upgradable(self, unit_type):
+        """True if the config has an upgrade for the unit type
+        """
+        return unit_type in self.upgrade_costs
+
+    def type_cost(self, unit_type, upgrade=False):
+        """The [SP, MP] cost of a unit type, or of upgrading it. Returns a new list.
+        """
+        if upgrade:
+            return list(self.upgrade_costs.get(unit_type, self.costs[unit_type]))
+        return list(self.costs[unit_type])
+
+    def MP_gained(self, turn_number):
+        """The MP a player gains at the start of the given turn
+        """
+        ramp_ups = turn_number // self.resources["turnIntervalForBitSchedule"]
+        return self.resources["bitsPerRound"] + self.resources["bitGrowthRate"] * ramp_ups
+
+    def project_MP(self, current_MP, turn_number, turns_in_future=1):
+        """Predicts MP on a future turn, see GameState.project_future_MP
+
+        Args:
+            current_MP: The MP held on turn_number
+            turn_number: The current turn number
+            turns_in_future: The number of turns to look ahead
+
+        Returns:
+            The MP that will be held after the given number of turns
+
+        """
+        MP = current_MP
+        decay = 1 - self.resources["bitDecayPerRound"]
+        for increment in range(1, turns_in_future + 1):
+            MP *= decay
+            MP += self.MP_gained(turn_number + increment)
+            MP = round(MP, 1)
+        return MP
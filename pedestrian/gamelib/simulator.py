@@ -0,0 +1,525 @@
+"""
+A local stand-in for the action phase of the game engine, for trying out deployments before submitting them.
+"""
+
+from . import geometry
+from .coverage import CoverageMap, footprint
+from .navigation import GridPathFinder, PocketIndex
+from .targeting import TargetingEngine
+from .transposition import TranspositionCache
+
+ARENA_SIZE = geometry.ARENA_SIZE
+NUM_TILES = geometry.NUM_TILES
+
+
+class SimUnit:
+    """A unit taking part in a simulated action phase
+
+    Carries the stats of a GameUnit together with the movement state the simulator needs.
+    The stat names match GameUnit, so SimUnits work with TargetingEngine and CoverageMap.
+
+    Attributes :
+        * unit_type, player_index, x, y, health, max_health, stationary, upgraded, pending_removal: As in GameUnit
+        * speed, damage_f, damage_i, attackRange, shieldRange, shieldPerUnit, shieldBonusPerY, cost: As in GameUnit
+        * edge (int): The edge a mobile unit is heading to, see GameState.get_target_edge
+        * direction (int): The direction of the last step, GridPathFinder.HORIZONTAL or VERTICAL, 0 before the first step
+        * progress (float): The part of a step a mobile unit has built up, it steps when this reaches 1
+        * steps (int): The number of steps the unit has taken
+        * shielded (int): A bitboard of the tiles of the supports that already shielded this unit
+
+    """
+    __slots__ = ("unit_type", "player_index", "x", "y", "health", "max_health", "stationary", "upgraded", "pending_removal",
+        "speed", "damage_f", "damage_i", "attackRange", "shieldRange", "shieldPerUnit", "shieldBonusPerY", "cost",
+        "edge", "direction", "progress", "steps", "shielded")
+
+    def __init__(self, stats, player_index, x, y, health=None, pending_removal=False, edge=None):
+        self.unit_type = stats.unit_type
+        self.player_index = player_index
+        self.x = x
+        self.y = y
+        self.max_health = stats.max_health
+        self.health = stats.max_health if health is None else health
+        self.stationary = stats.stationary
+        self.upgraded = stats.upgraded
+        self.pending_removal = pending_removal
+        self.speed = stats.speed
+        self.damage_f = stats.damage_f
+        self.damage_i = stats.damage_i
+        self.attackRange = stats.attackRange
+        self.shieldRange = stats.shieldRange
+        self.shieldPerUnit = stats.shieldPerUnit
+        self.shieldBonusPerY = stats.shieldBonusPerY
+        self.cost = stats.cost
+        self.edge = edge
+        self.direction = 0
+        self.progress = 0.0
+        self.steps = 0
+        self.shielded = 0
+
+    def copy(self):
+        """A copy of the unit, for a new rollout
+        """
+        unit = SimUnit.__new__(SimUnit)
+        for name in SimUnit.__slots__:
+            setattr(unit, name, getattr(self, name))
+        return unit
+
+    def __repr__(self):
+        return "SimUnit({}, player {}, [{}, {}], health {})".format(self.unit_type, self.player_index, self.x, self.y, self.health)
+
+
+class SimulationResult:
+    """The outcome of a simulated action phase
+
+    Attributes :
+        * frames (int): The number of frames simulated
+        * player_health (list): The [your, enemy] health at the end of the round
+        * SP_gained (list): The [your, enemy] SP gained from breaches and structure refunds
+        * breaches (list): A (frame, [x, y], unit_type, player_index) tuple for every unit that reached its edge
+        * self_destructs (list): A (frame, [x, y], unit_type, player_index) tuple for every unit that self destructed
+        * destroyed (list): The SimUnits of the structures destroyed during the round
+        * structures (list): The SimUnits of the structures standing at the end of the round, after removals
+        * survivors (list): The mobile SimUnits still alive, only when the simulation stopped at max_frames
+
+    """
+    def __init__(self, frames, player_health, SP_gained, breaches, self_destructs, destroyed, structures, survivors):
+        self.frames = frames
+        self.player_health = player_health
+        self.SP_gained = SP_gained
+        self.breaches = breaches
+        self.self_destructs = self_destructs
+        self.destroyed = destroyed
+        self.structures = structures
+        self.survivors = survivors
+
+
+class ActionSimulator:
+    """Steps the action phase of a GameState frame by frame
+
+    Each frame follows the order of the game engine:
+        1. Supports shield friendly mobile units in range that they have not shielded yet
+        2. Mobile units that have built up a full step move along the path GridPathFinder gives them,
+           breach if they stand on their edge, or self destruct if they are stuck at the end of their path
+        3. Every unit attacks the target get_target would pick, all attacks of a frame land together
+        4. Units with no health left are removed, and paths are recomputed if a structure died
+
+    The round ends once no mobile units are left. Structures marked for removal are then removed
+    and refunded, scaled by their remaining health.
+
+    The board of the GameState is copied when the simulator is created, so one simulator can run
+    many rollouts, see simulate_batch and simulate_attacks. Distance fields are shared between rollouts
+    that reach the same structure layout, the last 256 layouts are kept in a TranspositionCache.
+    Within a frame, only structures with an enemy in range look for a target, and the units of a stack
+    share their step and their target search.
+
+    Attributes :
+        * game_state (:obj: GameState): The game state the rollouts start from
+        * ruleset (:obj: Ruleset): The rules of the game
+
+    """
+    _MAX_CACHED_LAYOUTS = 256
+
+    def __init__(self, game_state):
+        """Copies the board of a game state
+
+        Args:
+            game_state: The GameState the rollouts start from, including the units already passed to attempt_spawn
+
+        """
+        self.game_state = game_state
+        self.ruleset = game_state.ruleset
+        self._finder = GridPathFinder()
+        self._fields = TranspositionCache(self._MAX_CACHED_LAYOUTS)
+        self._pockets = TranspositionCache(self._MAX_CACHED_LAYOUTS)
+        game_map = game_state.game_map
+        self._start = _Rollout(self)
+        for location in geometry.mask_to_locations(game_map.structure_mask() | game_map.mobile_mask()):
+            for unit in game_map[location]:
+                self._start.add(self.ruleset.stats[unit.unit_type, unit.upgraded], unit.player_index, unit.x, unit.y, unit.health, unit.pending_removal)
+
+    def simulate(self, deploys=None, enemy_deploys=None, max_frames=1000, on_frame=None):
+        """Simulates one action phase
+
+        Args:
+            deploys: A list of (unit_type, location, num) tuples you deploy on top of the game state, num is optional
+            enemy_deploys: The same for the enemy
+            max_frames: The number of frames after which the simulation stops even if mobile units are left
+            on_frame: An optional function called as on_frame(frame, mobile_units, structures) after every frame,
+                with the SimUnits still on the board. The lists must not be changed.
+
+        Returns:
+            A SimulationResult
+
+        """
+        rollout = self._start.copy()
+        for player_index, player_deploys in ((0, deploys), (1, enemy_deploys)):
+            for deploy in player_deploys or ():
+                rollout.deploy(player_index, *deploy)
+        return rollout.run(max_frames, on_frame)
+
+    def simulate_batch(self, scenarios, enemy_deploys=None, max_frames=1000):
+        """Simulates many deployments from the same starting board
+
+        The rollouts share the copied board, the distance fields of every structure layout they reach
+        and the range lookups, so a batch is much cheaper than a simulator per deployment.
+
+        Args:
+            scenarios: A list of deploy lists, see simulate
+            enemy_deploys: The enemy deploys used in every scenario
+            max_frames: The number of frames after which a simulation stops even if mobile units are left
+
+        Returns:
+            A list with the SimulationResult of each scenario, in the same order
+
+        """
+        return [self.simulate(deploys, enemy_deploys, max_frames) for deploys in scenarios]
+
+    def simulate_attacks(self, unit_types=None, counts=(1,), spawn_points=None, player_index=0, max_frames=1000):
+        """Simulates every single spawn point attack, each unit type and stack size from each spawn point on its own
+
+        Args:
+            unit_types: The mobile unit types to try, SCOUT, DEMOLISHER and INTERCEPTOR if None
+            counts: The stack sizes to try
+            spawn_points: The locations to spawn from, every open tile of the edges of player_index if None
+            player_index: The attacking player, 0 for you 1 for the enemy
+
+        Returns:
+            A dict mapping (unit_type, (x, y), count) to the SimulationResult of that attack
+
+        """
+        if unit_types is None:
+            unit_types = [self.ruleset.SCOUT, self.ruleset.DEMOLISHER, self.ruleset.INTERCEPTOR]
+        if spawn_points is None:
+            edges = (geometry.BOTTOM_LEFT, geometry.BOTTOM_RIGHT) if player_index == 0 else (geometry.TOP_LEFT, geometry.TOP_RIGHT)
+            spawn_points = [[x, y] for edge in edges for x, y in geometry.EDGES[edge] if not self._start.blocked[x + y * ARENA_SIZE]]
+        results = {}
+        for unit_type in unit_types:
+            for x, y in spawn_points:
+                for count in counts:
+                    deploys = [(unit_type, [x, y], count)]
+                    if player_index == 0:
+                        results[unit_type, (x, y), count] = self.simulate(deploys, None, max_frames)
+                    else:
+                        results[unit_type, (x, y), count] = self.simulate(None, deploys, max_frames)
+        return results
+
+    def _layout(self, blocked):
+        """The distance fields and pocket index shared by every rollout with the same blocked bitmap
+        """
+        key = bytes(blocked)
+        fields = self._fields.get(key)
+        if fields is None:
+            fields = {}
+            self._fields.put(key, fields)
+        return key, fields
+
+    def _field(self, key, fields, blocked, edge, tile):
+        """The distance field a unit on tile heading to edge follows, computed once per layout.
+        Units sealed away from their edge follow the field of their pocket instead.
+        """
+        field = fields.get(edge)
+        if field is None:
+            field = fields[edge] = self._finder.distance_field(geometry.EDGES[edge], blocked)
+        if field[tile] >= 0:
+            return field
+        pockets = self._pockets.get(key)
+        if pockets is None:
+            pockets = PocketIndex(bytearray(blocked))
+            self._pockets.put(key, pockets)
+        pocket_key = (edge, pockets.labels[tile])
+        field = fields.get(pocket_key)
+        if field is None:
+            field = fields[pocket_key] = pockets.pocket_field(tile, geometry.EDGES[edge])
+        return field
+
+
+class _Rollout:
+    """The board of one simulated action phase. It offers the parts of the GameMap interface TargetingEngine uses.
+    """
+    def __init__(self, simulator, empty=True):
+        self.simulator = simulator
+        self.ruleset = simulator.ruleset
+        self.hit_radius = self.ruleset.hit_radius
+        self.player_health = [simulator.game_state.my_health, simulator.game_state.enemy_health]
+        self.SP_gained = [0, 0]
+        self.breaches = []
+        self.self_destructs = []
+        self.destroyed = []
+        self.layout_changed = True
+        self.targeting = TargetingEngine(self)
+        if not empty:
+            return
+        self.tiles = {}
+        self.structures = {}
+        self.mobiles = []
+        self.structure_masks = [0, 0]
+        self.mobile_masks = [0, 0]
+        self.blocked = bytearray(NUM_TILES)
+        self.shielders = ([0] * NUM_TILES, [0] * NUM_TILES)
+        self.shields = {}
+        self.reach = ([0] * NUM_TILES, [0] * NUM_TILES)
+        self.sieges = set()
+
+    def copy(self):
+        """A rollout with copies of the units of this one, before any frame was simulated
+        """
+        rollout = _Rollout(self.simulator, False)
+        rollout.tiles = {}
+        rollout.structures = {}
+        rollout.mobiles = []
+        for tile, units in self.tiles.items():
+            copies = [unit.copy() for unit in units]
+            rollout.tiles[tile] = copies
+            for unit in copies:
+                if unit.stationary:
+                    rollout.structures[tile] = unit
+                else:
+                    rollout.mobiles.append(unit)
+        rollout.structure_masks = list(self.structure_masks)
+        rollout.mobile_masks = list(self.mobile_masks)
+        rollout.blocked = bytearray(self.blocked)
+        rollout.shielders = (list(self.shielders[0]), list(self.shielders[1]))
+        rollout.shields = dict(self.shields)
+        rollout.reach = (list(self.reach[0]), list(self.reach[1]))
+        rollout.sieges = set(self.sieges)
+        return rollout
+
+    def structure_mask(self, player_index):
+        return self.structure_masks[player_index]
+
+    def mobile_mask(self, player_index):
+        return self.mobile_masks[player_index]
+
+    def _tile_units(self, x, y):
+        return self.tiles.get(x + y * ARENA_SIZE, ())
+
+    def add(self, stats, player_index, x, y, health=None, pending_removal=False):
+        tile = x + y * ARENA_SIZE
+        if stats.stationary:
+            unit = SimUnit(stats, player_index, x, y, health, pending_removal)
+            self.structures[tile] = unit
+            self.blocked[tile] = 1
+            self.layout_changed = True
+            if player_index in (0, 1):
+                self.structure_masks[player_index] |= 1 << tile
+                if unit.shieldRange > 0:
+                    amount = CoverageMap.shield_amount(unit, y)
+                    if amount > 0:
+                        self.shields[tile] = (amount, footprint(x, y, unit.shieldRange, self.hit_radius))
+                        for covered in self.shields[tile][1]:
+                            self.shielders[player_index][covered] |= 1 << tile
+            if unit.damage_f > 0 or (unit.damage_i > 0 and player_index not in (0, 1)):
+                self.sieges.add(tile)
+            elif unit.damage_i > 0:
+                self.update_reach(unit, tile, True)
+        else:
+            unit = SimUnit(stats, player_index, x, y, health, edge=self.simulator.game_state.get_target_edge([x, y]))
+            self.mobiles.append(unit)
+            if player_index in (0, 1):
+                self.mobile_masks[player_index] |= 1 << tile
+        self.tiles.setdefault(tile, []).append(unit)
+        return unit
+
+    def deploy(self, player_index, unit_type, location, num=1):
+        x, y = location
+        stats = self.ruleset.stats.get((unit_type, False))
+        if stats is None or not geometry.in_arena_bounds(location):
+            self.simulator.game_state.warn("Could not simulate {} at {}".format(unit_type, location))
+            return
+        tile = x + y * ARENA_SIZE
+        if tile in self.structures:
+            self.simulator.game_state.warn("Could not simulate {} at {}, the location is blocked".format(unit_type, location))
+            return
+        if stats.stationary:
+            if not self.tiles.get(tile):
+                self.add(stats, player_index, x, y)
+            return
+        for _ in range(num):
+            self.add(stats, player_index, x, y)
+
+    def run(self, max_frames, on_frame=None):
+        frame = 0
+        while self.mobiles and frame < max_frames:
+            self.shield()
+            self.move(frame)
+            self.attack()
+            if on_frame is not None:
+                on_frame(frame, self.mobiles, list(self.structures.values()))
+            frame += 1
+        survivors = list(self.mobiles)
+        structures = []
+        for unit in self.structures.values():
+            if unit.pending_removal:
+                refund = self.ruleset.refund_percentage.get(unit.unit_type, 0) * unit.cost[0] * unit.health / unit.max_health
+                if unit.player_index in (0, 1):
+                    self.SP_gained[unit.player_index] += refund
+            else:
+                structures.append(unit)
+        return SimulationResult(frame, self.player_health, self.SP_gained, self.breaches, self.self_destructs, self.destroyed, structures, survivors)
+
+    def shield(self):
+        shields = self.shields
+        for unit in self.mobiles:
+            if unit.player_index not in (0, 1):
+                continue
+            bits = self.shielders[unit.player_index][unit.x + unit.y * ARENA_SIZE] & ~unit.shielded
+            if not bits:
+                continue
+            unit.shielded |= bits
+            while bits:
+                low = bits & -bits
+                unit.health += shields[low.bit_length() - 1][0]
+                bits ^= low
+
+    def move(self, frame):
+        simulator = self.simulator
+        finder = simulator._finder
+        if self.layout_changed:
+            self.layout_key, self.fields = simulator._layout(self.blocked)
+            self.layout_changed = False
+        blocked = self.blocked
+        dead = False
+        next_tiles = {}
+        for unit in self.mobiles:
+            unit.progress += unit.speed
+            if unit.progress < 1:
+                continue
+            unit.progress -= 1
+            tile = unit.x + unit.y * ARENA_SIZE
+            field = simulator._field(self.layout_key, self.fields, blocked, unit.edge, tile)
+            if field[tile] == 0:
+                if tile in geometry.EDGE_INDICES[unit.edge]:
+                    self.breach(unit, frame)
+                else:
+                    self.self_destruct(unit, frame)
+                unit.health = 0
+                dead = True
+                continue
+            # Units of a stack share their tile, edge and last direction, so they share their next step
+            key = (tile, unit.edge, unit.direction)
+            next_tile = next_tiles.get(key)
+            if next_tile is None:
+                next_tile = next_tiles[key] = finder._choose_next_move(tile, unit.direction, finder._idealness_weights(geometry.EDGES[unit.edge]), blocked, field)
+            unit.direction = finder.VERTICAL if next_tile % ARENA_SIZE == unit.x else finder.HORIZONTAL
+            self.relocate(unit, tile, next_tile)
+            unit.steps += 1
+        if dead:
+            self.remove_dead()
+
+    def relocate(self, unit, tile, next_tile):
+        units = self.tiles[tile]
+        units.remove(unit)
+        player_index = unit.player_index
+        if player_index in (0, 1):
+            if not any(other.player_index == player_index and not other.stationary for other in units):
+                self.mobile_masks[player_index] &= ~(1 << tile)
+            self.mobile_masks[player_index] |= 1 << next_tile
+        unit.x = next_tile % ARENA_SIZE
+        unit.y = next_tile // ARENA_SIZE
+        self.tiles.setdefault(next_tile, []).append(unit)
+
+    def breach(self, unit, frame):
+        damage, reward = self.ruleset.breach.get(unit.unit_type, (1, 0))
+        self.breaches.append((frame, [unit.x, unit.y], unit.unit_type, unit.player_index))
+        if unit.player_index in (0, 1):
+            self.player_health[1 - unit.player_index] -= damage
+            self.SP_gained[unit.player_index] += reward
+
+    def self_destruct(self, unit, frame):
+        radius, damage_i, damage_f, steps_required = self.ruleset.self_destruct.get(unit.unit_type, (0, 0, 0, 0))
+        self.self_destructs.append((frame, [unit.x, unit.y], unit.unit_type, unit.player_index))
+        if unit.steps < steps_required:
+            return
+        for x, y, _ in geometry.tiles_in_range((unit.x, unit.y), radius, self.hit_radius):
+            for other in self.tiles.get(x + y * ARENA_SIZE, ()):
+                if other.player_index != unit.player_index:
+                    other.health -= damage_f if other.stationary else damage_i
+
+    def update_reach(self, unit, tile, add):
+        """Keeps a bitboard per tile of the structures that could target a mobile unit on it, 
+        so each frame only the structures near an enemy look for a target
+        """
+        reach = self.reach[unit.player_index]
+        bit = 1 << tile
+        mask = geometry.range_mask((unit.x, unit.y), unit.attackRange, self.hit_radius)
+        while mask:
+            low = mask & -mask
+            if add:
+                reach[low.bit_length() - 1] |= bit
+            else:
+                reach[low.bit_length() - 1] &= ~bit
+            mask ^= low
+
+    def attack(self):
+        # Mobile units that would pick the same target are grouped, so a stack looks for its target once
+        groups = {}
+        attackers = []
+        members = []
+        for unit in self.mobiles:
+            if unit.damage_i <= 0 and unit.damage_f <= 0:
+                continue
+            key = (unit.x, unit.y, unit.player_index, unit.attackRange, unit.damage_i > 0, unit.damage_f > 0)
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = []
+                attackers.append(unit)
+                members.append(group)
+            group.append(unit)
+        for tile in self.sieges:
+            if tile in self.structures:
+                attackers.append(self.structures[tile])
+                members.append((self.structures[tile],))
+        bits = 0
+        for player_index in (0, 1):
+            reach = self.reach[player_index]
+            enemies = self.mobile_masks[1 - player_index]
+            while enemies:
+                low = enemies & -enemies
+                bits |= reach[low.bit_length() - 1]
+                enemies ^= low
+        structures = self.structures
+        while bits:
+            low = bits & -bits
+            structure = structures[low.bit_length() - 1]
+            attackers.append(structure)
+            members.append((structure,))
+            bits ^= low
+        dead = False
+        for group, target in zip(members, self.targeting.get_targets(attackers)):
+            if target is None:
+                continue
+            for attacker in group:
+                target.health -= attacker.damage_f if target.stationary else attacker.damage_i
+            if target.health <= 0:
+                dead = True
+        if dead:
+            self.remove_dead()
+
+    def remove_dead(self):
+        alive = []
+        for unit in self.mobiles:
+            if unit.health > 0:
+                alive.append(unit)
+                continue
+            tile = unit.x + unit.y * ARENA_SIZE
+            units = self.tiles[tile]
+            units.remove(unit)
+            if unit.player_index in (0, 1) and not any(other.player_index == unit.player_index and not other.stationary for other in units):
+                self.mobile_masks[unit.player_index] &= ~(1 << tile)
+        self.mobiles = alive
+        for tile, unit in list(self.structures.items()):
+            if unit.health > 0:
+                continue
+            del self.structures[tile]
+            self.tiles[tile].remove(unit)
+            self.blocked[tile] = 0
+            self.layout_changed = True
+            self.destroyed.append(unit)
+            if unit.player_index in (0, 1):
+                self.structure_masks[unit.player_index] &= ~(1 << tile)
+                if unit.damage_i > 0 and unit.damage_f <= 0:
+                    self.update_reach(unit, tile, False)
+                shield = self.shields.pop(tile, None)
+                if shield is not None:
+                    for covered in shield[1]:
+                        self.shielders[unit.player_index][covered] &= ~(1 << tile)
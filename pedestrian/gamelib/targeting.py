@@ -0,0 +1,132 @@
+"""
+Target selection for structures and mobile units, following the priority rules of GameState.get_target.
+"""
+
+from . import geometry
+
+ARENA_SIZE = geometry.ARENA_SIZE
+CENTER_X = geometry.HALF_ARENA - 0.5
+
+_shells = {}
+
+
+def range_shells(x, y, radius, hit_radius=0):
+    """The in-arena tiles in range of (x, y), grouped into shells of equal distance, nearest first
+
+    Shells are cached per (x, y, radius, hit_radius), do not modify them.
+
+    Args:
+        x, y: The center of the area
+        radius: The radius of the area
+        hit_radius: The getHitRadius from the game config
+
+    Returns:
+        A tuple of (distance, tiles) pairs, where tiles is a tuple of flat tile indices in range_stencil order
+
+    """
+    key = (x, y, radius, hit_radius)
+    shells = _shells.get(key)
+    if shells is None:
+        shells = []
+        for nx, ny, distance in geometry.tiles_in_range((x, y), radius, hit_radius):
+            if not shells or shells[-1][0] != distance:
+                shells.append((distance, []))
+            shells[-1][1].append(nx + ny * ARENA_SIZE)
+        shells = tuple((distance, tuple(tiles)) for distance, tiles in shells)
+        _shells[key] = shells
+    return shells
+
+
+class TargetingEngine:
+    """Picks the targets of attacking units the way GameState.get_target does, without scanning every tile in range
+
+    Mobile units are always preferred over structures and nearer units over farther ones, so the engine
+    walks the distance shells around an attacker, nearest first, and stops at the first shell with a valid target.
+    Only the tiles the structure and mobile bitboards of the GameMap mark as occupied by an enemy are looked at.
+
+    Units with a player_index other than 0 or 1 are not in the bitboards and are never targeted.
+
+    Attributes :
+        * game_map (:obj: GameMap): The map the targets are looked up on
+        * hit_radius (float): The getHitRadius from the game config
+
+    """
+    def __init__(self, game_map):
+        self.game_map = game_map
+        self.hit_radius = game_map.ruleset.hit_radius
+
+    def get_target(self, attacking_unit):
+        """The unit attacking_unit would attack on the current map, see GameState.get_target
+
+        Args:
+            attacking_unit: A GameUnit
+
+        Returns:
+            The GameUnit this unit would choose to attack, or None
+
+        """
+        return self.get_targets([attacking_unit])[0]
+
+    def get_targets(self, attackers):
+        """The targets of many attackers on the same map, for example every unit on one frame.
+        The bitboards are read once and the units of each tile are fetched once for all attackers.
+
+        Args:
+            attackers: A list of GameUnits
+
+        Returns:
+            A list with the target of each attacker, or None, in the same order
+
+        """
+        game_map = self.game_map
+        mobiles = (game_map.mobile_mask(0), game_map.mobile_mask(1))
+        structures = (game_map.structure_mask(0), game_map.structure_mask(1))
+        tiles = {}
+        targets = []
+        for attacker in attackers:
+            player = attacker.player_index
+            if player in (0, 1):
+                enemy_mobiles = mobiles[1 - player]
+                enemy_structures = structures[1 - player]
+            else:
+                enemy_mobiles = mobiles[0] | mobiles[1]
+                enemy_structures = structures[0] | structures[1]
+            reach = geometry.range_mask((attacker.x, attacker.y), attacker.attackRange, self.hit_radius)
+            target = None
+            if attacker.damage_i > 0 and enemy_mobiles & reach:
+                target = self.__nearest(attacker, enemy_mobiles & reach, False, tiles)
+            if target is None and attacker.damage_f > 0 and enemy_structures & reach:
+                target = self.__nearest(attacker, enemy_structures & reach, True, tiles)
+            targets.append(target)
+        return targets
+
+    def __nearest(self, attacker, mask, stationary, tiles):
+        player = attacker.player_index
+        lowest_y_first = player == 0
+        for _, shell in range_shells(attacker.x, attacker.y, attacker.attackRange, self.hit_radius):
+            target = None
+            for tile in shell:
+                if not mask >> tile & 1:
+                    continue
+                units = tiles.get(tile)
+                if units is None:
+                    units = tiles[tile] = self.game_map._tile_units(tile % ARENA_SIZE, tile // ARENA_SIZE)
+                for unit in units:
+                    if unit.player_index == player or unit.stationary != stationary:
+                        continue
+                    if target is None:
+                        target = unit
+                        continue
+                    if unit.health != target.health:
+                        if unit.health < target.health:
+                            target = unit
+                        continue
+                    if unit.y != target.y:
+                        if (unit.y < target.y) == lowest_y_first:
+                            target = unit
+                        continue
+                    if abs(CENTER_X - unit.x) > abs(CENTER_X - target.x):
+                        target = unit
+            if target is not None:
+                return target
+        return None
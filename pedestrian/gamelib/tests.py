@@ -1,7 +1,24 @@
 import unittest
+import os
 import json
-from .game_state import GameState
+import random
+import tempfile
+import time
+import io
+import contextlib
+import threading
+from unittest import mock
+from .game_state import GameState, is_stationary
 from .unit import GameUnit
+from .ruleset import Ruleset
+from .navigation import ShortestPathFinder, GridPathFinder, IncrementalPathFinder
+from .board import CompactBoard
+from .simulator import ActionSimulator
+from .calibration import calibrate_replay, load_replay, recorded_turns, summarize
+from .transposition import TranspositionCache, zobrist_key
+from .pool import EvaluationPool
+from .algocore import AlgoCore
+from . import geometry
 
 class BasicTests(unittest.TestCase):
 
@@ -235,11 +252,106 @@ class BasicTests(unittest.TestCase):
             game.game_map.add_unit("FF", [13,13])
         self.assertEqual(1, len(game.game_map[13,13]), "Towers seem to be stacking")
         
+    def test_map_iteration(self):
+        game = self.make_turn_0_map()
+        locations = list(game.game_map)
+        self.assertEqual(420, len(locations), "The arena should have 420 locations")
+        self.assertEqual([13, 0], locations[0], "Iteration should start at the bottom of the arena")
+        self.assertEqual([14, 27], locations[-1], "Iteration should end at the top of the arena")
+        self.assertTrue(all(game.game_map.in_arena_bounds(location) for location in locations), "Iterated over an out of bounds location")
+        pairs = sum(1 for _ in game.game_map for _ in game.game_map)
+        self.assertEqual(420 * 420, pairs, "Nested loops over the map should not share a cursor")
+
+    def test_structure_index(self):
+        game = self.make_turn_0_map()
+        game.game_map.add_unit("DF", [13, 13], 0)
+        game.game_map.add_unit("DF", [14, 14], 1)
+        game.game_map.add_unit("FF", [15, 14], 1)
+        game.game_map.add_unit("PI", [13, 0], 0)
+        self.assertEqual(3, game.game_map.count_structures(), "Mobile units should not be indexed")
+        self.assertEqual(2, game.game_map.count_structures(1), "Wrong number of enemy structures")
+        self.assertEqual([[14, 14]], [[unit.x, unit.y] for unit in game.game_map.get_structures(1, "DF")], "Wrong enemy turrets")
+        game.game_map.add_unit("FF", [14, 14], 1)
+        self.assertEqual(0, game.game_map.count_structures(1, "DF"), "Replaced structure is still indexed")
+        game.game_map.remove_unit([15, 14])
+        self.assertEqual(1, game.game_map.count_structures(1), "Removed structure is still indexed")
+        game.game_map[13, 13] = []
+        self.assertEqual(0, game.game_map.count_structures(0), "Overwritten tile is still indexed")
+
+        turn = json.loads(game.serialized_string)
+        turn["p2Units"][2] = [[14, 14, 90.0, "1"], [13, 15, 90.0, "2"]]
+        turn["p1Units"][0] = [[13, 1, 75.0, "3"]]
+        parsed = GameState(game.config, json.dumps(turn))
+        self.assertEqual(2, parsed.game_map.count_structures(1, "DF"), "Parsed structures are not indexed")
+        self.assertEqual(1, parsed.game_map.count_structures(0), "Parsed structures are not indexed")
+
+    def test_structure_bitboards(self):
+        game = self.make_random_board(3)
+        for player_index in [None, 0, 1]:
+            for unit_type in [None, "FF", "DF"]:
+                expected = sorted([unit.x, unit.y] for unit in game.game_map.get_structures(player_index, unit_type))
+                mask = game.structure_mask(player_index, unit_type)
+                self.assertEqual(expected, sorted(geometry.mask_to_locations(mask)), "Bitboard differs from the structure index")
+                self.assertEqual(len(expected), geometry.popcount(mask), "Wrong popcount")
+        for location in game.game_map:
+            self.assertEqual(bool(game.contains_stationary_unit(location)), any(unit.stationary for unit in game.game_map[location]), "Wrong answer at {}".format(location))
+        self.assertEqual(GridPathFinder().blocked_from_game_state(game), geometry.mask_to_bytearray(game.structure_mask()), "Blocked map differs from the bitboard")
+
+        game.game_map.remove_unit([13, 13])
+        game.game_map.add_unit("DF", [13, 13], 1)
+        self.assertTrue(game.structure_mask(1, "DF") & geometry.location_mask([13, 13]), "Added turret is missing from the bitboard")
+        game.game_map.remove_unit([13, 13])
+        self.assertFalse(game.structure_mask() & geometry.location_mask([13, 13]), "Removed turret is still in the bitboard")
+
+        self.assertEqual(28, len(geometry.mask_to_locations(geometry.ROW_MASKS[13])), "Row 13 should be full width")
+        open_left = geometry.lane_mask(0, 5) & ~game.structure_mask()
+        self.assertEqual(sorted(location for location in game.game_map if location[0] <= 5 and not game.contains_stationary_unit(location)),
+            sorted(geometry.mask_to_locations(open_left)), "Wrong open tiles in the left lane")
+        self.assertEqual(sorted(game.game_map.get_locations_in_range([13, 13], 3.5)), sorted(geometry.mask_to_locations(geometry.range_mask([13, 13], 3.5, 0.01))), "Wrong range mask")
+
+    def test_compact_board(self):
+        game = self.make_turn_0_map()
+        turn = json.loads(game.serialized_string)
+        turn["p2Units"][2] = [[14, 14, 90.0, "1"], [13, 17, 60.0, "2"], [13, 20, 75.0, "3"]]
+        turn["p2Units"].append([[13, 17, 0, "2"]])
+        turn["p1Units"][3] = [[13, 0, 15.0, "4"], [13, 0, 15.0, "5"]]
+        serialized = json.dumps(turn)
+        board = CompactBoard.from_serialized(game.config, serialized)
+        self.assertEqual(150.0, board.total_health(1, "DF", rows=range(14, 18)), "Wrong enemy turret health in rows 14 to 17")
+        self.assertEqual(3, board.count_structures(1), "Wrong number of enemy structures")
+        self.assertEqual(2, len(board[13, 0]), "Mobile units are missing")
+        self.assertTrue(board[13, 17][0].upgraded, "Upgraded turret is not upgraded")
+        self.assertIs(board[13, 17], board[13, 17], "Units should only be created once per tile")
+
+        parsed = GameState(game.config, serialized)
+        copied = CompactBoard.from_game_map(parsed.game_map)
+        for location in parsed.game_map:
+            self.assertEqual(str(parsed.game_map[location]), str(copied[location]), "Board differs from the map at {}".format(location))
+
+        board.add_unit("FF", [14, 14], 1)
+        self.assertEqual("FF", board[14, 14][0].unit_type, "Stale unit after replacing a structure")
+        board.remove_unit([13, 0])
+        self.assertEqual([], board[13, 0], "Mobile units were not removed")
+
     def test_get_units_in_range(self):
         game = self.make_turn_0_map()
         self.assertEqual(1, len(game.game_map.get_locations_in_range([13,13], 0)), "We should be in 0 range of ourself")
         self.assertEqual(37, len(game.game_map.get_locations_in_range([13,13], 3.5)), "Wrong number of tiles in range")
 
+    def test_range_stencil(self):
+        game = self.make_turn_0_map()
+        for location in [[13, 13], [0, 13], [13, 0], [20, 20]]:
+            for radius in [0, 1, 1.5, 2.5, 3.5, 4.5, 7]:
+                expected = []
+                for x in range(location[0] - 8, location[0] + 9):
+                    for y in range(location[1] - 8, location[1] + 9):
+                        if game.game_map.in_arena_bounds([x, y]) and game.game_map.distance_between_locations(location, [x, y]) < radius + 0.01:
+                            expected.append([x, y])
+                got = game.game_map.get_locations_in_range(location, radius)
+                self.assertEqual(sorted(expected), sorted(got), "Wrong tiles in range {} of {}".format(radius, location))
+                distances = [game.game_map.distance_between_locations(location, tile) for tile in got]
+                self.assertEqual(sorted(distances), distances, "Tiles in range should be nearest first")
+
     def _test_get_attackers(self):
         game = self.make_turn_0_map()
         
@@ -256,6 +368,228 @@ class BasicTests(unittest.TestCase):
         game.game_map.add_unit("DF", [14,14], 1)
         self.assertEqual(3, len(game.get_attackers([13,13], 0)), "We should be in danger from 3 places")
 
+    def scan_attackers(self, game, location, player_index):
+        attackers = []
+        for x, y, distance in game.game_map.get_tiles_in_range(location, game.ruleset.max_attack_range):
+            for unit in game.game_map[x, y]:
+                if unit.damage_i + unit.damage_f > 0 and unit.player_index != player_index and distance <= unit.attackRange:
+                    attackers.append(unit)
+        return attackers
+
+    def test_coverage_grid(self):
+        game = self.make_turn_0_map()
+        rng = random.Random(7)
+        locations = [location for location in game.game_map]
+        for location in rng.sample(locations, 60):
+            game.game_map.add_unit(rng.choice(["DF", "DF", "FF"]), location, 0 if location[1] < game.HALF_ARENA else 1)
+        for index, unit in enumerate(rng.sample(game.game_map.get_structures(unit_type="DF"), 10)):
+            if index % 2:
+                unit.upgrade()
+            else:
+                game.game_map.upgrade_unit([unit.x, unit.y])
+        game.game_map.remove_unit([13, 13])
+        game.game_map.add_unit("DF", [13, 13], 1)
+        game._player_resources[0]["SP"] = 100
+        for unit in game.game_map.get_structures(0, "DF")[:3]:
+            game.attempt_upgrade([unit.x, unit.y])
+        for location in game.game_map:
+            for player_index in (0, 1):
+                expected = self.scan_attackers(game, location, player_index)
+                self.assertEqual(expected, game.get_attackers(location, player_index), "Wrong attackers at {}".format(location))
+                self.assertEqual(len(expected), game.game_map.get_attacker_count(location, player_index), "Wrong attacker count at {}".format(location))
+                self.assertEqual(sum(unit.damage_i for unit in expected), game.game_map.get_damage_per_frame(location, player_index), "Wrong damage at {}".format(location))
+        path = game.find_path_to_edge([13, 0])
+        self.assertEqual(sum(game.game_map.get_damage_per_frame(location, 0) for location in path), game.game_map.get_path_damage(path, 0), "Wrong path damage")
+
+        game.game_map.add_unit("PI", [13, 14], 1)
+        self.assertEqual(self.scan_attackers(game, [13, 13], 0), game.get_attackers([13, 13], 0), "Mobile attackers are missing")
+        game._player_resources[0]["MP"] = 100
+        game.attempt_spawn("PI", [13, 0])
+        for location in rng.sample(locations, 20):
+            game.game_map.add_unit(rng.choice(["PI", "EI", "SI"]), location, rng.choice([0, 1]))
+        for location in game.game_map:
+            for player_index in (0, 1):
+                self.assertEqual(self.scan_attackers(game, location, player_index), game.get_attackers(location, player_index),
+                    "Wrong attackers with mobile units at {}".format(location))
+
+    def scan_target(self, game, attacking_unit):
+        target = None
+        target_key = None
+        for x, y, distance in game.game_map.get_tiles_in_range([attacking_unit.x, attacking_unit.y], attacking_unit.attackRange):
+            for unit in game.game_map[x, y]:
+                if unit.player_index == attacking_unit.player_index or (attacking_unit.damage_f == 0 and unit.stationary) or (attacking_unit.damage_i == 0 and not unit.stationary):
+                    continue
+                y_key = unit.y if attacking_unit.player_index == 0 else -unit.y
+                key = (unit.stationary, distance, unit.health, y_key, -abs(13.5 - unit.x))
+                if target_key is None or key < target_key:
+                    target, target_key = unit, key
+        return target
+
+    def test_targeting(self):
+        game = self.make_turn_0_map()
+        rng = random.Random(5)
+        locations = [location for location in game.game_map]
+        for location in rng.sample(locations, 200):
+            player_index = rng.randint(0, 1)
+            unit_type = rng.choice(["FF", "EF", "DF", "PI", "EI", "SI"])
+            game.game_map.add_unit(unit_type, location, player_index)
+            if unit_type in ("PI", "EI") and rng.random() < 0.3:
+                game.game_map.add_unit(unit_type, location, player_index)
+        units = [unit for location in game.game_map for unit in game.game_map[location]]
+        for unit in units:
+            unit.health = rng.choice([10.0, 15.0, 20.0])
+        expected = [self.scan_target(game, unit) for unit in units]
+        self.assertTrue(any(target is not None and not target.stationary for target in expected), "The map should have mobile targets")
+        self.assertEqual(expected, [game.get_target(unit) for unit in units], "get_target disagrees with the full scan")
+        self.assertEqual(expected, game.get_targets_batch(units), "get_targets_batch disagrees with the full scan")
+
+        game.game_map.remove_unit([expected[0].x, expected[0].y])
+        self.assertEqual(self.scan_target(game, units[0]), game.get_target(units[0]), "Removed target was still chosen")
+
+    def test_shield_grid(self):
+        game = self.make_turn_0_map()
+        config = json.loads(json.dumps(game.config))
+        config["unitInformation"][1].update({"shieldRange": 3.5, "shieldPerUnit": 3.0, "shieldBonusPerY": 0.5})
+        config["unitInformation"][1]["upgrade"].update({"shieldRange": 7.0, "shieldPerUnit": 4.0})
+        game = GameState(config, game.serialized_string)
+        game.suppress_warnings(True)
+        rng = random.Random(11)
+        locations = [location for location in game.game_map]
+        for location in rng.sample(locations, 12):
+            game.game_map.add_unit("EF", location, 0 if location[1] < game.HALF_ARENA else 1)
+        supports = game.game_map.get_structures(unit_type="EF")
+        supports[0].upgrade()
+        game.game_map.upgrade_unit([supports[2].x, supports[2].y])
+        game.game_map.remove_unit([supports[1].x, supports[1].y])
+        supports = game.game_map.get_structures(unit_type="EF")
+
+        def shield_of(unit):
+            rows = unit.y if unit.player_index == 0 else 27 - unit.y
+            return unit.shieldPerUnit + unit.shieldBonusPerY * rows
+
+        def reaches(unit, location):
+            return game.game_map.distance_between_locations([unit.x, unit.y], location) <= unit.shieldRange
+
+        for location in game.game_map:
+            for player_index in (0, 1):
+                expected = sum(shield_of(unit) for unit in supports if unit.player_index == player_index and reaches(unit, location))
+                self.assertAlmostEqual(expected, game.game_map.get_shield(location, player_index), msg="Wrong shield at {}".format(location))
+        path = game.find_path_to_edge([13, 0])
+        expected = sum(shield_of(unit) for unit in supports if unit.player_index == 0 and any(reaches(unit, location) for location in path))
+        self.assertAlmostEqual(expected, game.game_map.get_path_shield(path, 0), msg="Wrong path shield")
+
+    def test_simulator(self):
+        game = self.make_turn_0_map()
+        simulator = ActionSimulator(game)
+        path = game.find_path_to_edge([13, 0])
+        for frames in (1, 5, 12):
+            result = simulator.simulate([("PI", [13, 0])], max_frames=frames)
+            self.assertEqual(path[frames], [result.survivors[0].x, result.survivors[0].y], "Scout left the path after {} frames".format(frames))
+        result = simulator.simulate([("PI", [13, 0], 3)])
+        self.assertEqual(3, len(result.breaches), "Every scout should breach an empty board")
+        self.assertEqual(path[-1], result.breaches[0][1], "Scout breached at the wrong location")
+        self.assertEqual(([30.0, 27.0], [3.0, 0]), (result.player_health, result.SP_gained), "Wrong breach damage or reward")
+
+        for x in range(28):
+            game.game_map.add_unit("FF", [x, 14], 1)
+        game.game_map[5, 14][0].pending_removal = True
+        simulator = ActionSimulator(game)
+        result = simulator.simulate([("PI", [13, 0], 5)])
+        self.assertEqual(([], 5), (result.breaches, len(result.self_destructs)), "Sealed scouts should self destruct")
+        self.assertEqual([[26, 14], [27, 14]], sorted([unit.x, unit.y] for unit in result.destroyed), "Self destructs destroyed the wrong walls")
+        self.assertEqual([0, 0.75], result.SP_gained, "Wrong refund for the removed wall")
+        self.assertEqual(25, len(result.structures), "Removed and destroyed walls should be gone")
+        self.assertEqual(28, len(game.game_map.get_structures(1)), "Simulating changed the game state")
+
+    def test_simulate_attacks(self):
+        game = self.make_turn_0_map()
+        for location in ([12, 14], [15, 14], [13, 16], [6, 15], [21, 15]):
+            game.game_map.add_unit("DF", location, 1)
+        simulator = ActionSimulator(game)
+        results = simulator.simulate_attacks(["PI", "EI"], (1, 6))
+        self.assertEqual(2 * 28 * 2, len(results), "Expected a result per unit type, spawn point and count")
+        for key in [("PI", (13, 0), 6), ("EI", (0, 13), 1), ("EI", (20, 6), 6)]:
+            unit_type, location, count = key
+            single = simulator.simulate([(unit_type, list(location), count)])
+            got = results[key]
+            self.assertEqual((single.frames, single.player_health, len(single.destroyed)), (got.frames, got.player_health, len(got.destroyed)), "Batch disagrees for {}".format(key))
+        batch = simulator.simulate_batch([[("PI", [13, 0], 6)], [("EI", [14, 0], 1)]])
+        self.assertEqual([results["PI", (13, 0), 6].player_health, results["EI", (14, 0), 1].player_health], [result.player_health for result in batch], "simulate_batch disagrees with simulate_attacks")
+
+    def write_replay(self, path, game, deploys):
+        config = game.config
+        shorthands = [type_config.get("shorthand") for type_config in config["unitInformation"]]
+
+        def frame(turn_info, units, health, breaches):
+            buckets = ([[] for _ in shorthands], [[] for _ in shorthands])
+            for unit in units:
+                buckets[unit.player_index][shorthands.index(unit.unit_type)].append([unit.x, unit.y, unit.health, ""])
+            return json.dumps({"p1Units": buckets[0], "p2Units": buckets[1], "turnInfo": turn_info,
+                "p1Stats": [health[0], 0, 0, 0], "p2Stats": [health[1], 0, 0, 0], "events": {"breach": breaches, "shield": []}})
+
+        simulator = ActionSimulator(game)
+        start = simulator.simulate(deploys, max_frames=0)
+        result = simulator.simulate(deploys)
+        lines = [json.dumps(config), frame([1, 0, 0], start.survivors + start.structures, start.player_health, [])]
+        health = list(start.player_health)
+
+        def on_frame(number, mobiles, structures):
+            breaches = [breach for breach in result.breaches if breach[0] == number]
+            for breach in breaches:
+                health[1 - breach[3]] -= 1
+            lines.append(frame([1, 0, number + 1], mobiles + structures, health, breaches))
+
+        simulator.simulate(deploys, on_frame=on_frame)
+        with open(path, "w") as replay:
+            replay.write("\n".join(lines))
+        return lines
+
+    def test_calibration(self):
+        game = self.make_turn_0_map()
+        for location in ([12, 14], [15, 14], [13, 16]):
+            game.game_map.add_unit("DF", location, 1)
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "match.replay")
+            lines = self.write_replay(path, game, [("PI", [13, 0], 4), ("EI", [20, 6], 2)])
+            reports = calibrate_replay(path)
+            self.assertEqual([len(lines) - 2], [report.frames for report in reports], "Expected one turn with every frame compared")
+            self.assertEqual({}, reports[0].first_divergence, "The simulator disagrees with its own replay")
+
+            moved = json.loads(lines[5])
+            moved["p1Units"][3][0][0] += 1
+            lines[5] = json.dumps(moved)
+            with open(path, "w") as replay:
+                replay.write("\n".join(lines))
+            report = calibrate_replay(path)[0]
+            self.assertEqual(3, report.first_divergence.get("pathing"), "A moved unit should be a pathing mismatch")
+            self.assertEqual(1 / report.frames, summarize([report])["pathing"], "Wrong pathing mismatch rate")
+
+    def test_calibration_fixture(self):
+        path = os.path.join(os.path.dirname(__file__), "fixtures", "short_match.replay")
+        config, frames = load_replay(path)
+        self.assertIn("debug", config, "The config line should be found")
+        turns = recorded_turns(frames)
+        self.assertEqual([(0, 1), (1, 30), (2, 8)], [(turn_number, len(action_frames)) for turn_number, action_frames in turns], "Wrong action phases")
+        reports = calibrate_replay(path)
+        self.assertEqual([1, 2], [report.turn_number for report in reports], "Expected a report for every turn with mobile units")
+        self.assertEqual([29, 7], [report.frames for report in reports])
+        self.assertEqual((3, 3), reports[0].breaches, "Wrong breaches")
+        self.assertEqual([29.0, 28.0], reports[-1].final_health[0], "Wrong recorded health")
+
+        with open(path) as replay:
+            lines = replay.read().splitlines()
+        broken = json.loads(lines[6])
+        del broken["p1Units"]
+        lines[6] = json.dumps(broken)
+        with tempfile.TemporaryDirectory() as folder:
+            broken_path = os.path.join(folder, "broken.replay")
+            with open(broken_path, "w") as replay:
+                replay.write("\n".join(lines))
+            with contextlib.redirect_stderr(io.StringIO()) as errors:
+                reports = calibrate_replay(broken_path)
+        self.assertEqual([2], [report.turn_number for report in reports], "A malformed frame should only drop its own turn")
+        self.assertIn("Could not calibrate turn 1", errors.getvalue())
+
     def test_print_unit(self):
         game = self.make_turn_0_map()
 
@@ -264,6 +598,104 @@ class BasicTests(unittest.TestCase):
         expected_string = "Enemy FF, health: 75.0 location: [14, 13] removal:  upgrade: False "
         self.assertEqual(got_string, expected_string, "Expected {} from print_unit test got {} ".format(expected_string, got_string))
 
+    def test_shared_unit_stats(self):
+        game = self.make_turn_0_map()
+        first = GameUnit("DF", game.config, 0, None, 13, 13)
+        second = GameUnit("DF", game.config, 1, 45.0, 14, 14)
+        self.assertIs(first._stats, second._stats, "Units of one type should share their stats")
+        self.assertFalse(hasattr(first, "__dict__"), "GameUnit should use __slots__")
+        self.assertEqual((90.0, 2.5, 5.0, [2.0, 0]), (first.max_health, first.attackRange, first.damage_i, first.cost), "Wrong base stats")
+        first.upgrade()
+        self.assertTrue(first.upgraded, "Unit should be upgraded")
+        self.assertEqual((90.0, 3.5, 15.0, [6.0, 0]), (first.health, first.attackRange, first.damage_i, first.cost), "Wrong upgraded stats")
+        self.assertEqual(2.5, second.attackRange, "Upgrading one unit changed another")
+
+    def test_two_rulesets(self):
+        game = self.make_turn_0_map()
+        other_config = json.loads(json.dumps(game.config))
+        other_config["unitInformation"][2]["shorthand"] = "DT"
+        other_config["unitInformation"][2]["attackRange"] = 5.5
+        other_config["unitInformation"][0]["cost1"] = 3.0
+        other = GameState(other_config, game.serialized_string)
+        other.suppress_warnings(True)
+
+        self.assertEqual(("DF", "DT"), (game.TURRET, other.TURRET), "Game states should keep their own unit types")
+        self.assertEqual([1.0, 0], game.type_cost("FF"), "Wall cost leaked between configs")
+        self.assertEqual([3.0, 0], other.type_cost("FF"), "Wrong wall cost")
+        self.assertEqual(1, game.attempt_spawn("DF", [13, 13]), "Could not spawn a turret after building another config")
+        self.assertEqual(1, other.attempt_spawn("DT", [13, 13]), "Could not spawn a turret with the other config")
+        self.assertEqual((2.5, 5.5), (game.game_map[13, 13][0].attackRange, other.game_map[13, 13][0].attackRange), "Wrong turret ranges")
+        self.assertEqual(5.5, other.ruleset.max_attack_range, "Wrong max attack range")
+        self.assertTrue(is_stationary("DF", game.ruleset), "A turret should be stationary in its own ruleset")
+        self.assertTrue(is_stationary("DT"), "Without a ruleset, the last game state's should be used")
+        self.assertFalse(is_stationary("DF"), "DF is not a unit type of the last game state")
+        self.assertEqual(1, len(other.get_attackers([13, 18], 1)), "Turret with the longer range should reach")
+        self.assertEqual(0, len(game.get_attackers([13, 18], 1)), "Turret with the shorter range should not reach")
+
+        for _ in range(Ruleset._rulesets.max_size + 4):
+            Ruleset.for_config(json.loads(json.dumps(game.config)))
+        self.assertEqual(Ruleset._rulesets.max_size, len(Ruleset._rulesets), "The ruleset cache should stay bounded")
+        self.assertEqual(1, game.attempt_upgrade([13, 13]), "Could not upgrade after the config left the ruleset cache")
+        self.assertEqual(3.5, game.game_map[13, 13][0].attackRange, "Wrong upgraded turret range")
+
+    def test_next_turn_changes(self):
+        game = self.make_turn_0_map()
+        turn = json.loads(game.serialized_string)
+        turn["p1Units"][0] = [[13, 1, 75.0, "1"], [14, 1, 75.0, "2"], [12, 2, 75.0, "3"]]
+        turn["p2Units"][2] = [[13, 20, 90.0, "4"], [14, 20, 90.0, "5"]]
+        first = GameState(game.config, json.dumps(turn))
+        first.find_path_to_edge([13, 0])
+        first.attempt_upgrade([13, 1])
+        wall = first.game_map[13, 1][0]
+
+        turn["turnInfo"][1] = 1
+        turn["p2Units"][2] = [[13, 20, 50.0, "4"], [14, 20, 90.0, "5"]]
+        turn["p1Units"][6] = [[14, 1, 0, "2"]]
+        turn["p1Units"].append([[12, 2, 0, "3"]])
+        same_layout = GameState(game.config, json.dumps(turn), first)
+        changes = same_layout.structure_changes
+        self.assertIs(wall, same_layout.game_map[13, 1][0], "Unchanged structures should be reused")
+        self.assertFalse(wall.upgraded, "Reused unit kept an upgrade that never happened")
+        self.assertEqual([], changes.built + changes.destroyed, "Nothing was built or destroyed")
+        self.assertEqual([[12, 2]], [[unit.x, unit.y] for unit in changes.upgraded], "Wrong upgraded structures")
+        self.assertEqual([[14, 1]], [[unit.x, unit.y] for unit in changes.marked_for_removal], "Wrong structures marked for removal")
+        self.assertEqual([([13, 20], 90.0)], [([unit.x, unit.y], health) for unit, health in changes.health_changed], "Wrong health changes")
+        self.assertIs(first._edge_fields, same_layout._edge_fields, "Pathing caches should be kept for an unchanged layout")
+
+        turn["p1Units"] = turn["p1Units"][:6] + [[]]
+        turn["p1Units"][0] = [[13, 1, 75.0, "1"], [12, 2, 75.0, "3"]]
+        turn["p1Units"][2] = [[14, 1, 90.0, "6"], [15, 2, 90.0, "7"]]
+        changed_layout = GameState(game.config, json.dumps(turn), same_layout)
+        changes = changed_layout.structure_changes
+        self.assertEqual([[14, 1], [15, 2]], sorted([unit.x, unit.y] for unit in changes.built), "Wrong built structures")
+        self.assertEqual([["FF", 14, 1]], [[unit.unit_type, unit.x, unit.y] for unit in changes.destroyed], "Wrong destroyed structures")
+        fresh = GameState(game.config, json.dumps(turn))
+        self.assertEqual(fresh.find_path_to_edge([13, 0]), changed_layout.find_path_to_edge([13, 0]), "Stale pathing cache after the layout changed")
+
+    def test_lazy_parsing(self):
+        game = self.make_turn_0_map()
+        turn = json.loads(game.serialized_string)
+        turn["p1Units"][0] = [[13, 1, 75.0, "1"], [14, 1, 60.0, "2"]]
+        turn["p1Units"][2] = [[12, 2, 90.0, "3"]]
+        turn["p1Units"][3] = [[13, 0, 15.0, "4"]]
+        turn["p2Units"][2] = [[13, 20, 90.0, "5"]]
+        turn["p1Units"][6] = [[14, 1, 0, "2"]]
+        turn["p1Units"].append([[12, 2, 0, "3"]])
+        serialized = json.dumps(turn)
+        eager = GameState(game.config, serialized)
+        lazy = GameState(game.config, serialized, lazy=True)
+        self.assertEqual(5, lazy.get_resource(lazy.MP), "Stats should be parsed up front")
+        self.assertEqual(1, len(lazy.game_map.get_structures(1, "DF")), "Wrong enemy turrets")
+        self.assertTrue(lazy.game_map.get_structures(0, "DF")[0].upgraded, "Upgrade was not applied to a lazily built turret")
+        self.assertTrue(lazy.game_map[14, 1][0].pending_removal, "Removal was not applied to a lazily built wall")
+        for location in eager.game_map:
+            self.assertEqual(str(eager.game_map[location]), str(lazy.game_map[location]), "Lazy map differs at {}".format(location))
+
+        lazy = GameState(game.config, serialized, lazy=True)
+        lazy.attempt_upgrade([13, 1])
+        next_turn = GameState(game.config, serialized, lazy, lazy=True)
+        self.assertEqual(0, len(next_turn.structure_changes), "Planned upgrades should not show up as changes")
+
     def test_future_MP(self):
         game = self.make_turn_0_map()
 
@@ -275,3 +707,346 @@ class BasicTests(unittest.TestCase):
         actual = game.project_future_MP(turns)
         self.assertAlmostEqual(actual, expected, 0, "Expected {} MP {} turns from now, got {}".format(expected, turns, actual))
 
+    def make_random_board(self, seed, structures=150):
+        game = self.make_turn_0_map()
+        rng = random.Random(seed)
+        locations = [location for location in game.game_map]
+        for location in rng.sample(locations, structures):
+            game.game_map.add_unit("FF", location, 0 if location[1] < game.HALF_ARENA else 1)
+        return game
+
+    def test_grid_path_finder_matches_reference(self):
+        for seed in range(6):
+            game = self.make_random_board(seed, 80 + 40 * seed)
+            reference = ShortestPathFinder()
+            finder = GridPathFinder()
+            edges = game.game_map.get_edges()
+            for start in list(game.game_map)[seed::5]:
+                if game.contains_stationary_unit(start):
+                    continue
+                end_points = edges[game.get_target_edge(start)]
+                expected = reference.navigate_multiple_endpoints(start, end_points, game)
+                self.assertEqual(expected, finder.navigate_multiple_endpoints(start, end_points, game), "Paths differ from {} on board {}".format(start, seed))
+
+    def test_find_paths_to_edge_many(self):
+        game = self.make_random_board(3, 120)
+        reference = ShortestPathFinder()
+        starts = game.game_map.get_edge_locations(game.game_map.BOTTOM_LEFT) + game.game_map.get_edge_locations(game.game_map.BOTTOM_RIGHT)
+        paths = game.find_paths_to_edge_many(starts)
+        for start, path in zip(starts, paths):
+            if game.contains_stationary_unit(start):
+                self.assertIsNone(path)
+                continue
+            end_points = game.game_map.get_edge_locations(game.get_target_edge(start))
+            self.assertEqual(reference.navigate_multiple_endpoints(start, end_points, game), path, "Batched path differs from {}".format(start))
+
+        # The cached fields must be dropped once the layout changes
+        start = [13, 0]
+        game.game_map.remove_unit(start)
+        before = game.find_path_to_edge(start)
+        game.game_map.add_unit("FF", before[len(before) // 2], 0)
+        end_points = game.game_map.get_edge_locations(game.get_target_edge(start))
+        self.assertEqual(reference.navigate_multiple_endpoints(start, end_points, game), game.find_path_to_edge(start), "Path cache was not invalidated")
+
+    def test_incremental_path_finder(self):
+        game = self.make_random_board(4, 160)
+        rng = random.Random(4)
+        finder = IncrementalPathFinder.from_game_state(game)
+        reference = GridPathFinder()
+        edges = game.game_map.get_edges()
+        locations = list(game.game_map)
+        for step in range(60):
+            location = rng.choice(locations)
+            finder.set_blocked(location, not finder.blocked[location[0] + location[1] * game.ARENA_SIZE])
+            for start in locations[step % 7::7]:
+                end_points = edges[game.get_target_edge(start)]
+                expected = reference.navigate_blocked(start, end_points, finder.blocked)
+                self.assertEqual(expected, finder.find_path(start, end_points), "Incremental path differs from {} after step {}".format(start, step))
+
+    def test_self_destruct_location(self):
+        game = self.make_turn_0_map()
+        self.assertIsNone(game.get_self_destruct_location([13, 0]), "An open board should not seal anyone in")
+        for x in range(28):
+            if game.game_map.in_arena_bounds([x, 13]):
+                game.game_map.add_unit("FF", [x, 13], 0)
+        self.assertEqual([26, 12], game.get_self_destruct_location([13, 0]), "Unit heading top right should self destruct in the top right corner of our pocket")
+        self.assertEqual([1, 12], game.get_self_destruct_location([14, 0]), "Unit heading top left should self destruct in the top left corner of our pocket")
+        path = game.find_path_to_edge([13, 0])
+        self.assertEqual([26, 12], path[-1], "Sealed path should end on the self destruct location")
+
+        reference = ShortestPathFinder()
+        for seed in range(3):
+            game = self.make_random_board(seed, 220)
+            for start in list(game.game_map)[seed::3]:
+                if game.contains_stationary_unit(start):
+                    continue
+                end_points = game.game_map.get_edge_locations(game.get_target_edge(start))
+                expected = reference.navigate_multiple_endpoints(start, end_points, game)
+                self.assertEqual(expected, game.find_path_to_edge(start), "Path differs from {} on board {}".format(start, seed))
+                sealed_at = game.get_self_destruct_location(start)
+                if expected[-1] in end_points:
+                    self.assertIsNone(sealed_at)
+                else:
+                    self.assertEqual(expected[-1], sealed_at)
+
+    def test_savepoint_rollback(self):
+        game = self.make_random_board(1, 120)
+        game.game_map.add_unit("EF", [13, 5], 0)
+        game._player_resources[0]["SP"] = 100
+
+        def snapshot():
+            game_map = game.game_map
+            return (game.get_resources(0), game.structure_mask(0), game.structure_mask(1), game_map.mobile_mask(),
+                sorted((unit.x, unit.y, unit.unit_type, unit.upgraded) for unit in game_map.get_structures()),
+                [game_map.get_attacker_count(location, 1) for location in game_map],
+                [game_map.get_shield(location, 0) for location in game_map],
+                list(game._build_stack), list(game._deploy_stack), game.find_path_to_edge([13, 0]))
+
+        before = snapshot()
+        outer = game.savepoint()
+        game.attempt_spawn("DF", [[10, 10], [11, 10], [16, 11]])
+        game.attempt_spawn("PI", [13, 0], 3)
+        game.attempt_upgrade([13, 5])
+        after_outer = snapshot()
+        inner = game.savepoint()
+        game.attempt_remove([13, 5])
+        game.game_map.remove_unit([13, 5])
+        game.game_map.add_unit("FF", [13, 1], 0)
+        game.game_map[14, 1] = []
+        self.assertNotEqual(after_outer, snapshot(), "The inner branch should change the board")
+        game.rollback(inner)
+        self.assertEqual(after_outer, snapshot(), "Rollback to the inner savepoint did not restore the board")
+        game.rollback(outer)
+        self.assertEqual(before, snapshot(), "Rollback to the outer savepoint did not restore the board")
+        game.attempt_spawn("FF", [13, 1])
+        game.rollback(outer)
+        self.assertEqual(before, snapshot(), "A savepoint should be reusable")
+
+    def test_zobrist_hash(self):
+        game = self.make_random_board(2, 120)
+        game_map = game.game_map
+
+        def full_hash():
+            value = 0
+            for unit in game_map.get_structures():
+                value ^= zobrist_key(unit.x + unit.y * game.ARENA_SIZE, unit.unit_type, unit.player_index, unit.upgraded)
+            return value
+
+        start = game_map.zobrist_hash()
+        self.assertEqual(full_hash(), start, "Incremental hash differs from a full recompute")
+        game._player_resources[0]["SP"] = 100
+        savepoint = game.savepoint()
+        game.attempt_spawn("DF", [[13, 2], [14, 2]])
+        structure = game_map.get_structures(0)[0]
+        game.attempt_upgrade([structure.x, structure.y])
+        self.assertTrue(structure.upgraded)
+        self.assertEqual(full_hash(), game_map.zobrist_hash(), "Hash missed a spawn or an upgrade")
+        game_map.get_structures(1)[0].upgrade()
+        self.assertEqual(full_hash(), game_map.zobrist_hash(), "Hash missed GameUnit.upgrade")
+        self.assertNotEqual(start, game_map.zobrist_hash())
+        game.rollback(savepoint)
+        self.assertEqual(start, game_map.zobrist_hash(), "Rollback did not restore the hash")
+
+        other = self.make_turn_0_map()
+        for unit in reversed(game_map.get_structures()):
+            other.game_map.add_unit(unit.unit_type, [unit.x, unit.y], unit.player_index)
+        self.assertEqual(start, other.game_map.zobrist_hash(), "The same layout built in another order should hash the same")
+
+        GameState.layout_cache.clear()
+        game.find_path_to_edge([13, 0])
+        game.game_map.add_unit("FF", [13, 1], 0)
+        game.find_path_to_edge([13, 0])
+        game.game_map.remove_unit([13, 1])
+        self.assertEqual(game.find_path_to_edge([13, 0]), other.find_path_to_edge([13, 0]))
+        self.assertEqual((2, 4), (GameState.layout_cache.misses, GameState.layout_cache.hits + GameState.layout_cache.misses), "Revisited layouts and the copied board should hit the cache")
+
+        cache = TranspositionCache(2)
+        for key in "abac":
+            cache.get_or_compute(key, key.upper)
+        self.assertEqual((1, 3, 2), (cache.hits, cache.misses, len(cache)), "Wrong hit counters or size")
+        self.assertNotIn("b", cache, "The least recently used entry should be dropped")
+
+    def test_evaluation_pool(self):
+        game = self.make_random_board(4, 100)
+        game.game_map.add_unit("PI", [13, 0], 0)
+
+        def evaluate_plan(game_state, plan):
+            if plan == "slow":
+                time.sleep(1)
+            elif plan == "crash":
+                os._exit(1)
+            elif plan == "broken":
+                raise ValueError("broken plan")
+            spawned = game_state.attempt_spawn("FF", plan)
+            return spawned, game_state.get_resource(game_state.SP), game_state.game_map.zobrist_hash(), len(game_state.game_map[13, 0])
+
+        plans = [[[13, 2]], [[12, 3], [15, 3]], [[0, 13]]]
+        expected = []
+        for plan in plans:
+            savepoint = game.savepoint()
+            expected.append(evaluate_plan(game, plan))
+            game.rollback(savepoint)
+        with EvaluationPool(game.config, evaluate_plan, processes=2) as pool:
+            self.assertIsNone(pool.evaluate(plans), "Evaluating before publishing should fail")
+            pool.publish(game)
+            self.assertEqual(expected, pool.evaluate(plans, timeout=5), "Workers scored plans differently")
+            started = time.monotonic()
+            results = pool.evaluate(["slow"] + plans, timeout=0.5)
+            self.assertLess(time.monotonic() - started, 0.55, "evaluate should not wait for the late worker")
+            self.assertEqual([None] + expected, results, "A slow plan should be abandoned without holding up the rest")
+            self.assertEqual(1, pool.missed)
+            self.assertEqual(1, len(pool._abandoned), "The late worker should be replaced later, not after the deadline")
+            pool.replace_workers()
+            self.assertEqual(set(), pool._abandoned)
+            self.assertEqual(expected, pool.evaluate(plans, timeout=5), "The worker left on the slow plan should be replaced")
+            results = pool.evaluate(["crash", "broken"] + plans)
+            self.assertEqual([None, None] + expected, results, "A dead worker should not hold up an evaluate without timeout")
+            self.assertEqual(0, pool.missed)
+
+    def test_anytime_turn(self):
+        game = self.make_turn_0_map()
+        core = AlgoCore()
+        core.config = game.config
+        self.assertAlmostEqual(5 * 0.85, core.turn_budget(), msg="Budget should come from waitTimeBotSoft")
+        core._last_turn_elapsed = 1.0
+        core._record_turn_time({"p1Stats": [30, 25, 5, 1500]})
+        self.assertAlmostEqual(5 * 0.85 - 0.5, core.turn_budget(), msg="Budget should leave room for the reported overhead")
+
+        game.attempt_spawn("FF", [13, 0])
+        core.turn_overheads.clear()
+        core.turn_time_limit = 0.2
+        turn = core.anytime_turn(game)
+
+        def one_wall(game_state):
+            game_state.attempt_spawn("FF", [10, 3])
+            return 1
+
+        def growing(game_state):
+            for score, location in enumerate([[11, 2], [12, 1]], 2):
+                game_state.attempt_spawn("FF", location)
+                yield score
+
+        def broken(game_state):
+            game_state.attempt_spawn("FF", [20, 6])
+            raise ValueError("broken step")
+
+        def slow(game_state):
+            game_state.attempt_spawn("FF", [14, 0])
+            while True:
+                time.sleep(0.05)
+                yield 0
+
+        def too_late(game_state):
+            return 100
+
+        for step in (one_wall, growing, broken, slow, too_late):
+            turn.add_step(step)
+        builds, deploys = turn.run(submit=False)
+        self.assertEqual([("FF", 13, 0), ("FF", 11, 2), ("FF", 12, 1)], builds, "The best plan should be the last yield of the growing step")
+        self.assertEqual((3, 1, 4), (turn.best_score, turn.best_step, turn.steps_run), "The step after the deadline should not run")
+        self.assertEqual([("FF", 13, 0)], game._build_stack, "The game state should be back at the baseline")
+        self.assertEqual(1, len(game.game_map.get_structures()))
+
+    def engine(self, messages):
+        """A stand-in for get_command that sends each (message, ready) pair once ready() is true, then waits forever
+        """
+        pending = iter(messages)
+
+        def get_command():
+            for message, ready in pending:
+                while not ready():
+                    time.sleep(0.01)
+                return message
+            threading.Event().wait()
+        return get_command
+
+    def play_turns(self, algo, messages):
+        """Runs algo on the engine messages, returning the lines it wrote to stdout
+        """
+        output = io.StringIO()
+        with mock.patch("gamelib.algocore.get_command", side_effect=self.engine(messages(output))), contextlib.redirect_stdout(output), contextlib.redirect_stderr(io.StringIO()):
+            algo.start()
+        return output.getvalue().splitlines()
+
+    def test_watchdog(self):
+        game = self.make_turn_0_map()
+        turn = game.serialized_string
+
+        class SlowAlgo(AlgoCore):
+            def on_turn(self, turn_state):
+                game_state = GameState(self.config, turn_state)
+                game_state.suppress_warnings(True)
+                self.played.append(game_state.turn_number)
+                if game_state.turn_number == 0:
+                    time.sleep(0.3)
+                    self.overran = self.turn_overran
+                if game_state.turn_number != 1:
+                    game_state.attempt_spawn("FF", [13, 0])
+                    game_state.submit_turn()
+
+        algo = SlowAlgo()
+        algo.played = []
+        algo.watchdog_timeout = 0.1
+        algo.set_fallback(([("FF", 14, 0)], []))
+
+        def messages(output):
+            idle = lambda turns: lambda: len(output.getvalue().splitlines()) >= 2 * turns and not algo._turn_running
+            return [(json.dumps(game.config), lambda: True), (turn, lambda: True),
+                (turn.replace('"turnInfo":[0,0,-1]', '"turnInfo":[0,1,-1]'), lambda: algo.played == [0] and idle(1)()),
+                (turn.replace('"turnInfo":[0,0,-1]', '"turnInfo":[0,2,-1]'), idle(2)), ('{"turnInfo":[2,3,-1]}', idle(3))]
+        fallback, planned = '[["FF", 14, 0]]', '[["FF", 13, 0]]'
+        self.assertEqual([fallback, "[]", fallback, "[]", planned, "[]"], self.play_turns(algo, messages),
+            "Expected the fallback for the slow and the unsubmitted turn, then the planned turn")
+        self.assertEqual([0, 1, 2], algo.played)
+        self.assertTrue(algo.overran, "The slow turn should know it overran")
+
+    def test_watchdog_late_turn(self):
+        game = self.make_turn_0_map()
+        turn = game.serialized_string
+
+        class SlowAlgo(AlgoCore):
+            def on_turn(self, turn_state):
+                game_state = GameState(self.config, turn_state)
+                game_state.suppress_warnings(True)
+                self.played.append(game_state.turn_number)
+                if game_state.turn_number == 0:
+                    time.sleep(0.5)
+                    self.sent_while_slow = len(self.output.getvalue().splitlines())
+                else:
+                    self.started = time.monotonic()
+                    self.deadline = self.anytime_turn(game_state).deadline
+                game_state.attempt_spawn("FF", [13, 0])
+                game_state.submit_turn()
+
+            def on_action_frame(self, frame):
+                time.sleep(0.1)
+
+        algo = SlowAlgo()
+        algo.played = []
+        algo.watchdog_timeout = 0.2
+        algo.set_fallback(([("FF", 14, 0)], []))
+        arrivals = {}
+
+        def arrived(name, ready):
+            def check():
+                if not ready():
+                    return False
+                arrivals[name] = time.monotonic()
+                return True
+            return check
+
+        def messages(output):
+            algo.output = output
+            lines = lambda count: lambda: len(output.getvalue().splitlines()) >= count
+            return [(json.dumps(game.config), lambda: True), (turn, lambda: True),
+                (turn.replace('"turnInfo":[0,0,-1]', '"turnInfo":[0,1,-1]'), lines(2)),
+                ('{"turnInfo":[1,1,0]}', lambda: lines(4)() and algo.played == [0] and not algo._turn_running),
+                (turn.replace('"turnInfo":[0,0,-1]', '"turnInfo":[0,2,-1]'), arrived(2, lambda: True)),
+                ('{"turnInfo":[2,3,-1]}', lines(6))]
+        fallback, planned = '[["FF", 14, 0]]', '[["FF", 13, 0]]'
+        self.assertEqual([fallback, "[]", fallback, "[]", planned, "[]"], self.play_turns(algo, messages),
+            "Expected the fallback for the slow turn and the turn that arrived during it, then the planned turn")
+        self.assertEqual(4, algo.sent_while_slow, "The turn that arrived during the slow turn should be answered at once")
+        self.assertEqual([0, 2], algo.played, "on_turn should not run for a turn that was already answered")
+        self.assertGreater(algo.started - arrivals[2], 0.05, "The turn should have waited for the action frame")
+        self.assertLess(abs(arrivals[2] + algo.turn_budget() - algo.deadline), 0.03, "The deadline should count from the arrival of the turn")
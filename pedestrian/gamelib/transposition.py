@@ -0,0 +1,109 @@
+"""
+Zobrist keys for structure layouts and a bounded cache for analyses keyed on them.
+"""
+
+import random
+from collections import OrderedDict
+
+_keys = {}
+
+
+def zobrist_key(tile, unit_type, player_index, upgraded):
+    """The random 64 bit key of one structure, the hash of a layout is the xor of the keys of its structures
+
+    Keys are derived from their arguments alone, so they are the same in every process and every run.
+
+    Args:
+        tile: The flat index x + y * ARENA_SIZE of the structure
+        unit_type: The type of the structure
+        player_index: The player controlling it
+        upgraded: If it is upgraded
+
+    Returns:
+        An int below 2 ** 64
+
+    """
+    key = (tile, unit_type, player_index, upgraded)
+    value = _keys.get(key)
+    if value is None:
+        value = _keys[key] = random.Random("{}:{}:{}:{}".format(*key)).getrandbits(64)
+    return value
+
+
+class TranspositionCache:
+    """A least recently used cache with hit counters, for analyses repeated on the same layout
+
+    Key entries on GameMap.zobrist_hash together with whatever else the analysis depends on,
+    for example (game_map.zobrist_hash(), start_location, target_edge) for a path.
+
+    Attributes :
+        * max_size (int): The number of entries kept, the least recently used one is dropped first
+        * hits (int): The number of lookups that found an entry
+        * misses (int): The number of lookups that did not
+
+    """
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __contains__(self, key):
+        return key in self.__entries
+
+    def get(self, key, default=None):
+        """The entry stored under key, or default. Counts a hit or a miss.
+        """
+        entries = self.__entries
+        if key in entries:
+            entries.move_to_end(key)
+            self.hits += 1
+            return entries[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        """Stores value under key, dropping the least recently used entry if the cache is full
+        """
+        entries = self.__entries
+        entries[key] = value
+        entries.move_to_end(key)
+        if len(entries) > self.max_size:
+            entries.popitem(last=False)
+
+    def get_or_compute(self, key, compute):
+        """The entry stored under key, calling compute() and storing its result on a miss
+
+        Args:
+            key: The cache key
+            compute: A function without arguments returning the value
+
+        Returns:
+            The cached or computed value
+
+        """
+        entries = self.__entries
+        if key in entries:
+            entries.move_to_end(key)
+            self.hits += 1
+            return entries[key]
+        self.misses += 1
+        value = compute()
+        self.put(key, value)
+        return value
+
+    def hit_rate(self):
+        """The share of lookups that were hits, 0 if there were none
+        """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def clear(self):
+        """Drops every entry and resets the counters
+        """
+        self.__entries.clear()
+        self.hits = 0
+        self.misses = 0
@@ -1,3 +1,6 @@
+from .ruleset import Ruleset
+
+
 def is_stationary(unit_type, structure_types):
     """
         Args:
@@ -9,6 +12,10 @@ def is_stationary(unit_type, structure_types):
     return unit_type in structure_types
 
 
+def _stat(name):
+    return property(lambda self: getattr(self._stats, name), doc="Read from this unit's UnitStats record")
+
+
 class GameUnit:
     """Holds information about a Unit. 
 
@@ -31,7 +38,13 @@ class GameUnit:
         * pending_removal (boolean): If this unit is marked for removal by its owner
         * upgraded (boolean): If this unit is upgraded
 
+    The stats are shared with every other unit of the same type through an immutable UnitStats record, 
+    so they can not be changed on a single unit. upgrade() switches the unit to the upgraded record. 
+    A structure standing on a GameMap is upgraded through GameMap.upgrade_unit, so the map stays up to date.
+
     """
+    __slots__ = ("unit_type", "config", "player_index", "health", "x", "y", "pending_removal", "_stats", "_game_map")
+
     def __init__(self, unit_type, config, player_index=None, health=None, x=-1, y=-1):
         """ Initialize unit variables using args passed
 
@@ -40,41 +53,42 @@ class GameUnit:
         self.config = config
         self.player_index = player_index
         self.pending_removal = False
-        self.upgraded = False
+        self._game_map = None
         self.x = x
         self.y = y
-        self.__serialize_type()
+        self._stats = Ruleset.for_config(config).stats[unit_type, False]
         self.health = self.max_health if not health else health
 
-    def __serialize_type(self):
-        from .game_state import STRUCTURE_TYPES, UNIT_TYPE_TO_INDEX, SUPPORT
-        type_config = self.config["unitInformation"][UNIT_TYPE_TO_INDEX[self.unit_type]]
-        self.stationary = type_config["unitCategory"] == 0
-        self.speed = type_config.get("speed", 0)
-        self.damage_f = type_config.get("attackDamageTower", 0)
-        self.damage_i = type_config.get("attackDamageWalker", 0)
-        self.attackRange = type_config.get("attackRange", 0)
-        self.shieldRange = type_config.get("shieldRange", 0)
-        self.max_health = type_config.get("startHealth", 0)
-        self.shieldPerUnit = type_config.get("shieldPerUnit", 0)
-        self.shieldBonusPerY = type_config.get("shieldBonusPerY", 0)
-        self.cost = [type_config.get("cost1", 0), type_config.get("cost2", 0)]
+    upgraded = _stat("upgraded")
+    stationary = _stat("stationary")
+    speed = _stat("speed")
+    damage_f = _stat("damage_f")
+    damage_i = _stat("damage_i")
+    attackRange = _stat("attackRange")
+    shieldRange = _stat("shieldRange")
+    max_health = _stat("max_health")
+    shieldPerUnit = _stat("shieldPerUnit")
+    shieldBonusPerY = _stat("shieldBonusPerY")
 
+    @property
+    def cost(self):
+        return list(self._stats.cost)
 
-    def upgrade(self):
-        from .game_state import UNIT_TYPE_TO_INDEX
-        type_config = self.config["unitInformation"][UNIT_TYPE_TO_INDEX[self.unit_type]].get("upgrade", {})
-        self.speed = type_config.get("speed", self.speed)
-        self.damage_f = type_config.get("attackDamageTower", self.damage_f)
-        self.damage_i = type_config.get("attackDamageWalker", self.damage_i)
-        self.attackRange = type_config.get("attackRange", self.attackRange)
-        self.shieldRange = type_config.get("shieldRange", self.shieldRange)
-        self.max_health = type_config.get("startHealth", self.max_health)
-        self.shieldPerUnit = type_config.get("shieldPerUnit", self.shieldPerUnit)
-        self.shieldBonusPerY = type_config.get("shieldBonusPerY", self.shieldBonusPerY)
-        self.cost = [type_config.get("cost1", 0) + self.cost[0], type_config.get("cost2", 0) + self.cost[1]]
-        self.upgraded = True
+    def reset(self, health=None):
+        """Puts the unit back to its parsed state with the given health, used when a unit is carried over to the next turn
+        """
+        self._stats = Ruleset.for_config(self.config).stats[self.unit_type, False]
+        self._game_map = None
+        self.pending_removal = False
+        self.health = self.max_health if not health else health
 
+    def upgrade(self):
+        """Switches the unit to its upgraded stats, updating the GameMap it stands on if there is one
+        """
+        if self._game_map is not None:
+            self._game_map._upgrade(self)
+        else:
+            self._stats = Ruleset.for_config(self.config).stats[self.unit_type, True]
 
     def __toString(self):
         owner = "Friendly" if self.player_index == 0 else "Enemy"
@@ -1,8 +1,23 @@
 import sys
+import json
+import threading
+
+try:
+    import orjson as _fast_json
+except ImportError:
+    try:
+        import ujson as _fast_json
+    except ImportError:
+        _fast_json = None
 
 
 BANNER_TEXT = "---------------- Starting Your Algo --------------------"
 
+_submission_lock = threading.Lock()
+_guarded_turn = None
+_turn_count = 0
+_turn_submitted = False
+
 
 def get_command():
     """Gets input from stdin
@@ -29,6 +44,58 @@ def send_command(cmd):
     sys.stdout.write(cmd.strip() + "\n")
     sys.stdout.flush()
 
+def open_turn():
+    """Starts guarding the submissions of a turn, so that only the first one is sent. Used by the AlgoCore watchdog.
+
+    Returns:
+        The id of the guarded turn, see submit_commands
+
+    """
+    global _guarded_turn, _turn_count, _turn_submitted
+    with _submission_lock:
+        _turn_count += 1
+        _guarded_turn = _turn_count
+        _turn_submitted = False
+        return _guarded_turn
+
+def close_turn():
+    """Stops guarding submissions, later ones are sent again
+
+    Returns:
+        True if the guarded turn was submitted
+
+    """
+    global _guarded_turn
+    with _submission_lock:
+        _guarded_turn = None
+        return _turn_submitted
+
+def submit_commands(build_string, deploy_string, turn=None):
+    """Sends the build and deploy commands of a turn together
+
+    While a turn is guarded, only its first submission is sent and later ones are discarded.
+
+    Args:
+        build_string: The json list of build commands
+        deploy_string: The json list of deploy commands
+        turn: If given, the commands are only sent while this turn id is guarded
+
+    Returns:
+        True if the commands were sent, False if they were discarded
+
+    """
+    global _turn_submitted
+    with _submission_lock:
+        if turn is not None and turn != _guarded_turn:
+            return False
+        if _guarded_turn is not None:
+            if _turn_submitted:
+                return False
+            _turn_submitted = True
+        send_command(build_string)
+        send_command(deploy_string)
+        return True
+
 def debug_write(*msg):
     """Prints a message to the games debug output
 
@@ -39,3 +106,14 @@ def debug_write(*msg):
     #Printing to STDERR is okay and printed out by the game but doesn't effect turns.
     sys.stderr.write(", ".join(map(str, msg)).strip() + "\n")
     sys.stderr.flush()
+
+def decode_json(string):
+    """Decodes a json string, using orjson or ujson instead of the json module if one of them is installed
+
+    Args:
+        string: The json string to decode
+
+    """
+    if _fast_json is not None:
+        return _fast_json.loads(string)
+    return json.loads(string)